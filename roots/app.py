@@ -1,16 +1,31 @@
 #!/usr/bin/env python
 
-from collections import defaultdict
+import os
+import threading
+from typing import Optional
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
 
-from roots import conversations, models, context, memories
-from roots.types import Message
-
-
-SUMMARIZE_HISTORY_AT = 50
+from roots import cancellation as cancellations
+from roots import conversations, models, context, memories, pubsub, sessions, tracing
+from roots import jobs, sql
+from roots._decisions import DECISION_CACHE_FILE
+from roots._embedding import EMBEDDING_CACHE_FILE, embedding_cache
+from roots.cancellation import Cancelled, CancellationToken
+from roots.streaming import Acknowledge, StreamCoalescer
+from roots.types import Job, Message
+
+
+PORT = int(os.getenv("ROOTS_PORT", "5001"))
+DEBUG = os.getenv("ROOTS_DEBUG", "1") != "0"
+# set when several server processes share the data directory behind a load balancer
+# with sticky sessions, such as "sqlite:///data/socketio.db" or a Redis URL
+MESSAGE_QUEUE = os.getenv("ROOTS_MESSAGE_QUEUE", "")
+MEMORY_BATCH_SIZE = 64
+DEDUPLICATE_EVERY_SECONDS = 24 * 60 * 60.0
+OPTIMIZE_EVERY_SECONDS = 24 * 60 * 60.0
 
 app = Flask(__name__)
 CORS(app)
@@ -22,15 +37,44 @@ socketio = SocketIO(
     ping_timeout=10,
     logger=True,
     engineio_logger=True,
+    **pubsub.options(MESSAGE_QUEUE),
 )
-stream_allowed: dict[str, bool] = {}
-chat_histories: dict[str, list[models.ChatMessage]] = defaultdict(list)
+
+tracing.register_collector("decision_cache", models.decision_cache.stats)
+tracing.register_collector("embedding_cache", embedding_cache.stats)
+tracing.register_collector("sessions", lambda: sessions.store.stats())
+tracing.register_collector("jobs", jobs.stats)
+tracing.register_collector("router", context.router_stats)
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(tracing.render(), content_type=tracing.METRICS_CONTENT_TYPE)
+
+
+_initialized = False
+_initialize_lock = threading.Lock()
+
+
+def initialize():
+    global _initialized  # pylint: disable=global-statement
+    with _initialize_lock:
+        if _initialized:
+            return
+        conversations.initialize_database()
+        # a missing index is rebuilt by the job workers rather than holding up startup
+        memories.initialize_database(rebuild=False)
+        jobs.start()
+        if memories.needs_rebuild():
+            jobs.enqueue("rebuild_memory_index", coalesce_key="rebuild_memory_index")
+        jobs.enqueue("backfill_search_index", coalesce_key="backfill_search_index")
+        _initialized = True
 
 
 @socketio.on("initialize")
 def handle_initialization():
-    conversations.initialize_database()
-    memories.initialize_database()
+    # the server initializes once at startup; this only covers imports that skip it
+    initialize()
     emit("initialized")
 
 
@@ -46,20 +90,16 @@ def handle_conversation_request(data: dict[str | int, str]):
         conversation = conversations.create(conversation_name)
         new_conversation = True
     else:
-        conversation = conversations.fetch(int(conversation_id))
+        conversation = conversations.fetch(
+            int(conversation_id), message_limit=conversations.MESSAGE_PAGE_SIZE
+        )
 
     emit("conversation_response", conversation)
 
     if new_conversation:
-        handle_request_conversations()
+        emit_conversations_delta(conversation["conversation_id"])
 
-    history: list[models.ChatMessage] = [
-        {"role": message["role"], "content": message["content"]}
-        for message in conversation["messages"]
-    ]
-    if len(history) >= SUMMARIZE_HISTORY_AT:
-        history = models.summarize_history(history)
-    chat_histories[session_id] += history
+    sessions.store.history(session_id, conversation["conversation_id"], refresh=True)
 
 
 @socketio.on("update_conversation")
@@ -70,20 +110,35 @@ def handle_conversation_update(data: dict[str, str]):
         name=data.get("name", None),
     )
     emit("conversation_update", conversation)
-    handle_request_conversations()
+    emit_conversations_delta(conversation_id)
 
 
 @socketio.on("new_message")
 def handle_new_message(data: dict):
     session_id = request.sid  # type: ignore
-
-    if not stream_allowed.get(session_id, True):
-        stream_allowed[session_id] = True
-        return
-
     user_message: Message = data["user_message"]
     assistant_message: Message = data["assistant_message"]
 
+    message_id = assistant_message["message_id"]
+    cancellation = cancellations.register(message_id, session_id)
+    try:
+        with (
+            cancellations.active(cancellation),
+            tracing.trace(
+                "chat", message_id=message_id, model_id=assistant_message["model_id"]
+            ),
+        ):
+            respond(session_id, user_message, assistant_message, cancellation)
+    finally:
+        cancellations.release(message_id)
+
+
+def respond(
+    session_id: str,
+    user_message: Message,
+    assistant_message: Message,
+    cancellation: CancellationToken,
+):
     emit(
         "backend_update",
         {
@@ -92,40 +147,8 @@ def handle_new_message(data: dict):
         },
     )
 
-    is_memorable, memory = memories.is_memorable(user_message["content"])
-    if is_memorable:
-        print("Saving memory: ", memory)
-        memories.add(memory)
-        user_message["context"] = f"Memory saved: {memory}"
-        emit(
-            "message_metadata_response",
-            {
-                "message_id": user_message["message_id"],
-                "context": memory,
-            },
-        )
-
-    conversations.save_message(user_message)
-
-    additional_context = context.generate(user_message["content"])
-
-    if additional_context:
-        chat_prompt = "\n\n".join((additional_context, user_message["content"]))
-        assistant_message["context"] = additional_context
-    else:
-        chat_prompt = user_message["content"]
-
-    chat_histories[session_id].append(
-        {"role": user_message["role"], "content": chat_prompt}
-    )
-    chat = models.query(
-        assistant_message["model_id"],  # type: ignore
-        messages=chat_histories[session_id],
-    )
-
-    response = ""
-    for token in chat:
-        response += token
+    def start_writing():
+        tracing.mark("time_to_first_token")
         emit(
             "backend_update",
             {
@@ -133,16 +156,59 @@ def handle_new_message(data: dict):
                 "state": "writing",
             },
         )
+
+    def emit_frame(content: str, acknowledge: Acknowledge):
         emit(
             "message_stream_response",
             {
                 "message_id": assistant_message["message_id"],
-                "content": token,
+                "content": content,
             },
+            callback=acknowledge,
         )
 
-    assistant_message["content"] = response
-    conversations.save_message(assistant_message)
+    conversation_id = int(user_message["conversation_id"])
+    # caught up before this turn is saved, so the prompt does not repeat it
+    conversation_history = sessions.store.history(
+        session_id, conversation_id, refresh=True
+    )
+    # saved up front, so the conversation is not empty while the reply is generated and
+    # the prompt survives a failed reply
+    conversations.save_message(user_message)
+    coalescer = StreamCoalescer(emit_frame, on_first_token=start_writing)
+    additional_context = ""
+    failed = False
+    try:
+        additional_context = context.generate(
+            user_message["content"], conversation_id=conversation_id
+        )
+        if additional_context:
+            chat_prompt = "\n\n".join((additional_context, user_message["content"]))
+            assistant_message["context"] = additional_context
+        else:
+            chat_prompt = user_message["content"]
+
+        model_id: str = assistant_message["model_id"]  # type: ignore
+        chat = models.query(
+            model_id,
+            messages=conversation_history.prompt(model_id, chat_prompt),
+            cancellation=cancellation,
+        )
+        coalescer.stream(chat, cancellation)
+    except Cancelled:
+        pass
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        print(f"Could not generate a reply: {error}")
+        failed = True
+    # a stopped reply keeps whatever was generated before the stop
+    assistant_message["content"] = coalescer.response
+    if failed:
+        assistant_message["state"] = "failed"
+    elif cancellation.cancelled:
+        assistant_message["state"] = "cancelled"
+    else:
+        assistant_message["state"] = "complete"
+    tracing.mark("generate")
     emit(
         "message_metadata_response",
         {
@@ -154,10 +220,112 @@ def handle_new_message(data: dict):
         "backend_update",
         {
             "message_id": assistant_message["message_id"],
-            "state": "complete",
+            "state": assistant_message["state"],
         },
     )
-    chat_histories[session_id].append({"role": "assistant", "content": response})
+    conversations.save_message(assistant_message)
+    sessions.store.append(session_id, conversation_id, [user_message, assistant_message])
+    emit_conversations_delta(conversation_id)
+    # a stopped turn is not remembered
+    if assistant_message["state"] != "cancelled":
+        jobs.enqueue(
+            "remember",
+            {
+                "message_id": user_message["message_id"],
+                "content": user_message["content"],
+                "session_id": session_id,
+            },
+            session_id=session_id,
+        )
+    tracing.annotate(state=assistant_message["state"], stream=coalescer.stats.stats())
+
+
+@jobs.handler("remember", priority=jobs.PRIORITY_INTERACTIVE)
+def remember(payloads: list[dict]):
+    for payload in payloads:
+        is_memorable, memory = memories.is_memorable(payload["content"])
+        if not is_memorable:
+            continue
+
+        print("Saving memory: ", memory)
+        conversations.update_message_context(
+            payload["message_id"], f"Memory saved: {memory}"
+        )
+        socketio.emit(
+            "message_metadata_response",
+            {
+                "message_id": payload["message_id"],
+                "context": memory,
+            },
+            to=payload["session_id"],
+        )
+        # last, and keyed by message, so a retry after a failure above cannot save the
+        # memory twice
+        jobs.enqueue(
+            "add_memories",
+            {"memory": memory},
+            session_id=payload["session_id"],
+            coalesce_key=f"add_memories:{payload['message_id']}",
+        )
+
+
+# memories saved in quick succession share one journal write and one index update
+@jobs.handler("add_memories", batch_size=MEMORY_BATCH_SIZE)
+def add_memories(payloads: list[dict]):
+    memories.add_many([payload["memory"] for payload in payloads])
+
+
+@jobs.handler("rebuild_memory_index", priority=jobs.PRIORITY_MAINTENANCE)
+def rebuild_memory_index(_: list[dict]):
+    memories.rebuild_database()
+
+
+@jobs.handler("backfill_search_index", priority=jobs.PRIORITY_MAINTENANCE)
+def backfill_search_index(_: list[dict]):
+    conversations.backfill_search_index()
+
+
+@jobs.handler("clean_conversations", priority=jobs.PRIORITY_MAINTENANCE)
+def clean_conversations(_: list[dict]):
+    conversations.clean_database(keep=sessions.store.active_conversations())
+
+
+@jobs.handler("deduplicate_memories", priority=jobs.PRIORITY_MAINTENANCE)
+def deduplicate_memories(_: list[dict]):
+    memories.deduplicate()
+
+
+@jobs.handler("optimize_databases", priority=jobs.PRIORITY_MAINTENANCE)
+def optimize_databases(_: list[dict]):
+    for database_file in (
+        conversations.DATABASE_FILE,
+        memories.MEMORY_DB_FILE,
+        sessions.SESSION_DB_FILE,
+        jobs.JOBS_DB_FILE,
+        EMBEDDING_CACHE_FILE,
+        DECISION_CACHE_FILE,
+    ):
+        if database_file and os.path.exists(database_file):
+            sql.optimize(database_file)
+    memories.compact_payloads()
+    jobs.prune()
+
+
+jobs.periodic("deduplicate_memories", DEDUPLICATE_EVERY_SECONDS)
+jobs.periodic("optimize_databases", OPTIMIZE_EVERY_SECONDS)
+
+
+def report_job(job: Job):
+    if job["session_id"] is not None:
+        socketio.emit("job_status", job, to=job["session_id"])
+
+
+jobs.on_update(report_job)
+
+
+@socketio.on("request_job_status")
+def handle_request_job_status():
+    emit("job_status_response", jobs.status(session_id=request.sid))  # type: ignore
 
 
 @socketio.on("request_conversations")
@@ -166,6 +334,57 @@ def handle_request_conversations():
     emit("conversations_response", current_conversations)
 
 
+@socketio.on("request_conversations_page")
+def handle_request_conversations_page(data: Optional[dict] = None):
+    data = data or {}
+    page, has_more = conversations.fetch_conversations(
+        before_modified=data.get("before_modified", None),
+        before_conversation_id=data.get("before_conversation_id", None),
+        limit=min(
+            int(data.get("limit", conversations.CONVERSATION_PAGE_SIZE)),
+            conversations.CONVERSATION_PAGE_SIZE,
+        ),
+    )
+    emit("conversations_page_response", {"conversations": page, "has_more": has_more})
+
+
+@socketio.on("request_messages")
+def handle_request_messages(data: dict):
+    conversation_id = int(data["conversation_id"])
+    messages, has_more = conversations.fetch_messages(
+        conversation_id,
+        before=data.get("before", None),
+        limit=min(
+            int(data.get("limit", conversations.MESSAGE_PAGE_SIZE)),
+            conversations.MESSAGE_PAGE_SIZE,
+        ),
+    )
+    emit(
+        "messages_response",
+        {"conversation_id": conversation_id, "messages": messages, "has_more": has_more},
+    )
+
+
+@socketio.on("search_conversations")
+def handle_search_conversations(data: dict):
+    query = str(data.get("query", ""))
+    results, has_more = conversations.search(
+        query,
+        limit=min(
+            int(data.get("limit", conversations.SEARCH_PAGE_SIZE)),
+            conversations.SEARCH_PAGE_SIZE,
+        ),
+        offset=max(int(data.get("offset", 0)), 0),
+    )
+    emit("search_response", {"query": query, "results": results, "has_more": has_more})
+
+
+def emit_conversations_delta(conversation_id: int):
+    conversation = conversations.fetch(conversation_id, message_limit=0)
+    del conversation["has_more_messages"]
+    emit("conversations_delta", [conversation])
+
+
 @socketio.on("request_models")
 def handle_request_models():
     available_models = models.available_models()
@@ -173,25 +392,41 @@ def handle_request_models():
 
 
 @socketio.on("stop")
-def handle_stop():
-    stream_allowed[request.sid] = False  # type: ignore
+def handle_stop(data: Optional[dict] = None):
+    message_id = (data or {}).get("message_id", None)
+    if message_id is None:
+        cancellations.cancel_session(request.sid)  # type: ignore
+    else:
+        cancellations.cancel(message_id)
 
 
 @socketio.on("disconnect")
 def handle_disconnect():
     session_id = request.sid  # type: ignore
-    if session_id in chat_histories:
-        del chat_histories[session_id]
-
-    if session_id in stream_allowed:
-        del stream_allowed[session_id]
+    # nobody is left to read the reply, so stop paying for it
+    cancellations.cancel_session(session_id)
+    sessions.store.drop(session_id)
 
     try:
-        conversations.clean_database()
+        jobs.enqueue("clean_conversations", coalesce_key="clean_conversations")
     except Exception as error:  # pylint: disable=broad-exception-caught
-        print("Could not clean database")
+        print("Could not schedule database cleanup")
         print(error)
 
 
+def is_serving_process() -> bool:
+    # in debug mode werkzeug's reloader re-runs this script in a child that serves
+    # requests; the parent only watches for changes, and if it initialized it would
+    # hold the index and run jobs whose events reach no browser
+    return not DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true"
+
+
+def main():
+    if is_serving_process():
+        initialize()
+    # the development server; scripts/serve-workers runs the app under gunicorn
+    socketio.run(app, host="0.0.0.0", port=PORT, debug=DEBUG)
+
+
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=5001, debug=True)
+    main()
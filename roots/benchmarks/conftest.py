@@ -0,0 +1,49 @@
+import logging
+import os
+
+import pytest
+
+from roots import conversations, memories
+from roots._index import close_index
+
+from . import fakes, synthetic
+
+
+CONVERSATIONS = int(os.getenv("ROOTS_BENCHMARK_CONVERSATIONS", "100"))
+MESSAGES_PER_CONVERSATION = int(os.getenv("ROOTS_BENCHMARK_MESSAGES", "50"))
+MEMORIES = int(os.getenv("ROOTS_BENCHMARK_MEMORIES", "2000"))
+SESSIONS = int(os.getenv("ROOTS_BENCHMARK_SESSIONS", "8"))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def workspace(tmp_path_factory):
+    # every data file path is relative, so running from a scratch directory keeps the
+    # benchmarks away from real conversations and memories
+    directory = tmp_path_factory.mktemp("roots")
+    (directory / "data").mkdir()
+    previous = os.getcwd()
+    os.chdir(directory)
+    # one process needs no follower, and one that woke after the chdir back would open
+    # the real index
+    memories.INDEX_FOLLOW_SECONDS = 0.0
+    fakes.install()
+    for name in ("socketio", "engineio", "werkzeug"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    try:
+        yield directory
+    finally:
+        # flush the index while its relative path still points into the scratch directory
+        close_index(memories.MEMORY_INDEX_FILE)
+        os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+def conversation_ids(workspace) -> list[int]:
+    conversations.initialize_database()
+    return synthetic.populate_conversations(CONVERSATIONS, MESSAGES_PER_CONVERSATION)
+
+
+@pytest.fixture(scope="session")
+def memory_ids(workspace) -> list[int]:
+    memories.initialize_database()
+    return synthetic.populate_memories(MEMORIES)
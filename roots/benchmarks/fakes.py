@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import re
+import time
+from functools import lru_cache
+from typing import AsyncGenerator, Optional
+
+import numpy as np
+from socketio import packet  # type: ignore
+
+from roots import _embedding, models
+from roots._embedding import EMBEDDING_SIZE
+from roots.cancellation import CancellationToken
+from roots.models import ChatMessage, ModelIterResponse, Provider
+
+
+FAKE_EMBEDDING_MODEL = "fake-embedding"
+FAKE_FIRST_TOKEN_SECONDS = 0.05
+FAKE_TOKENS_PER_SECOND = 200.0
+FAKE_RESPONSE_TOKENS = 48
+WORDS = (
+    "the quick brown fox jumps over a lazy dog while the river keeps running past "
+    "old stone bridges and quiet gardens where people talk about books music food "
+    "travel work projects code habits plans weekends friends family and the weather"
+).split()
+
+
+@lru_cache(maxsize=16384)
+def _word_vector(word: str) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(word.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(EMBEDDING_SIZE).astype(np.float32)
+
+
+def fake_embedding(text: str) -> np.ndarray:
+    # a bag of hashed word vectors, so texts that share words land near each other
+    words = re.findall(r"\w+", text.lower()) or [""]
+    vector = np.sum([_word_vector(word) for word in words], axis=0)
+    return vector / np.linalg.norm(vector)
+
+
+class FakeEmbeddingBackend:
+    model = FAKE_EMBEDDING_MODEL
+
+    def __init__(self, latency_seconds: float = 0.0):
+        self.latency_seconds = latency_seconds
+        self.requests = 0
+        self.texts = 0
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        self.requests += 1
+        self.texts += len(texts)
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return [fake_embedding(text).tolist() for text in texts]
+
+
+class FakeProvider(Provider):
+    def __init__(
+        self,
+        name: str,
+        first_token_seconds: float = FAKE_FIRST_TOKEN_SECONDS,
+        tokens_per_second: float = FAKE_TOKENS_PER_SECOND,
+        response_tokens: int = FAKE_RESPONSE_TOKENS,
+        concurrency: int = 64,
+    ):
+        super().__init__(name, concurrency=concurrency, attempts=1)
+        self.first_token_seconds = first_token_seconds
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+
+    # responses are made up in process, with no client to connect
+    def _connect(self):
+        return None
+
+    def _connect_async(self):
+        return None
+
+    def respond(self, messages: list[ChatMessage]) -> list[str]:
+        if messages and messages[0]["content"] == models.DECISION_SYSTEM_PROMPT:
+            prompt = messages[-1]["content"]
+            return ["SPECIFIC" if "'BROAD'" in prompt else "None"]
+        seed = sum(len(message["content"]) for message in messages)
+        return [
+            WORDS[(seed + position) % len(WORDS)] + " "
+            for position in range(self.response_tokens)
+        ]
+
+    def _stream(
+        self,
+        model_id: str,
+        messages: list[ChatMessage],
+        cancellation: Optional[CancellationToken] = None,
+    ) -> ModelIterResponse:
+        time.sleep(self.first_token_seconds)
+        for position, token in enumerate(self.respond(messages)):
+            if position and self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            yield token
+
+    async def _astream(
+        self, model_id: str, messages: list[ChatMessage]
+    ) -> AsyncGenerator[str, None]:
+        await asyncio.sleep(self.first_token_seconds)
+        for position, token in enumerate(self.respond(messages)):
+            if position and self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            yield token
+
+
+def install(
+    embedding_latency_seconds: float = 0.0,
+    first_token_seconds: float = FAKE_FIRST_TOKEN_SECONDS,
+    tokens_per_second: float = FAKE_TOKENS_PER_SECOND,
+    response_tokens: int = FAKE_RESPONSE_TOKENS,
+) -> FakeEmbeddingBackend:
+    backend = FakeEmbeddingBackend(embedding_latency_seconds)
+    _embedding.set_backend(backend)
+    for name in ("openai", "anthropic", "ollama"):
+        models.register_provider(
+            name,
+            FakeProvider(
+                name,
+                first_token_seconds=first_token_seconds,
+                tokens_per_second=tokens_per_second,
+                response_tokens=response_tokens,
+            ),
+        )
+    return backend
+
+
+def acknowledge_frames(socketio) -> None:
+    # the Flask-SocketIO test client never answers server callbacks, so acknowledge
+    # every event as it is sent, as a browser keeping up with the stream would
+    # pylint: disable=protected-access
+    server = socketio.server
+    send_packet = server._send_packet
+
+    def send_and_acknowledge(eio_sid, pkt):
+        send_packet(eio_sid, pkt)
+        if pkt.id is not None and pkt.packet_type == packet.EVENT:
+            server._handle_ack(eio_sid, pkt.namespace, pkt.id, [])
+
+    server._send_packet = send_and_acknowledge
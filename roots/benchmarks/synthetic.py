@@ -0,0 +1,79 @@
+import random
+import uuid
+
+from roots import conversations, memories
+from roots.types import Message
+
+from .fakes import WORDS
+
+
+TOPICS = (
+    "cooking",
+    "running",
+    "python",
+    "gardening",
+    "travel",
+    "guitar",
+    "reading",
+    "finance",
+)
+
+
+def sentence(generator: random.Random, words: int = 16) -> str:
+    topic = generator.choice(TOPICS)
+    body = " ".join(generator.choice(WORDS) for _ in range(words - 1))
+    return f"{topic} {body}"
+
+
+def message(
+    conversation_id: int, role: str, content: str, exchange_id: str = ""
+) -> Message:
+    return {
+        "message_id": uuid.uuid4().hex,
+        "exchange_id": exchange_id or uuid.uuid4().hex,
+        "conversation_id": conversation_id,
+        "role": role,  # type: ignore
+        "content": content,
+        "context": None,
+        "model_id": "mistral" if role == "assistant" else None,
+        "created_at_utc": None,
+    }
+
+
+def populate_conversations(
+    count: int,
+    messages_per_conversation: int,
+    seed: int = 0,
+    database_file: str = conversations.DATABASE_FILE,
+) -> list[int]:
+    generator = random.Random(seed)
+    conversation_ids = []
+    for number in range(count):
+        conversation = conversations.create(
+            f"benchmark/{seed}/{number}", database_file=database_file
+        )
+        conversation_id = conversation["conversation_id"]
+        batch: list[Message] = []
+        for turn in range(messages_per_conversation):
+            user_turn = turn % 2 == 0
+            exchange_id = uuid.uuid4().hex if user_turn else batch[-1]["exchange_id"]
+            batch.append(
+                message(
+                    conversation_id,
+                    "user" if user_turn else "assistant",
+                    sentence(generator),
+                    exchange_id,
+                )
+            )
+        conversations.save_messages(batch, database_file=database_file)
+        conversation_ids.append(conversation_id)
+    return conversation_ids
+
+
+def populate_memories(count: int, seed: int = 0, batch_size: int = 500) -> list[int]:
+    generator = random.Random(seed)
+    texts = [f"{sentence(generator, words=10)} {number}" for number in range(count)]
+    memory_ids: list[int] = []
+    for start in range(0, count, batch_size):
+        memory_ids += memories.add_many(texts[start : start + batch_size])
+    return memory_ids
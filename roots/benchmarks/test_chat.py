@@ -0,0 +1,91 @@
+import random
+import threading
+import uuid
+
+import pytest
+
+import app
+from roots import conversations, jobs, memories
+
+from . import fakes, synthetic
+from .conftest import SESSIONS
+
+
+@pytest.fixture(scope="module")
+def clients(memory_ids):
+    conversations.initialize_database()
+    memories.initialize_database()
+    jobs.initialize_database()
+    sessions = []
+    for _ in range(SESSIONS):
+        session = app.socketio.test_client(app.app)
+        session.emit("request_conversation", {"conversation_name": uuid.uuid4().hex})
+        conversation = next(
+            event["args"][0]
+            for event in session.get_received()
+            if event["name"] == "conversation_response"
+        )
+        sessions.append((session, conversation["conversation_id"]))
+    fakes.acknowledge_frames(app.socketio)
+    yield sessions
+    for session, _ in sessions:
+        session.disconnect()
+
+
+def send_message(session, conversation_id: int, content: str) -> list[dict]:
+    exchange_id = uuid.uuid4().hex
+    user_message = synthetic.message(conversation_id, "user", content, exchange_id)
+    assistant_message = synthetic.message(conversation_id, "assistant", "", exchange_id)
+    session.emit(
+        "new_message",
+        {"user_message": user_message, "assistant_message": assistant_message},
+    )
+    return session.get_received()
+
+
+def test_new_message(benchmark, clients):
+    session, conversation_id = clients[0]
+    generator = random.Random(0)
+    events = benchmark.pedantic(
+        lambda: send_message(session, conversation_id, synthetic.sentence(generator)),
+        rounds=10,
+        iterations=1,
+    )
+    assert any(event["name"] == "message_stream_response" for event in events)
+
+
+def test_new_message_concurrent_sessions(benchmark, clients):
+    generator = random.Random(0)
+    prompts = [synthetic.sentence(generator) for _ in clients]
+
+    def converse() -> list[list[dict]]:
+        received: list[list[dict]] = [[] for _ in clients]
+
+        def converse_in(position: int, session, conversation_id: int, prompt: str):
+            received[position] = send_message(session, conversation_id, prompt)
+
+        threads = [
+            threading.Thread(
+                target=converse_in, args=(position, session, conversation_id, prompt)
+            )
+            for position, ((session, conversation_id), prompt) in enumerate(
+                zip(clients, prompts)
+            )
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return received
+
+    received = benchmark.pedantic(converse, rounds=5, iterations=1)
+    benchmark.extra_info["sessions"] = len(clients)
+    # every session got its own reply streamed back and finished
+    for events in received:
+        states = [
+            event["args"][0]["state"]
+            for event in events
+            if event["name"] == "backend_update"
+        ]
+        assert any(event["name"] == "message_stream_response" for event in events)
+        assert states[-1] == "complete"
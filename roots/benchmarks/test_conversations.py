@@ -0,0 +1,39 @@
+import itertools
+import random
+
+from roots import conversations
+
+from . import synthetic
+
+
+def test_fetch(benchmark, conversation_ids):
+    generator = random.Random(0)
+    benchmark(
+        lambda: conversations.fetch(
+            generator.choice(conversation_ids),
+            message_limit=conversations.MESSAGE_PAGE_SIZE,
+        )
+    )
+
+
+def test_fetch_all_messages(benchmark, conversation_ids):
+    generator = random.Random(0)
+    benchmark(lambda: conversations.fetch(generator.choice(conversation_ids)))
+
+
+def test_save_message(benchmark, conversation_ids):
+    generator = random.Random(0)
+    turns = itertools.count()
+
+    def save():
+        conversation_id = conversation_ids[next(turns) % len(conversation_ids)]
+        conversations.save_message(
+            synthetic.message(conversation_id, "user", synthetic.sentence(generator))
+        )
+
+    benchmark(save)
+
+
+def test_search(benchmark, conversation_ids):
+    generator = random.Random(0)
+    benchmark(lambda: conversations.search(generator.choice(synthetic.TOPICS)))
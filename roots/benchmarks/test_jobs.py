@@ -0,0 +1,32 @@
+import random
+
+import app  # registers the job handlers
+from roots import jobs, memories
+from roots.sql import client
+
+from . import synthetic
+
+
+JOBS = 256
+
+
+def test_add_memories_coalesced(benchmark, memory_ids):
+    jobs.initialize_database()
+    # whatever earlier benchmarks left queued, such as memories from chat turns
+    jobs.run_pending()
+    generator = random.Random(0)
+
+    def enqueue():
+        for _ in range(JOBS):
+            jobs.enqueue("add_memories", {"memory": synthetic.sentence(generator)})
+
+    # one round enqueues a burst of memories, as a busy chat would, and drains it
+    ran = benchmark.pedantic(jobs.run_pending, setup=enqueue, rounds=5, iterations=1)
+    assert ran == JOBS
+    assert jobs.stats()["queued"] == 0
+
+    # leave the shared memories as the other benchmarks expect them
+    with client(memories.MEMORY_DB_FILE) as cursor:
+        cursor.execute("SELECT memory_id FROM memories")
+        added = {row["memory_id"] for row in cursor.fetchall()} - set(memory_ids)
+    memories.remove_many(sorted(added))
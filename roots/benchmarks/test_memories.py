@@ -0,0 +1,28 @@
+import random
+
+from roots import memories
+
+from . import synthetic
+
+
+def test_fetch_relevant_memories(benchmark, memory_ids):
+    generator = random.Random(0)
+    benchmark(lambda: memories.fetch_relevant_memories(synthetic.sentence(generator)))
+
+
+def test_fetch_broad_memories(benchmark, memory_ids):
+    generator = random.Random(0)
+    benchmark(
+        lambda: memories.fetch_relevant_memories(
+            synthetic.sentence(generator), broad_search=True
+        )
+    )
+
+
+def test_rebuild_database(benchmark, memory_ids):
+    # embeddings come from the cache after the first build, so this measures training,
+    # indexing and the database scan
+    result = benchmark.pedantic(
+        memories.rebuild_database, kwargs={"resume": False}, rounds=3, iterations=1
+    )
+    assert result == len(memory_ids)
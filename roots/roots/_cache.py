@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+
+Value = TypeVar("Value")
+
+
+class LRUCache(Generic[Value]):
+    def __init__(
+        self,
+        max_size: int,
+        max_weight: Optional[int] = None,
+        weigher: Optional[Callable[[Value], int]] = None,
+        ttl_seconds: Optional[float] = None,
+        refresh_on_get: bool = True,
+    ):
+        self.max_size = max_size
+        self.max_weight = max_weight
+        self.weigher = weigher
+        # entries expire this long after they were written, or last read as well
+        # when refresh_on_get is set
+        self.ttl_seconds = ttl_seconds
+        self.refresh_on_get = refresh_on_get
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.weight = 0
+        self._entries: OrderedDict[Hashable, tuple[Value, int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Value]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            value, weight, touched_at = entry
+            if self.refresh_on_get:
+                touched_at = time.monotonic()
+            self._entries[key] = (value, weight, touched_at)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Value) -> None:
+        weight = self.weigher(value) if self.weigher else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, weight, time.monotonic())
+            self.weight += weight
+            self._evict()
+
+    def pop(self, key: Hashable) -> Optional[Value]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            return self._remove(key)
+
+    def keys(self) -> list[Hashable]:
+        with self._lock:
+            return list(self._entries)
+
+    def expire(self) -> int:
+        with self._lock:
+            return self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def _expired(self, entry: tuple[Value, int, float]) -> bool:
+        return (
+            self.ttl_seconds is not None
+            and time.monotonic() - entry[2] > self.ttl_seconds
+        )
+
+    def _remove(self, key: Hashable) -> Value:
+        value, weight, _ = self._entries.pop(key)
+        self.weight -= weight
+        return value
+
+    def _evict(self) -> int:
+        evicted = 0
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            over_weight = self.max_weight is not None and self.weight > self.max_weight
+            # the newest entry stays even when it alone is over the weight cap
+            if not (
+                len(self._entries) > self.max_size
+                or (over_weight and len(self._entries) > 1)
+                or self._expired(entry)
+            ):
+                break
+            self._remove(key)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self),
+            "weight": self.weight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
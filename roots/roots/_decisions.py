@@ -0,0 +1,123 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Optional
+
+from ._cache import LRUCache
+from .sql import client
+
+
+DECISION_CACHE_FILE = os.getenv("ROOTS_DECISION_CACHE", "data/decision_cache.db")
+DECISION_CACHE_SIZE = 2048
+DECISION_CACHE_TTL_SECONDS = float(os.getenv("ROOTS_DECISION_CACHE_TTL", "86400"))
+
+
+class DecisionCache:
+    def __init__(
+        self,
+        database_file: Optional[str] = DECISION_CACHE_FILE,
+        max_size: int = DECISION_CACHE_SIZE,
+        ttl_seconds: float = DECISION_CACHE_TTL_SECONDS,
+    ):
+        # an empty database_file keeps the cache in memory only
+        self.database_file = database_file or None
+        self.ttl_seconds = ttl_seconds
+        self.memory: LRUCache[tuple[str, float]] = LRUCache(
+            max_size, ttl_seconds=ttl_seconds, refresh_on_get=False
+        )
+        self.disk_hits = 0
+        self.misses = 0
+        self.skips = 0
+        self.saved_seconds = 0.0
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, system_prompt: str, prompt: str) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return hashlib.sha256(
+            "\0".join((model, system_prompt, prompt_hash)).encode("utf-8")
+        ).hexdigest()
+
+    def _initialize(self) -> None:
+        if self._initialized or self.database_file is None:
+            return
+        with client(self.database_file) as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS decisions (
+                    decision_key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    latency_seconds REAL NOT NULL,
+                    created_at_utc REAL NOT NULL
+                )
+                """
+            )
+            cursor.execute(
+                "DELETE FROM decisions WHERE created_at_utc < ?",
+                (time.time() - self.ttl_seconds,),
+            )
+        self._initialized = True
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.memory.get(key)
+        if entry is None and self.database_file is not None:
+            self._initialize()
+            with client(self.database_file) as cursor:
+                cursor.execute(
+                    """
+                    SELECT response, latency_seconds
+                    FROM decisions
+                    WHERE decision_key = ? AND created_at_utc >= ?
+                    """,
+                    (key, time.time() - self.ttl_seconds),
+                )
+                record = cursor.fetchone()
+            if record is not None:
+                entry = (record["response"], record["latency_seconds"])
+                self.memory.put(key, entry)
+                with self._lock:
+                    self.disk_hits += 1
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.saved_seconds += entry[1]
+        return entry[0]
+
+    def put(self, key: str, response: str, latency_seconds: float) -> None:
+        self.memory.put(key, (response, latency_seconds))
+        if self.database_file is None:
+            return
+        self._initialize()
+        with client(self.database_file) as cursor:
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO decisions
+                (decision_key, response, latency_seconds, created_at_utc)
+                VALUES (?, ?, ?, ?)
+                """,
+                (key, response, latency_seconds, time.time()),
+            )
+
+    def skip(self) -> None:
+        with self._lock:
+            self.skips += 1
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            hits = self.memory.hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "skips": self.skips,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+            }
+
+
+decision_cache = DecisionCache()
@@ -1,22 +1,284 @@
-import faiss  # type: ignore
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Protocol
+
 import numpy as np
-import ollama
+
+from . import tracing
+from ._cache import LRUCache
+from ._lazy import lazy_import
+from .cancellation import raise_if_cancelled
+from .sql import client
+
+faiss = lazy_import("faiss")
+ollama = lazy_import("ollama")
 
 
 EMBEDDING_MODEL = "nomic-embed-text"
 EMBEDDING_SIZE = 768
+EMBEDDING_CACHE_FILE = "data/embedding_cache.db"
+EMBEDDING_CACHE_SIZE = 4096
+EMBEDDING_BATCH_SIZE = 32
+EMBEDDING_CONCURRENCY = 4
+INDEX_SPEC = os.getenv("ROOTS_INDEX_SPEC", "HNSW32,Flat")
+FALLBACK_INDEX_SPEC = "Flat"
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+TRAINING_SAMPLE_SIZE = 50_000
+
+
+# the configured model does not produce EMBEDDING_SIZE dimensions, so nothing it returns
+# can be searched against the index
+class EmbeddingSizeError(ValueError):
+    pass
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        database_file: str = EMBEDDING_CACHE_FILE,
+        max_size: int = EMBEDDING_CACHE_SIZE,
+    ):
+        self.database_file = database_file
+        self.memory: LRUCache[np.ndarray] = LRUCache(max_size)
+        self.disk_hits = 0
+        self.misses = 0
+        self._initialized_for: Optional[tuple[str, int]] = None
+
+    def _initialize(self, model: str, size: int) -> None:
+        if self._initialized_for == (model, size):
+            return
+        with client(self.database_file) as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                )
+                """
+            )
+            cursor.execute(
+                "DELETE FROM embeddings WHERE model != ? OR size != ?", (model, size)
+            )
+        self.memory.clear()
+        self._initialized_for = (model, size)
+
+    def get(self, model: str, size: int, text_hash: str) -> Optional[np.ndarray]:
+        self._initialize(model, size)
+        vector = self.memory.get((model, size, text_hash))
+        if vector is not None:
+            return vector
+
+        with client(self.database_file) as cursor:
+            cursor.execute(
+                """
+                SELECT vector
+                FROM embeddings
+                WHERE model = ? AND text_hash = ? AND size = ?
+                """,
+                (model, text_hash, size),
+            )
+            record = cursor.fetchone()
+        if record is None:
+            self.misses += 1
+            return None
+
+        self.disk_hits += 1
+        vector = np.frombuffer(record["vector"], dtype=np.float32)
+        self.memory.put((model, size, text_hash), vector)
+        return vector
+
+    def put(self, model: str, size: int, text_hash: str, vector: np.ndarray) -> None:
+        self._initialize(model, size)
+        vector = np.ascontiguousarray(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        self.memory.put((model, size, text_hash), vector)
+        with client(self.database_file) as cursor:
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO embeddings (model, text_hash, size, vector)
+                VALUES (?, ?, ?, ?)
+                """,
+                (model, text_hash, size, vector.tobytes()),
+            )
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "memory_hits": self.memory.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_size": len(self.memory),
+        }
+
+
+embedding_cache = EmbeddingCache()
+
+
+class EmbeddingBackend(Protocol):
+    model: str
+
+    def embed(self, texts: list[str]) -> list[list[float]]: ...
+
+
+class OllamaEmbeddingBackend:
+    model = EMBEDDING_MODEL
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        return ollama.embed(model=self.model, input=texts)["embeddings"]
+
+
+backend: EmbeddingBackend = OllamaEmbeddingBackend()
+
+
+def set_backend(new_backend: EmbeddingBackend) -> None:
+    global backend  # pylint: disable=global-statement
+    backend = new_backend
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
 def embed(text):
-    print(text)
+    text_hash = hash_text(text)
+    cached = embedding_cache.get(backend.model, EMBEDDING_SIZE, text_hash)
+    if cached is not None:
+        return cached
+
+    raise_if_cancelled()
     try:
-        response = ollama.embeddings(model=EMBEDDING_MODEL, prompt=text)
-        print(response)
-        return np.array(response["embedding"], dtype=np.float32)
+        with tracing.span("embed_request"):
+            embedding = np.array(backend.embed([text])[0], dtype=np.float32)
     except Exception as error:
         print(f"Error generating embedding: {error}")
         return None
 
+    _check_size(embedding)
+    embedding_cache.put(backend.model, EMBEDDING_SIZE, text_hash, embedding)
+    return embedding
+
+
+def _check_size(embedding: np.ndarray) -> None:
+    if embedding.shape != (EMBEDDING_SIZE,):
+        raise EmbeddingSizeError(
+            f"{backend.model} returned an embedding of shape {embedding.shape}, but "
+            f"the memory index expects {EMBEDDING_SIZE} dimensions"
+        )
+
+
+def _embed_batch(texts: list[str]) -> list[Optional[np.ndarray]]:
+    try:
+        embeddings = backend.embed(texts)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        print(f"Error generating {len(texts)} embeddings: {error}")
+        return [_embed_or_none(text) for text in texts]
+    return [np.array(embedding, dtype=np.float32) for embedding in embeddings]
+
+
+def _embed_or_none(text: str) -> Optional[np.ndarray]:
+    try:
+        return embed(text)
+    except EmbeddingSizeError as error:
+        print(f"Could not embed text: {error}")
+        return None
+
+
+def embed_many(
+    texts: list[str],
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    concurrency: int = EMBEDDING_CONCURRENCY,
+) -> list[Optional[np.ndarray]]:
+    embeddings: list[Optional[np.ndarray]] = [None] * len(texts)
+    text_hashes = [hash_text(text) for text in texts]
+    missing: list[int] = []
+    for position, text_hash in enumerate(text_hashes):
+        cached = embedding_cache.get(backend.model, EMBEDDING_SIZE, text_hash)
+        if cached is None:
+            missing.append(position)
+        else:
+            embeddings[position] = cached
+
+    batches = [missing[i : i + batch_size] for i in range(0, len(missing), batch_size)]
+    if not batches:
+        return embeddings
+
+    raise_if_cancelled()
+    with (
+        tracing.span("embed_request"),
+        ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(batches)))) as pool,
+    ):
+        results = pool.map(
+            lambda batch: _embed_batch([texts[position] for position in batch]), batches
+        )
+        for batch, batch_embeddings in zip(batches, results):
+            for position, embedding in zip(batch, batch_embeddings):
+                if embedding is None:
+                    continue
+                try:
+                    _check_size(embedding)
+                except EmbeddingSizeError as error:
+                    # left as None, like any text the backend could not embed
+                    print(f"Could not embed text: {error}")
+                    continue
+                embedding_cache.put(
+                    backend.model, EMBEDDING_SIZE, text_hashes[position], embedding
+                )
+                embeddings[position] = embedding
+    return embeddings
+
+
+def construct_index(spec: str = INDEX_SPEC):
+    index = faiss.index_factory(EMBEDDING_SIZE, spec)
+    base = faiss.downcast_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    return index
+
+
+def train_index(index, sample: np.ndarray):
+    if index.is_trained:
+        return index
+    if not len(sample):
+        print(f"No vectors to train {INDEX_SPEC}; using {FALLBACK_INDEX_SPEC} for now.")
+        return construct_index(FALLBACK_INDEX_SPEC)
+    try:
+        index.train(np.asarray(sample, dtype=np.float32))
+        return index
+    except RuntimeError as error:
+        print(
+            f"Could not train {INDEX_SPEC} on {len(sample):,} vectors ({error}); "
+            f"using {FALLBACK_INDEX_SPEC} until the next rebuild."
+        )
+        return construct_index(FALLBACK_INDEX_SPEC)
+
+
+def search_parameters(
+    index,
+    k: int,
+    ef_search: Optional[int] = None,
+    nprobe: Optional[int] = None,
+    exclude_ids: Optional[set[int]] = None,
+):
+    base = index.index if isinstance(index, faiss.IndexIDMap) else index
+    base = faiss.downcast_index(base)
+    if isinstance(base, faiss.IndexHNSW):
+        parameters = faiss.SearchParametersHNSW()
+        parameters.efSearch = max(ef_search or HNSW_EF_SEARCH, k)
+    elif faiss.try_extract_index_ivf(base) is not None:
+        parameters = faiss.SearchParametersIVF()
+        parameters.nprobe = nprobe or IVF_NPROBE
+    else:
+        parameters = faiss.SearchParameters()
 
-def construct_index():
-    return faiss.IndexHNSWFlat(EMBEDDING_SIZE, 32)
+    if exclude_ids:
+        excluded = faiss.IDSelectorBatch(np.fromiter(exclude_ids, dtype=np.int64))
+        selector = faiss.IDSelectorNot(excluded)
+        parameters.sel = selector
+        # swig does not keep the selectors alive on its own
+        parameters.referenced_objects = [excluded, selector]
+    return parameters
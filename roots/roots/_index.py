@@ -0,0 +1,384 @@
+import atexit
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+from . import tracing
+from ._embedding import FALLBACK_INDEX_SPEC, construct_index, search_parameters
+from ._lazy import lazy_import
+
+faiss = lazy_import("faiss")
+
+
+FLUSH_AFTER_WRITES = 64
+FLUSH_AFTER_SECONDS = 30.0
+
+
+class ReadWriteLock:
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writing or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class MemoryIndex:
+    def __init__(
+        self,
+        path: str,
+        flush_after_writes: int = FLUSH_AFTER_WRITES,
+        flush_after_seconds: float = FLUSH_AFTER_SECONDS,
+    ):
+        self.path = path
+        self.flush_after_writes = flush_after_writes
+        self.flush_after_seconds = flush_after_seconds
+        self._lock = ReadWriteLock()
+        self._flush_lock = threading.Lock()
+        self._index = None
+        self._removed: set[int] = set()
+        self.removed_path = f"{path}.removed"
+        self.generation_path = f"{path}.generation"
+        self.lock_path = f"{path}.lock"
+        self.readers_path = f"{path}.readers"
+        self.generation = 0
+        self.persisted_generation = 0
+        # one process writes each index file; the others map the flushed file
+        # read-only and reload it whenever the writer publishes a new generation
+        self._lock_file: Optional[int] = None
+        self._readers_file: Optional[int] = None
+        self.writer = self._claim_writer()
+        if not self.writer:
+            self._readers_file = _open_locked(self.readers_path, fcntl.LOCK_SH)
+        self._published: Optional[int] = None
+        self._dirty = 0
+        self._last_flush = time.monotonic()
+        self._wake = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name=f"index-flusher:{path}", daemon=True
+        )
+        self._flusher.start()
+
+    def _claim_writer(self) -> bool:
+        self._lock_file = _open_locked(self.lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return self._lock_file is not None
+
+    def _release_locks(self) -> None:
+        for lock_file in (self._lock_file, self._readers_file):
+            if lock_file is not None:
+                os.close(lock_file)
+        self._lock_file = self._readers_file = None
+
+    def has_readers(self) -> bool:
+        # readers share a lock on their own file, so it is only free without them
+        lock_file = _open_locked(self.readers_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if lock_file is None:
+            return True
+        os.close(lock_file)
+        return False
+
+    def _load(self):
+        # read before the index, so a flush in between only makes the next refresh
+        # load the index again
+        self._published = _modified_at(self.generation_path)
+        if os.path.exists(self.generation_path):
+            with open(self.generation_path, encoding="utf-8") as file:
+                self.generation = self.persisted_generation = int(file.read() or 0)
+        if os.path.exists(self.path) and not self.writer:
+            index = faiss.read_index(
+                self.path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+            )
+        elif os.path.exists(self.path):
+            index = faiss.read_index(self.path)
+        else:
+            index = construct_index()
+            if not index.is_trained:
+                index = construct_index(FALLBACK_INDEX_SPEC)
+        if not isinstance(index, faiss.IndexIDMap):
+            index = faiss.IndexIDMap2(index)
+        if os.path.exists(self.removed_path):
+            self._removed = set(np.fromfile(self.removed_path, dtype=np.int64).tolist())
+        return index
+
+    def refresh(self) -> bool:
+        if self.writer:
+            return False
+        if self._claim_writer():
+            # the writer exited; reopen the file writable and take over
+            with self._lock.write():
+                self.writer = True
+                self._index = None
+            if self._readers_file is not None:
+                os.close(self._readers_file)
+                self._readers_file = None
+            return True
+        if self._index is None or _modified_at(self.generation_path) == self._published:
+            return False
+        with self._lock.write():
+            self._index = self._load()
+        return True
+
+    def _check_writer(self) -> None:
+        if not self.writer:
+            raise RuntimeError(f"{self.path} is written by another process")
+
+    def _loaded(self):
+        if self._index is None:
+            with self._lock.write():
+                if self._index is None:
+                    self._index = self._load()
+        return self._index
+
+    @property
+    def ntotal(self) -> int:
+        index = self._loaded()
+        with self._lock.read():
+            return index.ntotal
+
+    @property
+    def is_trained(self) -> bool:
+        return self._loaded().is_trained
+
+    def add(self, embeddings: np.ndarray, ids: np.ndarray) -> None:
+        self._check_writer()
+        index = self._loaded()
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock.write():
+            index.add_with_ids(  # pylint: disable=no-value-for-parameter
+                np.asarray(embeddings, dtype=np.float32), ids
+            )
+            self._removed.difference_update(ids.tolist())
+            self._dirty += len(ids)
+        if self._dirty >= self.flush_after_writes:
+            self._wake.set()
+
+    def contains(self, ids: list[int]) -> set[int]:
+        index = self._loaded()
+        with self._lock.read():
+            if not isinstance(index, faiss.IndexIDMap2):
+                stored = set(faiss.vector_to_array(index.id_map).tolist())
+                return {memory_id for memory_id in ids if memory_id in stored}
+            found = set()
+            for memory_id in ids:
+                try:
+                    index.reconstruct(int(memory_id))
+                    found.add(memory_id)
+                except RuntimeError:
+                    pass
+            return found
+
+    def set_generation(self, generation: int) -> None:
+        self._check_writer()
+        self._loaded()
+        with self._lock.write():
+            if generation != self.generation:
+                self.generation = generation
+                self._dirty += 1
+
+    def remove(self, ids: list[int]) -> None:
+        self._check_writer()
+        index = self._loaded()
+        with self._lock.write():
+            try:
+                index.remove_ids(np.asarray(ids, dtype=np.int64))
+            except RuntimeError:
+                # graph indexes such as HNSW cannot delete; hide the ids until a rebuild
+                self._removed.update(ids)
+            self._dirty += len(ids)
+        if self._dirty >= self.flush_after_writes:
+            self._wake.set()
+
+    def search(
+        self,
+        embeddings: np.ndarray,
+        k: int,
+        ef_search: Optional[int] = None,
+        nprobe: Optional[int] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        index = self._loaded()
+        with tracing.span("ann_search"), self._lock.read():
+            parameters = search_parameters(
+                index, k, ef_search=ef_search, nprobe=nprobe, exclude_ids=self._removed
+            )
+            return index.search(
+                np.asarray(embeddings, dtype=np.float32), k, params=parameters
+            )
+
+    def reconstruct(self, ids: list[int]) -> Optional[np.ndarray]:
+        index = self._loaded()
+        if not isinstance(index, faiss.IndexIDMap2):
+            return None
+        with self._lock.read():
+            return np.vstack([index.reconstruct(int(memory_id)) for memory_id in ids])
+
+    def replace(self, index, generation: Optional[int] = None) -> None:
+        self._check_writer()
+        if not isinstance(index, faiss.IndexIDMap):
+            index = faiss.IndexIDMap2(index)
+        with self._lock.write():
+            self._index = index
+            self._removed = set()
+            if generation is not None:
+                self.generation = generation
+            self._dirty += 1
+        self._wake.set()
+
+    def flush(self, force: bool = False) -> bool:
+        with self._flush_lock:
+            if self._index is None or not self._dirty or not self.writer:
+                return False
+            due = time.monotonic() - self._last_flush >= self.flush_after_seconds
+            if not (force or due or self._dirty >= self.flush_after_writes):
+                return False
+
+            with self._lock.read():
+                data = faiss.serialize_index(self._index)
+                removed = np.array(sorted(self._removed), dtype=np.int64)
+                generation = self.generation
+                flushed = self._dirty
+
+            # the generation goes last: replaying journal entries the index already
+            # holds is harmless, skipping ones it lacks is not
+            write_atomic(self.removed_path, removed)
+            write_atomic(self.path, data)
+            write_atomic(self.generation_path, str(generation).encode("utf-8"))
+            with self._lock.write():
+                self._dirty -= flushed
+                self.persisted_generation = generation
+            self._last_flush = time.monotonic()
+            return True
+
+    def close(self, flush: bool = True) -> None:
+        self._closed = True
+        self._wake.set()
+        try:
+            if flush:
+                self.flush(force=True)
+        finally:
+            self._release_locks()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(timeout=self.flush_after_seconds)
+            self._wake.clear()
+            if self._closed:
+                return
+            try:
+                self.flush()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                print(f"Could not flush memory index {self.path}: {error}")
+
+
+def _open_locked(path: str, operation: int) -> Optional[int]:
+    lock_file = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_file, operation)
+    except BlockingIOError:
+        os.close(lock_file)
+        return None
+    return lock_file
+
+
+def _modified_at(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def write_atomic(path: str, data: bytes | np.ndarray) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(data.tobytes() if isinstance(data, np.ndarray) else data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+_indexes: dict[str, MemoryIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(path: str) -> MemoryIndex:
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = MemoryIndex(path)
+        return _indexes[path]
+
+
+def close_index(path: str, flush: bool = True) -> None:
+    with _indexes_lock:
+        index = _indexes.pop(path, None)
+    if index is not None:
+        index.close(flush=flush)
+
+
+_inherited: list[MemoryIndex] = []
+
+
+def _forget_inherited_indexes() -> None:
+    global _indexes_lock  # pylint: disable=global-statement
+    # a forked worker gets copies of the parent's indexes but none of their threads;
+    # it opens its own, while the copies stay referenced so nothing they hold is closed
+    # behind the parent's back, except the file locks, which only the parent may keep
+    _indexes_lock = threading.Lock()
+    for index in _indexes.values():
+        index._release_locks()  # pylint: disable=protected-access
+        _inherited.append(index)
+    _indexes.clear()
+
+
+os.register_at_fork(after_in_child=_forget_inherited_indexes)
+
+
+@atexit.register
+def close_all() -> None:
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+        _indexes.clear()
+    for index in indexes:
+        try:
+            index.close()
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            print(f"Could not flush memory index {index.path}: {error}")
@@ -0,0 +1,206 @@
+import mmap
+import os
+import threading
+from typing import Iterable, Optional
+
+import numpy as np
+
+from ._index import write_atomic
+
+
+RECORD = np.dtype([("memory_id", "<i8"), ("offset", "<i8"), ("length", "<i8")])
+# a compacted table starts with this id, its offset naming the blob it points into
+HEADER_ID = -1
+COMPACT_MIN_GARBAGE = 0.5
+
+
+# memory texts packed into one memory-mapped blob, located through an append-only
+# (memory_id, offset, length) table where the latest record for an id wins
+class PayloadStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.table_path = f"{path}.idx"
+        self.epoch = 0
+        self._lock = threading.Lock()
+        self._offsets: Optional[dict[int, tuple[int, int]]] = None
+        self._records = 0
+        self._map: Optional[mmap.mmap] = None
+        self._mapped_size = 0
+
+    @property
+    def blob_path(self) -> str:
+        return self._blob_path(self.epoch)
+
+    def _blob_path(self, epoch: int) -> str:
+        return f"{self.path}.bin" if not epoch else f"{self.path}.{epoch}.bin"
+
+    def _load(self) -> dict[int, tuple[int, int]]:
+        if self._offsets is not None:
+            return self._offsets
+
+        offsets: dict[int, tuple[int, int]] = {}
+        epoch, records = 0, []
+        if os.path.exists(self.table_path):
+            # a partial record at the end is either torn by a crash or still being
+            # appended by the writer; it is read again on the next load once complete
+            count = os.path.getsize(self.table_path) // RECORD.itemsize
+            records = np.fromfile(self.table_path, dtype=RECORD, count=count).tolist()
+            if records and records[0][0] == HEADER_ID:
+                epoch, records = records[0][1], records[1:]
+            blob_path = self._blob_path(epoch)
+            # a compacted table always has its blob, unless it has been compacted again
+            # since it was read, which the caller recovers from by loading anew
+            blob_size = (
+                os.path.getsize(blob_path) if epoch or os.path.exists(blob_path) else 0
+            )
+            for memory_id, offset, length in records:
+                if length < 0:
+                    offsets.pop(memory_id, None)
+                elif offset + length <= blob_size:
+                    offsets[memory_id] = (offset, length)
+        self.epoch = epoch
+        self._records = len(records)
+        self._offsets = offsets
+        return offsets
+
+    def _remap(self, size: int) -> None:
+        if size <= self._mapped_size:
+            return
+        if self._map is not None:
+            self._map.close()
+        with open(self.blob_path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped_size = len(self._map)
+
+    def get_many(self, memory_ids: Iterable[int]) -> dict[int, str]:
+        memory_ids = list(memory_ids)
+        try:
+            return self._get_many(memory_ids)
+        except FileNotFoundError:
+            # compacted since this process loaded the table; the new one names the blob
+            self.close()
+            return self._get_many(memory_ids)
+
+    def _get_many(self, memory_ids: list[int]) -> dict[int, str]:
+        with self._lock:
+            offsets = self._load()
+            found = {
+                memory_id: offsets[memory_id]
+                for memory_id in memory_ids
+                if memory_id in offsets
+            }
+            if not found:
+                return {}
+            self._remap(max(offset + length for offset, length in found.values()))
+            if self._map is None:
+                return {memory_id: "" for memory_id in found}
+            return {
+                memory_id: self._map[offset : offset + length].decode("utf-8")
+                for memory_id, (offset, length) in found.items()
+            }
+
+    def put_many(self, memories: Iterable[tuple[int, str]]) -> None:
+        with self._lock:
+            offsets = self._load()
+            records = []
+            with open(self.blob_path, "ab") as blob:
+                offset = blob.tell()
+                for memory_id, text in memories:
+                    data = text.encode("utf-8")
+                    blob.write(data)
+                    records.append((memory_id, offset, len(data)))
+                    offset += len(data)
+                blob.flush()
+                os.fsync(blob.fileno())
+            self._append_records(records)
+            for memory_id, offset, length in records:
+                offsets[memory_id] = (offset, length)
+            self._records += len(records)
+
+    def remove_many(self, memory_ids: Iterable[int]) -> None:
+        with self._lock:
+            offsets = self._load()
+            records = [(memory_id, 0, -1) for memory_id in memory_ids]
+            self._append_records(records)
+            for memory_id, _, _ in records:
+                offsets.pop(memory_id, None)
+            self._records += len(records)
+
+    def _append_records(self, records: list[tuple[int, int, int]]) -> None:
+        # only the writing process appends, so only it may cut off a torn record
+        if os.path.exists(self.table_path):
+            table_size = os.path.getsize(self.table_path)
+            if table_size % RECORD.itemsize:
+                os.truncate(self.table_path, table_size - table_size % RECORD.itemsize)
+        with open(self.table_path, "ab") as table:
+            table.write(np.array(records, dtype=RECORD).tobytes())
+            table.flush()
+            os.fsync(table.fileno())
+
+    def compact(self, min_garbage: float = COMPACT_MIN_GARBAGE) -> bool:
+        # the blob keeps every text ever written and the table every record, so once
+        # enough of either is superseded both are rewritten with only live memories.
+        # The new blob gets a name of its own and the table, replaced in one step, says
+        # which blob it indexes, so readers see either the old pair or the new one
+        with self._lock:
+            offsets = self._load()
+            blob_size = (
+                os.path.getsize(self.blob_path) if os.path.exists(self.blob_path) else 0
+            )
+            live_bytes = sum(length for _, length in offsets.values())
+            garbage = max(
+                1.0 - live_bytes / blob_size if blob_size else 0.0,
+                1.0 - len(offsets) / self._records if self._records else 0.0,
+            )
+            if garbage < min_garbage:
+                return False
+
+            old_blob_path, epoch = self.blob_path, self.epoch + 1
+            self._remap(blob_size)
+            source = self._map if self._map is not None else b""
+            compacted: dict[int, tuple[int, int]] = {}
+            with open(self._blob_path(epoch), "wb") as blob:
+                for memory_id, (offset, length) in sorted(
+                    offsets.items(), key=lambda item: item[1][0]
+                ):
+                    compacted[memory_id] = (blob.tell(), length)
+                    blob.write(source[offset : offset + length])
+                blob.flush()
+                os.fsync(blob.fileno())
+            records = [(HEADER_ID, epoch, 0)] + [
+                (memory_id, offset, length)
+                for memory_id, (offset, length) in compacted.items()
+            ]
+            write_atomic(self.table_path, np.array(records, dtype=RECORD))
+
+            if self._map is not None:
+                self._map.close()
+            self._map = None
+            self._mapped_size = 0
+            # open maps in other processes keep the old blob readable until they reload
+            if os.path.exists(old_blob_path):
+                os.remove(old_blob_path)
+            self.epoch = epoch
+            self._records = len(compacted)
+            self._offsets = compacted
+            return True
+
+    def destroy(self) -> None:
+        self.close()
+        with self._lock:
+            for path in (self.table_path, self.blob_path, self._blob_path(0)):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.epoch = 0
+
+    def __contains__(self, memory_id: int) -> bool:
+        with self._lock:
+            return memory_id in self._load()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+            self._map = None
+            self._mapped_size = 0
+            self._offsets = None
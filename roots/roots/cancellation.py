@@ -0,0 +1,95 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._event = threading.Event()
+        self._callbacks: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise Cancelled(self.name)
+
+
+_current: contextvars.ContextVar[Optional[CancellationToken]] = contextvars.ContextVar(
+    "cancellation", default=None
+)
+_tokens: dict[str, tuple[str, CancellationToken]] = {}
+_tokens_lock = threading.Lock()
+
+
+def current() -> Optional[CancellationToken]:
+    return _current.get()
+
+
+@contextmanager
+def active(token: CancellationToken):
+    reset = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(reset)
+
+
+def raise_if_cancelled() -> None:
+    token = current()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def register(message_id: str, session_id: str) -> CancellationToken:
+    token = CancellationToken(message_id)
+    with _tokens_lock:
+        _tokens[message_id] = (session_id, token)
+    return token
+
+
+def release(message_id: str) -> None:
+    with _tokens_lock:
+        _tokens.pop(message_id, None)
+
+
+def cancel(message_id: str) -> bool:
+    with _tokens_lock:
+        entry = _tokens.get(message_id)
+    if entry is None:
+        return False
+    entry[1].cancel()
+    return True
+
+
+def cancel_session(session_id: str) -> int:
+    with _tokens_lock:
+        tokens = [token for owner, token in _tokens.values() if owner == session_id]
+    for token in tokens:
+        token.cancel()
+    return len(tokens)
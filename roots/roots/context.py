@@ -1,7 +1,162 @@
-from .models import query_decision_agent
+import threading
+import time
+from typing import NamedTuple, Optional, Protocol
+
+import numpy as np
+
+from . import conversations, tracing
+from ._embedding import EmbeddingSizeError, embed, embed_many
+from .cancellation import raise_if_cancelled
+from .models import decide
 from .memories import fetch_relevant_memories
 
 
+BROAD_PROTOTYPES = (
+    "What do you know about me?",
+    "Summarize everything you remember about me.",
+    "What are my preferences?",
+    "Tell me about my habits and routines.",
+    "What have we talked about before?",
+    "Give me an overview of my interests.",
+    "Based on everything you know about me, what should I do next?",
+    "How have my goals changed over time?",
+)
+SPECIFIC_PROTOTYPES = (
+    "What is the capital of France?",
+    "How do I reverse a list in Python?",
+    "What book did I say I was reading?",
+    "Write a function that parses a JSON file.",
+    "What is my dog's name?",
+    "Explain how HNSW indexes work.",
+    "Why does this code raise a KeyError?",
+    "What time is my meeting tomorrow?",
+)
+ROUTER_MIN_MARGIN = 0.05
+HYBRID_CANDIDATES = 10
+HYBRID_RESULTS = 3
+# bm25 scores are negative and lower is better; matches on common words alone score
+# close to zero, so past messages must clear this to be worth a place in the prompt
+HYBRID_MAX_MESSAGE_SCORE = -3.0
+RRF_K = 60
+
+
+class RoutingDecision(NamedTuple):
+    is_broad: bool
+    confidence: float
+    source: str
+    response: str
+
+
+class Router(Protocol):
+    def route(self, prompt: str, embedding: Optional[np.ndarray]) -> RoutingDecision: ...
+
+
+class RouterMetrics:
+    def __init__(self):
+        self.decisions: dict[str, int] = {}
+        self.latency_seconds_total = 0.0
+        self.latency_seconds_max = 0.0
+        self.fallbacks = 0
+        self.agreements = 0
+        self._lock = threading.Lock()
+
+    def record(self, decision: RoutingDecision, seconds: float) -> None:
+        with self._lock:
+            self.decisions[decision.source] = self.decisions.get(decision.source, 0) + 1
+            self.latency_seconds_total += seconds
+            self.latency_seconds_max = max(self.latency_seconds_max, seconds)
+
+    def record_fallback(self, guess: bool, decision: RoutingDecision) -> None:
+        with self._lock:
+            self.fallbacks += 1
+            self.agreements += guess == decision.is_broad
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            count = sum(self.decisions.values())
+            by_source = {
+                f"decisions_{source}": total for source, total in self.decisions.items()
+            }
+            return {
+                **by_source,
+                "decisions": count,
+                "latency_seconds_mean": self.latency_seconds_total / max(count, 1),
+                "latency_seconds_max": self.latency_seconds_max,
+                "fallbacks": self.fallbacks,
+                "agreement": self.agreements / self.fallbacks if self.fallbacks else 1.0,
+            }
+
+
+class LLMRouter:
+    def route(
+        self, prompt: str, embedding: Optional[np.ndarray] = None
+    ) -> RoutingDecision:
+        is_broad, response = _prompt_requires_broad_context(prompt)
+        return RoutingDecision(is_broad, 1.0, "llm", response)
+
+
+class PrototypeRouter:
+    def __init__(
+        self,
+        fallback: Optional[Router] = None,
+        min_margin: float = ROUTER_MIN_MARGIN,
+        broad_prototypes: tuple[str, ...] = BROAD_PROTOTYPES,
+        specific_prototypes: tuple[str, ...] = SPECIFIC_PROTOTYPES,
+    ):
+        self.fallback = fallback
+        self.min_margin = min_margin
+        self.metrics = RouterMetrics()
+        self._prototypes = {True: broad_prototypes, False: specific_prototypes}
+        self._centroids: Optional[dict[bool, np.ndarray]] = None
+        self._lock = threading.Lock()
+
+    def _load_centroids(self) -> Optional[dict[bool, np.ndarray]]:
+        with self._lock:
+            if self._centroids is None:
+                centroids = {}
+                for is_broad, prompts in self._prototypes.items():
+                    embeddings = [e for e in embed_many(list(prompts)) if e is not None]
+                    if not embeddings:
+                        return None
+                    centroids[is_broad] = _normalize(np.mean(embeddings, axis=0))
+                self._centroids = centroids
+            return self._centroids
+
+    def route(
+        self, prompt: str, embedding: Optional[np.ndarray] = None
+    ) -> RoutingDecision:
+        started_at = time.perf_counter()
+        decision = self._route(prompt, embedding)
+        self.metrics.record(decision, time.perf_counter() - started_at)
+        return decision
+
+    def _route(self, prompt: str, embedding: Optional[np.ndarray]) -> RoutingDecision:
+        if embedding is None:
+            embedding = _embed(prompt)
+        centroids = self._load_centroids() if embedding is not None else None
+        if centroids is None or embedding is None:
+            if self.fallback is None:
+                return RoutingDecision(False, 0.0, "default", "")
+            return self.fallback.route(prompt, embedding)
+
+        embedding = _normalize(embedding)
+        margin = float(embedding @ centroids[True] - embedding @ centroids[False])
+        guess = margin > 0
+        if abs(margin) >= self.min_margin or self.fallback is None:
+            return RoutingDecision(
+                guess, abs(margin), "prototype", f"margin={margin:.3f}"
+            )
+
+        decision = self.fallback.route(prompt, embedding)
+        self.metrics.record_fallback(guess, decision)
+        return decision
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
 def _prompt_requires_broad_context(prompt: str) -> tuple[bool, str]:
     text = f"""
 Determine if the query requires broad memory retrieval.
@@ -9,23 +164,95 @@ Respond with either the word 'BROAD' or the word 'SPECIFIC'.
 
 Query: {prompt}
 """.strip()
-    response = "".join(query_decision_agent(text)).strip()
+    response = decide(text).strip()
     return "BROAD" in response, response
 
 
-def generate(prompt: str) -> str:
-    is_broad_prompt, _is_broad_prompt_response = _prompt_requires_broad_context(prompt)
-    print(
-        "Using broad context?",
-        is_broad_prompt,
-        ": (response)=",
-        _is_broad_prompt_response,
+router: Router = PrototypeRouter(fallback=LLMRouter())
+
+
+def set_router(new_router: Router) -> None:
+    global router  # pylint: disable=global-statement
+    router = new_router
+
+
+def router_stats() -> dict[str, float]:
+    metrics: Optional[RouterMetrics] = getattr(router, "metrics", None)
+    return metrics.stats() if metrics is not None else {}
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = RRF_K) -> list[str]:
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, text in enumerate(ranking):
+            scores[text] = scores.get(text, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.__getitem__, reverse=True)
+
+
+def _hybrid_search(
+    prompt: str, embedding: Optional[np.ndarray], conversation_id: Optional[int]
+) -> tuple[list[str], list[str]]:
+    memory_results = fetch_relevant_memories(
+        prompt, k=HYBRID_CANDIDATES, embedding=embedding
+    )
+    # the current conversation is already in the prompt through its history, and only
+    # what the user wrote is evidence about them
+    message_results, _ = conversations.search(
+        prompt,
+        limit=HYBRID_CANDIDATES,
+        match_all=False,
+        exclude_conversation_id=conversation_id,
+        role="user",
+        max_score=HYBRID_MAX_MESSAGE_SCORE,
+        highlight=("", ""),
+    )
+    memories = [result["memory"] for result in memory_results]
+    messages = [result["snippet"] for result in message_results]
+    fused = reciprocal_rank_fusion([memories, messages])[:HYBRID_RESULTS]
+    return (
+        [text for text in fused if text in memories],
+        [text for text in fused if text not in memories],
+    )
+
+
+def _embed(prompt: str) -> Optional[np.ndarray]:
+    # routing and retrieval both fall back to working without an embedding
+    try:
+        return embed(prompt)
+    except EmbeddingSizeError as error:
+        print(f"Could not embed prompt: {error}")
+        return None
+
+
+def generate(prompt: str, conversation_id: Optional[int] = None) -> str:
+    with tracing.span("embed"):
+        query_embedding = _embed(prompt)
+    raise_if_cancelled()
+    with tracing.span("route"):
+        decision = router.route(prompt, query_embedding)
+    raise_if_cancelled()
+    tracing.annotate(
+        broad_context=decision.is_broad,
+        route_source=decision.source,
+        route_confidence=round(decision.confidence, 3),
     )
-    relevant_memories, _ = fetch_relevant_memories(prompt, broad_search=is_broad_prompt)
+    with tracing.span("retrieve"):
+        if decision.is_broad:
+            memory_results = fetch_relevant_memories(
+                prompt, broad_search=True, embedding=query_embedding
+            )
+            relevant_memories = [result["memory"] for result in memory_results]
+            relevant_messages: list[str] = []
+        else:
+            relevant_memories, relevant_messages = _hybrid_search(
+                prompt, query_embedding, conversation_id
+            )
     relevant_notes: list[str] = []
     context = ""
     if relevant_memories:
         context += f"\nRelevant memories: \n{relevant_memories}"
+    if relevant_messages:
+        context += f"\nRelevant past messages: \n{relevant_messages}"
     if relevant_notes:
         context += f"\nRelevant notes: \n{relevant_notes}"
     return context
@@ -1,11 +1,21 @@
-from typing import Optional
+import re
+import sys
+from typing import Iterable, Optional
 from datetime import datetime, UTC
 
 
-from .types import Conversation, Message
+from .types import Conversation, ConversationSummary, Message, Role, SearchResult
+from . import sql
 from .sql import client
 
 DATABASE_FILE = "data/conversations.db"
+MESSAGE_PAGE_SIZE = 100
+CONVERSATION_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+SEARCH_SNIPPET_TOKENS = 16
+SEARCH_BACKFILL_BATCH_SIZE = 1000
+# a conversation is created before its first message, so cleanup leaves new ones alone
+CLEAN_GRACE_SECONDS = 10 * 60
 
 
 def write_default_name():
@@ -13,32 +23,145 @@ def write_default_name():
     return f"conversations/{today}"
 
 
-def initialize_database(database_file: str = DATABASE_FILE) -> None:
-    with client(database_file) as cursor:
-        cursor.execute(
-            """
-                CREATE TABLE IF NOT EXISTS conversations (
-                    conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    conversation_name TEXT NOT NULL,
-                    created_at_utc INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
-                    last_modified_at_utc INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
-                )
-            """
+MIGRATIONS: list[tuple[str, ...]] = [
+    (
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_name TEXT NOT NULL,
+            created_at_utc INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
+            last_modified_at_utc INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
         )
-        cursor.execute(
-            """
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id TEXT PRIMARY KEY,
-                    exchange_id TEXT NOT NULL,
-                    conversation_id INTEGER NOT NULL,
-                    role TEXT CHECK(role IN ('user', 'assistant', 'system')) NOT NULL,
-                    content TEXT NOT NULL,
-                    context TEXT,
-                    model_id TEXT,
-                    created_at_utc INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
-                )
-            """
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id TEXT PRIMARY KEY,
+            exchange_id TEXT NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            role TEXT CHECK(role IN ('user', 'assistant', 'system')) NOT NULL,
+            content TEXT NOT NULL,
+            context TEXT,
+            model_id TEXT,
+            created_at_utc INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+        )
+        """,
+    ),
+    (
+        # SQLite cannot add a foreign key or widen a CHECK constraint in place. The
+        # search index and keyset pages are keyed on rowid, which VACUUM may renumber
+        # unless it is declared as an INTEGER PRIMARY KEY, so the rowids are copied too
+        """
+        CREATE TABLE messages_with_foreign_key (
+            message_rowid INTEGER PRIMARY KEY,
+            message_id TEXT NOT NULL UNIQUE,
+            exchange_id TEXT NOT NULL,
+            conversation_id INTEGER NOT NULL
+                REFERENCES conversations (conversation_id) ON DELETE CASCADE,
+            role TEXT CHECK(role IN ('user', 'assistant', 'system')) NOT NULL,
+            content TEXT NOT NULL,
+            context TEXT,
+            model_id TEXT,
+            created_at_utc INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
+            state TEXT NOT NULL DEFAULT 'complete'
+                CHECK(state IN ('complete', 'cancelled', 'failed'))
+        )
+        """,
+        """
+        INSERT INTO messages_with_foreign_key
+        (
+            message_rowid, message_id, exchange_id, conversation_id, role, content,
+            context, model_id, created_at_utc
+        )
+        SELECT
+            rowid, message_id, exchange_id, conversation_id, role, content, context,
+            model_id, created_at_utc
+        FROM messages
+        WHERE conversation_id IN (SELECT conversation_id FROM conversations)
+        """,
+        "DROP TABLE messages",
+        "ALTER TABLE messages_with_foreign_key RENAME TO messages",
+        """
+        CREATE INDEX messages_conversation_id_created_at_utc
+        ON messages (conversation_id, created_at_utc)
+        """,
+        """
+        CREATE INDEX conversations_conversation_name
+        ON conversations (conversation_name)
+        """,
+        """
+        CREATE INDEX conversations_last_modified_at_utc
+        ON conversations (last_modified_at_utc)
+        """,
+    ),
+    (
+        """
+        CREATE TABLE conversation_summaries (
+            conversation_id INTEGER PRIMARY KEY
+                REFERENCES conversations (conversation_id) ON DELETE CASCADE,
+            summary TEXT NOT NULL,
+            through_message_id TEXT NOT NULL,
+            updated_at_utc INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
         )
+        """,
+    ),
+    (
+        """
+        CREATE VIRTUAL TABLE messages_fts
+        USING fts5(content, tokenize = 'porter unicode61')
+        """,
+        """
+        CREATE VIRTUAL TABLE conversations_fts
+        USING fts5(conversation_name, tokenize = 'porter unicode61')
+        """,
+        """
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT OR REPLACE INTO messages_fts (rowid, content)
+            VALUES (new.rowid, new.content);
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.rowid;
+        END
+        """,
+        """
+        CREATE TRIGGER conversations_fts_insert AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts (rowid, conversation_name)
+            VALUES (new.conversation_id, new.conversation_name);
+        END
+        """,
+        """
+        CREATE TRIGGER conversations_fts_update
+        AFTER UPDATE OF conversation_name ON conversations BEGIN
+            INSERT OR REPLACE INTO conversations_fts (rowid, conversation_name)
+            VALUES (new.conversation_id, new.conversation_name);
+        END
+        """,
+        """
+        CREATE TRIGGER conversations_fts_delete AFTER DELETE ON conversations BEGIN
+            DELETE FROM conversations_fts WHERE rowid = old.conversation_id;
+        END
+        """,
+        # rows written before the triggers existed are indexed by backfill_search_index
+        """
+        CREATE TABLE search_backfill (
+            table_name TEXT PRIMARY KEY,
+            last_rowid INTEGER NOT NULL
+        )
+        """,
+        "INSERT INTO search_backfill VALUES ('messages', 0), ('conversations', 0)",
+    ),
+]
+SEARCH_BACKFILL_COLUMNS = {"messages": "content", "conversations": "conversation_name"}
+
+
+def initialize_database(database_file: str = DATABASE_FILE) -> None:
+    sql.migrate(database_file, MIGRATIONS)
 
 
 def create(
@@ -49,7 +172,7 @@ def create(
         cursor.execute("SELECT * FROM conversations WHERE conversation_name = ?", (name,))
         record = cursor.fetchone()
         if record is not None:
-            return fetch(record["conversation_id"])
+            return fetch(record["conversation_id"], database_file)
 
         cursor.execute(
             """
@@ -93,10 +216,14 @@ def update(
             )
         if cursor.fetchone() is None:
             raise ValueError("Could not update conversation")
-    return fetch(conversation_id)
+    return fetch(conversation_id, database_file, message_limit=MESSAGE_PAGE_SIZE)
 
 
-def fetch(conversation_id: int, database_file: str = DATABASE_FILE) -> Conversation:
+def fetch(
+    conversation_id: int,
+    database_file: str = DATABASE_FILE,
+    message_limit: Optional[int] = None,
+) -> Conversation:
     with client(database_file) as cursor:
         cursor.execute(
             """
@@ -107,19 +234,275 @@ def fetch(conversation_id: int, database_file: str = DATABASE_FILE) -> Conversat
             (conversation_id,),
         )
         conversation = cursor.fetchone()
+        messages, has_more = _fetch_message_page(
+            cursor, conversation_id, before=None, limit=message_limit
+        )
+    conversation["messages"] = messages
+    conversation["has_more_messages"] = has_more
+    return conversation
+
+
+def fetch_messages(
+    conversation_id: int,
+    before: Optional[str] = None,
+    limit: Optional[int] = MESSAGE_PAGE_SIZE,
+    database_file: str = DATABASE_FILE,
+) -> tuple[list[Message], bool]:
+    with client(database_file) as cursor:
+        return _fetch_message_page(cursor, conversation_id, before=before, limit=limit)
+
 
+def _fetch_message_page(
+    cursor, conversation_id: int, before: Optional[str], limit: Optional[int]
+) -> tuple[list[Message], bool]:
+    if limit == 0:
+        return [], False
+
+    if before is None:
         cursor.execute(
             """
             SELECT *
             FROM messages
             WHERE conversation_id = ?
-            ORDER BY created_at_utc ASC;
+            ORDER BY created_at_utc DESC, rowid DESC
+            LIMIT ?;
+            """,
+            (conversation_id, -1 if limit is None else limit + 1),
+        )
+    else:
+        cursor.execute(
+            """
+            SELECT *
+            FROM messages
+            WHERE conversation_id = ?
+            AND (created_at_utc, rowid) < (
+                SELECT created_at_utc, rowid
+                FROM messages
+                WHERE message_id = ?
+            )
+            ORDER BY created_at_utc DESC, rowid DESC
+            LIMIT ?;
+            """,
+            (conversation_id, before, -1 if limit is None else limit + 1),
+        )
+    messages = cursor.fetchall()
+    has_more = limit is not None and len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    return messages, has_more
+
+
+def fetch_messages_after(
+    conversation_id: int, after: Optional[str], database_file: str = DATABASE_FILE
+) -> list[Message]:
+    if after is None:
+        return fetch_messages(conversation_id, limit=None, database_file=database_file)[0]
+
+    with client(database_file) as cursor:
+        cursor.execute(
+            """
+            SELECT *
+            FROM messages
+            WHERE conversation_id = ?
+            AND (created_at_utc, rowid) > (
+                SELECT created_at_utc, rowid
+                FROM messages
+                WHERE message_id = ?
+            )
+            ORDER BY created_at_utc, rowid
+            """,
+            (conversation_id, after),
+        )
+        return cursor.fetchall()
+
+
+def fetch_summary(
+    conversation_id: int, database_file: str = DATABASE_FILE
+) -> Optional[ConversationSummary]:
+    with client(database_file) as cursor:
+        cursor.execute(
+            """
+            SELECT conversation_id, summary, through_message_id
+            FROM conversation_summaries
+            WHERE conversation_id = ?
             """,
             (conversation_id,),
         )
-        messages = cursor.fetchall()
-    conversation["messages"] = messages
-    return conversation
+        return cursor.fetchone()
+
+
+def save_summary(
+    conversation_id: int,
+    summary: str,
+    through_message_id: str,
+    database_file: str = DATABASE_FILE,
+) -> None:
+    with client(database_file) as cursor:
+        cursor.execute(
+            """
+            INSERT INTO conversation_summaries
+            (conversation_id, summary, through_message_id)
+            VALUES (?, ?, ?)
+            ON CONFLICT (conversation_id) DO UPDATE SET
+                summary = excluded.summary,
+                through_message_id = excluded.through_message_id,
+                updated_at_utc = strftime('%s', 'now')
+            """,
+            (conversation_id, summary, through_message_id),
+        )
+
+
+def search(
+    query: str,
+    limit: int = SEARCH_PAGE_SIZE,
+    offset: int = 0,
+    match_all: bool = True,
+    exclude_conversation_id: Optional[int] = None,
+    role: Optional[Role] = None,
+    max_score: Optional[float] = None,
+    highlight: tuple[str, str] = ("**", "**"),
+    snippet_tokens: int = SEARCH_SNIPPET_TOKENS,
+    database_file: str = DATABASE_FILE,
+) -> tuple[list[SearchResult], bool]:
+    terms = re.findall(r"\w+", query)
+    if not terms or limit <= 0:
+        return [], False
+    # quoting every term keeps user input from being read as FTS5 query syntax
+    match = (" AND " if match_all else " OR ").join(f'"{term}"' for term in terms)
+    match += "*"
+    # conversation names have no author, so filtering by role leaves them out
+
+    with client(database_file) as cursor:
+        cursor.execute(
+            """
+            SELECT *
+            FROM (
+                SELECT
+                    messages.conversation_id,
+                    conversations.conversation_name,
+                    messages.message_id,
+                    snippet(messages_fts, 0, ?, ?, '…', ?) AS snippet,
+                    bm25(messages_fts) AS score
+                FROM messages_fts
+                JOIN messages ON messages.rowid = messages_fts.rowid
+                JOIN conversations USING (conversation_id)
+                WHERE messages_fts MATCH ?
+                AND messages.conversation_id IS NOT ?
+                AND (? IS NULL OR messages.role = ?)
+                UNION ALL
+                SELECT
+                    conversations.conversation_id,
+                    conversations.conversation_name,
+                    NULL,
+                    snippet(conversations_fts, 0, ?, ?, '…', ?),
+                    bm25(conversations_fts)
+                FROM conversations_fts
+                JOIN conversations
+                ON conversations.conversation_id = conversations_fts.rowid
+                WHERE conversations_fts MATCH ?
+                AND conversations.conversation_id IS NOT ?
+                AND ? IS NULL
+            )
+            WHERE ? IS NULL OR score <= ?
+            ORDER BY score
+            LIMIT ? OFFSET ?
+            """,
+            (
+                *highlight,
+                snippet_tokens,
+                match,
+                exclude_conversation_id,
+                role,
+                role,
+                *highlight,
+                snippet_tokens,
+                match,
+                exclude_conversation_id,
+                role,
+                max_score,
+                max_score,
+                limit + 1,
+                offset,
+            ),
+        )
+        results = cursor.fetchall()
+    return results[:limit], len(results) > limit
+
+
+def backfill_search_index(
+    batch_size: int = SEARCH_BACKFILL_BATCH_SIZE, database_file: str = DATABASE_FILE
+) -> int:
+    indexed = 0
+    for table, column in SEARCH_BACKFILL_COLUMNS.items():
+        while True:
+            with client(database_file) as cursor:
+                cursor.execute(
+                    "SELECT last_rowid FROM search_backfill WHERE table_name = ?",
+                    (table,),
+                )
+                progress = cursor.fetchone()
+                if progress is None:
+                    break
+                cursor.execute(
+                    f"""
+                    SELECT rowid AS source_rowid, {column} AS text
+                    FROM {table}
+                    WHERE rowid > ?
+                    ORDER BY rowid
+                    LIMIT ?
+                    """,
+                    (progress["last_rowid"], batch_size),
+                )
+                records = cursor.fetchall()
+                if not records:
+                    cursor.execute(
+                        "DELETE FROM search_backfill WHERE table_name = ?", (table,)
+                    )
+                    break
+                cursor.executemany(
+                    f"INSERT OR REPLACE INTO {table}_fts (rowid, {column}) VALUES (?, ?)",
+                    [(record["source_rowid"], record["text"]) for record in records],
+                )
+                cursor.execute(
+                    "UPDATE search_backfill SET last_rowid = ? WHERE table_name = ?",
+                    (records[-1]["source_rowid"], table),
+                )
+            indexed += len(records)
+    if indexed:
+        print(f"Indexed {indexed:,} rows for search.")
+    return indexed
+
+
+def fetch_conversations(
+    before_modified: Optional[float] = None,
+    before_conversation_id: Optional[int] = None,
+    limit: int = CONVERSATION_PAGE_SIZE,
+    database_file: str = DATABASE_FILE,
+) -> tuple[list[Conversation], bool]:
+    # newest first, so the first page holds the conversations a user is likely to open
+    if before_modified is None:
+        before_modified, before_conversation_id = sys.maxsize, sys.maxsize
+    elif before_conversation_id is None:
+        before_conversation_id = -1
+
+    with client(database_file) as cursor:
+        cursor.execute(
+            """
+            SELECT *
+            FROM conversations
+            WHERE (last_modified_at_utc, conversation_id) < (?, ?)
+            ORDER BY last_modified_at_utc DESC, conversation_id DESC
+            LIMIT ?
+            """,
+            (before_modified, before_conversation_id, limit + 1),
+        )
+        conversations = cursor.fetchall()
+
+    has_more = len(conversations) > limit
+    conversations = conversations[:limit]
+    for conversation in conversations:
+        conversation["messages"] = []
+    return conversations, has_more
 
 
 def drop(conversation_id: int, database_file: str = DATABASE_FILE) -> None:
@@ -128,6 +511,7 @@ def drop(conversation_id: int, database_file: str = DATABASE_FILE) -> None:
             """
             DELETE FROM conversations
             WHERE conversation_id = ?
+            RETURNING conversation_id
             """,
             (conversation_id,),
         )
@@ -135,17 +519,38 @@ def drop(conversation_id: int, database_file: str = DATABASE_FILE) -> None:
             raise ValueError("Could not drop conversation")
 
 
-def clean_database(database_file: str = DATABASE_FILE) -> None:
+def clean_database(
+    keep: Iterable[int] = (),
+    grace_seconds: int = CLEAN_GRACE_SECONDS,
+    database_file: str = DATABASE_FILE,
+) -> None:
+    keep = list(keep)
+    placeholders = ", ".join("?" * len(keep))
     with client(database_file) as cursor:
         cursor.execute(
-            """
+            f"""
             DELETE FROM conversations
-            WHERE conversation_id NOT IN (
-                SELECT DISTINCT conversation_id
+            WHERE NOT EXISTS (
+                SELECT 1
                 FROM messages
+                WHERE messages.conversation_id = conversations.conversation_id
             )
-            """
+            AND created_at_utc < CAST(strftime('%s', 'now') AS INTEGER) - ?
+            AND conversation_id NOT IN ({placeholders})
+            """,
+            (grace_seconds, *keep),
+        )
+
+
+def update_message_context(
+    message_id: str, context: str, database_file: str = DATABASE_FILE
+) -> bool:
+    with client(database_file) as cursor:
+        cursor.execute(
+            "UPDATE messages SET context = ? WHERE message_id = ? RETURNING message_id",
+            (context, message_id),
         )
+        return cursor.fetchone() is not None
 
 
 def fetch_all(database_file: str = DATABASE_FILE) -> list[Conversation]:
@@ -179,25 +584,49 @@ def exists(conversation_id: int, database_file: str = DATABASE_FILE) -> bool:
 
 
 def save_message(message: Message, database_file: str = DATABASE_FILE) -> Message:
+    return save_messages([message], database_file)[0]
+
+
+def save_messages(
+    messages: list[Message], database_file: str = DATABASE_FILE
+) -> list[Message]:
+    last_modified_at_utc = datetime.now(UTC).timestamp()
+    conversation_ids = {int(message["conversation_id"]) for message in messages}
+    saved: list[Message] = []
     with client(database_file) as cursor:
-        cursor.execute(
+        for message in messages:
+            cursor.execute(
+                """
+                INSERT INTO messages
+                (
+                    message_id, exchange_id, conversation_id, model_id, role, content,
+                    context, state
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                RETURNING *
+                """,
+                (
+                    message["message_id"],
+                    message["exchange_id"],
+                    message["conversation_id"],
+                    message.get("model_id", None),
+                    message["role"],
+                    message["content"],
+                    message.get("context", None),
+                    message.get("state", "complete"),
+                ),
+            )
+            saved.append(cursor.fetchone())
+
+        cursor.executemany(
             """
-            INSERT INTO messages
-            (message_id, exchange_id, conversation_id, model_id, role, content, context)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            RETURNING *
+            UPDATE conversations
+            SET last_modified_at_utc = ?
+            WHERE conversation_id = ?
             """,
-            (
-                message["message_id"],
-                message["exchange_id"],
-                message["conversation_id"],
-                message.get("model_id", None),
-                message["role"],
-                message["content"],
-                message.get("context", None),
-            ),
+            [
+                (last_modified_at_utc, conversation_id)
+                for conversation_id in conversation_ids
+            ],
         )
-        message = cursor.fetchone()
-
-    update(int(message["conversation_id"]))
-    return message
+    return saved
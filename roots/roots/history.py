@@ -0,0 +1,172 @@
+import threading
+from concurrent.futures import Future
+from typing import Optional
+
+from . import conversations, models
+from .models import ChatMessage
+from .tokens import count_tokens
+from .types import Message
+from .workers import submit_detached
+
+
+RESPONSE_TOKEN_RESERVE = 1024
+RECENT_HISTORY_TOKENS = 1536
+SUMMARIZE_AFTER_TOKENS = 2048
+SUMMARIZE_CHUNK_TOKENS = 2048
+SUMMARY_PREFIX = "Summary of our earlier conversation:\n"
+
+
+class ConversationHistory:
+    def __init__(
+        self,
+        conversation_id: int,
+        summary: str = "",
+        through_message_id: Optional[str] = None,
+        messages: Optional[list[Message]] = None,
+    ):
+        self.conversation_id = conversation_id
+        self.summary = summary
+        self.through_message_id = through_message_id
+        self.messages: list[tuple[str, ChatMessage]] = []
+        # the newest message read from the database, where refresh picks up from
+        self.loaded_through_message_id = (
+            messages[-1]["message_id"] if messages else through_message_id
+        )
+        self._message_ids: set[str] = set()
+        self._lock = threading.Lock()
+        self._summarizing: Optional[Future] = None
+        self._extend(messages or [])
+
+    def _extend(self, messages: list[Message]) -> None:
+        with self._lock:
+            # a session's own turns come back again when it refreshes
+            messages = [
+                message
+                for message in messages
+                if message["message_id"] not in self._message_ids
+            ]
+            self._message_ids.update(message["message_id"] for message in messages)
+            self.messages += [
+                (
+                    message["message_id"],
+                    {"role": message["role"], "content": message["content"]},
+                )
+                for message in messages
+                if _belongs_in_prompt(message)
+            ]
+
+    def append(self, messages: list[Message]) -> None:
+        self._extend(messages)
+        self.compact()
+
+    def refresh(self) -> None:
+        # catches up on turns written by other tabs or server processes
+        messages = conversations.fetch_messages_after(
+            self.conversation_id, self.loaded_through_message_id
+        )
+        if messages:
+            self.loaded_through_message_id = messages[-1]["message_id"]
+            self.append(messages)
+
+    def tokens(self) -> int:
+        with self._lock:
+            return count_tokens(self.summary) + sum(
+                count_tokens(message["content"]) for _, message in self.messages
+            )
+
+    def prompt(self, model_id: str, content: str) -> list[ChatMessage]:
+        with self._lock:
+            summary = self.summary
+            messages = [message for _, message in self.messages if message["content"]]
+
+        budget = models.context_tokens(model_id) - RESPONSE_TOKEN_RESERVE
+        budget -= count_tokens(content)
+        prefix: list[ChatMessage] = []
+        if summary:
+            prefix.append({"role": "user", "content": f"{SUMMARY_PREFIX}{summary}"})
+            budget -= count_tokens(prefix[0]["content"])
+
+        window: list[ChatMessage] = []
+        for message in reversed(messages):
+            tokens = count_tokens(message["content"])
+            if tokens > budget:
+                break
+            window.append(message)
+            budget -= tokens
+        window.reverse()
+        # providers expect the user to speak first
+        while not prefix and window and window[0]["role"] == "assistant":
+            window.pop(0)
+        return prefix + window + [{"role": "user", "content": content}]
+
+    def compact(self) -> Optional[Future]:
+        with self._lock:
+            if self._summarizing is not None and not self._summarizing.done():
+                return None
+            folded = self._foldable()
+            if not folded:
+                return None
+            self._summarizing = submit_detached(self._summarize, folded)
+            return self._summarizing
+
+    def _foldable(self) -> list[tuple[str, ChatMessage]]:
+        # everything older than the recent window, once there is enough of it
+        recent_tokens = 0
+        split = len(self.messages)
+        while split and recent_tokens < RECENT_HISTORY_TOKENS:
+            split -= 1
+            recent_tokens += count_tokens(self.messages[split][1]["content"])
+        older = self.messages[:split]
+        older_tokens = sum(count_tokens(message["content"]) for _, message in older)
+        if older_tokens < SUMMARIZE_AFTER_TOKENS:
+            return []
+
+        # fold a long backlog a chunk at a time so each pass fits the summary model
+        folded_tokens = 0
+        for position, (_, message) in enumerate(older):
+            folded_tokens += count_tokens(message["content"])
+            if folded_tokens >= SUMMARIZE_CHUNK_TOKENS:
+                return older[: position + 1]
+        return older
+
+    def _summarize(self, folded: list[tuple[str, ChatMessage]]) -> None:
+        while folded:
+            try:
+                summary = models.summarize_history(
+                    [message for _, message in folded], self.summary
+                )
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                print(f"Could not summarize conversation {self.conversation_id}: {error}")
+                return
+
+            through_message_id = folded[-1][0]
+            conversations.save_summary(self.conversation_id, summary, through_message_id)
+            with self._lock:
+                # only one summary runs at a time, so the folded messages are still first
+                self.messages = self.messages[len(folded) :]
+                self.summary = summary
+                self.through_message_id = through_message_id
+                folded = self._foldable()
+
+
+def _belongs_in_prompt(message: Message) -> bool:
+    # a reply stopped or failed before it said anything would be an empty turn, which
+    # some providers reject outright
+    if not message["content"]:
+        return False
+    if message["role"] != "assistant":
+        return True
+    return message.get("state", "complete") == "complete"
+
+
+def load(conversation_id: int) -> ConversationHistory:
+    summary = conversations.fetch_summary(conversation_id)
+    through_message_id = summary["through_message_id"] if summary else None
+    history = ConversationHistory(
+        conversation_id,
+        summary=summary["summary"] if summary else "",
+        through_message_id=through_message_id,
+        messages=conversations.fetch_messages_after(conversation_id, through_message_id),
+    )
+    history.compact()
+    return history
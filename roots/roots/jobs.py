@@ -0,0 +1,535 @@
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+from . import sql, tracing
+from .sql import client
+from .types import Job
+
+
+JOBS_DB_FILE = "data/jobs.db"
+JOB_WORKERS = int(os.getenv("ROOTS_JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = 1.0
+# a running job renews its claim this often; one not renewed for a whole lease is
+# assumed lost with its process
+JOB_HEARTBEAT_SECONDS = 30.0
+JOB_LEASE_SECONDS = 5 * 60.0
+JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60.0
+JOB_STATUS_LIMIT = 20
+RETRY_BACKOFF_SECONDS = 2.0
+RETRY_BACKOFF_MAX_SECONDS = 5 * 60.0
+SCHEDULE_CHECK_SECONDS = 60.0
+# local hours, start inclusive and end exclusive, wrapping past midnight as in "22-6"
+OFF_PEAK_HOURS = os.getenv("ROOTS_OFF_PEAK_HOURS", "2-6")
+
+# lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 10
+PRIORITY_MAINTENANCE = 20
+
+MIGRATIONS: list[tuple[str, ...]] = [
+    (
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            state TEXT CHECK(state IN ('queued', 'running', 'done', 'failed')) NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            session_id TEXT,
+            coalesce_key TEXT,
+            error TEXT,
+            run_after_utc REAL NOT NULL,
+            claimed_at_utc REAL,
+            created_at_utc REAL NOT NULL,
+            updated_at_utc REAL NOT NULL
+        )
+        """,
+        """
+        CREATE INDEX jobs_runnable
+        ON jobs (state, priority, job_id)
+        """,
+        """
+        CREATE INDEX jobs_coalesce_key
+        ON jobs (coalesce_key, state)
+        WHERE coalesce_key IS NOT NULL
+        """,
+        """
+        CREATE INDEX jobs_session_id
+        ON jobs (session_id, job_id)
+        WHERE session_id IS NOT NULL
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS job_schedule (
+            kind TEXT PRIMARY KEY,
+            last_enqueued_at_utc REAL NOT NULL
+        )
+        """,
+    ),
+]
+
+Handler = Callable[[list[dict]], None]
+Listener = Callable[[Job], None]
+
+
+class JobKind:
+    def __init__(
+        self,
+        name: str,
+        function: Handler,
+        batch_size: int = 1,
+        max_attempts: int = 3,
+        priority: int = PRIORITY_DEFAULT,
+    ):
+        self.name = name
+        self.function = function
+        # queued jobs of a batched kind run together, so many small writes share one
+        # transaction and one index update
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.priority = priority
+
+
+class Schedule:
+    def __init__(
+        self,
+        kind: str,
+        every_seconds: float,
+        payload: Optional[dict] = None,
+        off_peak: bool = True,
+    ):
+        self.kind = kind
+        self.every_seconds = every_seconds
+        self.payload = payload or {}
+        self.off_peak = off_peak
+
+
+_kinds: dict[str, JobKind] = {}
+_schedules: dict[str, Schedule] = {}
+_listeners: list[Listener] = []
+_wake = threading.Condition()
+_threads: list[threading.Thread] = []
+_start_lock = threading.Lock()
+
+
+def initialize_database(database_file: str = JOBS_DB_FILE) -> None:
+    sql.migrate(database_file, MIGRATIONS)
+
+
+def handler(
+    kind: str,
+    batch_size: int = 1,
+    max_attempts: int = 3,
+    priority: int = PRIORITY_DEFAULT,
+) -> Callable[[Handler], Handler]:
+    def register(function: Handler) -> Handler:
+        _kinds[kind] = JobKind(kind, function, batch_size, max_attempts, priority)
+        return function
+
+    return register
+
+
+def periodic(
+    kind: str,
+    every_seconds: float,
+    payload: Optional[dict] = None,
+    off_peak: bool = True,
+) -> None:
+    _schedules[kind] = Schedule(kind, every_seconds, payload, off_peak)
+
+
+def on_update(listener: Listener) -> None:
+    _listeners.append(listener)
+
+
+def enqueue(
+    kind: str,
+    payload: Optional[dict] = None,
+    priority: Optional[int] = None,
+    session_id: Optional[str] = None,
+    coalesce_key: Optional[str] = None,
+    delay_seconds: float = 0.0,
+    database_file: str = JOBS_DB_FILE,
+) -> int:
+    job_kind = _kinds[kind]
+    now = time.time()
+    priority = job_kind.priority if priority is None else priority
+    with client(database_file) as cursor:
+        # a job already waiting under the same key covers this one
+        cursor.execute(
+            """
+            INSERT INTO jobs
+            (
+                kind, payload, priority, state, max_attempts, session_id, coalesce_key,
+                run_after_utc, created_at_utc, updated_at_utc
+            )
+            SELECT ?, ?, ?, 'queued', ?, ?, ?, ?, ?, ?
+            WHERE ? IS NULL OR NOT EXISTS (
+                SELECT 1 FROM jobs WHERE coalesce_key = ? AND state = 'queued'
+            )
+            RETURNING job_id
+            """,
+            (
+                kind,
+                json.dumps(payload or {}),
+                priority,
+                job_kind.max_attempts,
+                session_id,
+                coalesce_key,
+                now + delay_seconds,
+                now,
+                now,
+                coalesce_key,
+                coalesce_key,
+            ),
+        )
+        inserted = cursor.fetchone()
+        if inserted is None:
+            cursor.execute(
+                """
+                UPDATE jobs
+                SET priority = MIN(priority, ?), updated_at_utc = ?
+                WHERE coalesce_key = ? AND state = 'queued'
+                RETURNING job_id
+                """,
+                (priority, now, coalesce_key),
+            )
+            inserted = cursor.fetchone()
+    with _wake:
+        _wake.notify()
+    return inserted["job_id"]
+
+
+def run_pending(database_file: str = JOBS_DB_FILE) -> int:
+    # runs whatever is due in the calling thread, for scripts and benchmarks
+    ran = 0
+    while claimed := _claim(database_file):
+        _run(claimed, database_file)
+        ran += len(claimed)
+    return ran
+
+
+def _claim(database_file: str) -> list[Job]:
+    if not _kinds:
+        return []
+    now = time.time()
+    kinds = list(_kinds)
+    placeholders = ", ".join("?" * len(kinds))
+    with client(database_file) as cursor:
+        cursor.execute(
+            f"""
+            SELECT kind
+            FROM jobs
+            WHERE state = 'queued' AND run_after_utc <= ? AND kind IN ({placeholders})
+            ORDER BY priority, job_id
+            LIMIT 1
+            """,
+            (now, *kinds),
+        )
+        next_job = cursor.fetchone()
+        if next_job is None:
+            return []
+        job_kind = _kinds[next_job["kind"]]
+        # the state check keeps two workers, or two processes, from claiming one job
+        cursor.execute(
+            """
+            UPDATE jobs
+            SET
+                state = 'running',
+                attempts = attempts + 1,
+                claimed_at_utc = ?,
+                updated_at_utc = ?
+            WHERE state = 'queued' AND job_id IN (
+                SELECT job_id
+                FROM jobs
+                WHERE state = 'queued' AND kind = ? AND run_after_utc <= ?
+                ORDER BY priority, job_id
+                LIMIT ?
+            )
+            RETURNING *
+            """,
+            (now, now, job_kind.name, now, job_kind.batch_size),
+        )
+        claimed = [_decode(job) for job in cursor.fetchall()]
+    for job in claimed:
+        _notify(job)
+    return claimed
+
+
+def _run(claimed: list[Job], database_file: str) -> None:
+    job_kind = _kinds[claimed[0]["kind"]]
+    finished = threading.Event()
+    heartbeat = threading.Thread(
+        target=_heartbeat,
+        args=([job["job_id"] for job in claimed], finished, database_file),
+        name=f"roots-job-heartbeat-{claimed[0]['job_id']}",
+        daemon=True,
+    )
+    heartbeat.start()
+    try:
+        with tracing.span(f"job_{job_kind.name}"):
+            job_kind.function([job["payload"] for job in claimed])
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        print(f"Job {job_kind.name} failed: {error}")
+        error_message: Optional[str] = f"{type(error).__name__}: {error}"
+    else:
+        error_message = None
+    finally:
+        finished.set()
+        heartbeat.join()
+    _finish(claimed, error_message, database_file)
+
+
+def _heartbeat(job_ids: list[int], finished: threading.Event, database_file: str):
+    # keeps long jobs, such as an index rebuild, from being taken for lost and run twice
+    placeholders = ", ".join("?" * len(job_ids))
+    while not finished.wait(timeout=JOB_HEARTBEAT_SECONDS):
+        try:
+            with client(database_file) as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE jobs
+                    SET claimed_at_utc = ?
+                    WHERE state = 'running' AND job_id IN ({placeholders})
+                    """,
+                    (time.time(), *job_ids),
+                )
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            print(f"Could not renew jobs {job_ids}: {error}")
+
+
+def _finish(claimed: list[Job], error: Optional[str], database_file: str) -> None:
+    now = time.time()
+    updates = []
+    for job in claimed:
+        if error is None:
+            state, run_after_utc = "done", job["run_after_utc"]
+        elif job["attempts"] < job["max_attempts"]:
+            state, run_after_utc = "queued", now + backoff(job["attempts"])
+        else:
+            state, run_after_utc = "failed", job["run_after_utc"]
+        updates.append((state, error, run_after_utc, now, job["job_id"]))
+    with client(database_file) as cursor:
+        cursor.executemany(
+            """
+            UPDATE jobs
+            SET state = ?, error = ?, run_after_utc = ?, updated_at_utc = ?
+            WHERE job_id = ?
+            """,
+            updates,
+        )
+        placeholders = ", ".join("?" * len(claimed))
+        cursor.execute(
+            f"SELECT * FROM jobs WHERE job_id IN ({placeholders})",
+            [job["job_id"] for job in claimed],
+        )
+        finished = [_decode(job) for job in cursor.fetchall()]
+    for job in finished:
+        _notify(job)
+
+
+def backoff(attempts: int) -> float:
+    delay = min(RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1), RETRY_BACKOFF_MAX_SECONDS)
+    # jittered so jobs that failed together do not all retry together
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _decode(job: dict) -> Job:
+    job["payload"] = json.loads(job["payload"])
+    return job  # type: ignore
+
+
+def _notify(job: Job) -> None:
+    for listener in _listeners:
+        try:
+            listener(job)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            print(f"Could not report job {job['job_id']}: {error}")
+
+
+def recover_expired(database_file: str = JOBS_DB_FILE) -> int:
+    now = time.time()
+    expired_before = now - JOB_LEASE_SECONDS
+    with client(database_file) as cursor:
+        # a job that keeps taking its process down must not be retried forever
+        cursor.execute(
+            """
+            UPDATE jobs
+            SET
+                state = 'failed',
+                error = 'Lost with the process that ran it',
+                updated_at_utc = ?
+            WHERE state = 'running' AND claimed_at_utc < ? AND attempts >= max_attempts
+            RETURNING job_id
+            """,
+            (now, expired_before),
+        )
+        failed = cursor.fetchall()
+        cursor.execute(
+            """
+            UPDATE jobs
+            SET state = 'queued', run_after_utc = ?, updated_at_utc = ?
+            WHERE state = 'running' AND claimed_at_utc < ?
+            RETURNING job_id
+            """,
+            (now + backoff(1), now, expired_before),
+        )
+        return len(failed) + len(cursor.fetchall())
+
+
+def prune(
+    retention_seconds: float = JOB_RETENTION_SECONDS,
+    database_file: str = JOBS_DB_FILE,
+) -> int:
+    with client(database_file) as cursor:
+        cursor.execute(
+            """
+            DELETE FROM jobs
+            WHERE state IN ('done', 'failed') AND updated_at_utc < ?
+            RETURNING job_id
+            """,
+            (time.time() - retention_seconds,),
+        )
+        return len(cursor.fetchall())
+
+
+def is_off_peak(moment: Optional[datetime] = None) -> bool:
+    start, end = (int(hour) for hour in OFF_PEAK_HOURS.split("-"))
+    hour = (moment or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def schedule_due(database_file: str = JOBS_DB_FILE) -> list[int]:
+    now = time.time()
+    job_ids = []
+    for schedule in _schedules.values():
+        if schedule.off_peak and not is_off_peak():
+            continue
+        # claimed through the schedule row, so one of several processes enqueues it
+        with client(database_file) as cursor:
+            cursor.execute(
+                """
+                INSERT INTO job_schedule (kind, last_enqueued_at_utc) VALUES (?, ?)
+                ON CONFLICT (kind) DO UPDATE
+                SET last_enqueued_at_utc = excluded.last_enqueued_at_utc
+                WHERE last_enqueued_at_utc <= ?
+                RETURNING kind
+                """,
+                (schedule.kind, now, now - schedule.every_seconds),
+            )
+            due = cursor.fetchone() is not None
+        if due:
+            job_ids.append(
+                enqueue(
+                    schedule.kind,
+                    schedule.payload,
+                    coalesce_key=schedule.kind,
+                    database_file=database_file,
+                )
+            )
+    return job_ids
+
+
+def status(
+    session_id: Optional[str] = None, database_file: str = JOBS_DB_FILE
+) -> dict[str, Any]:
+    with client(database_file) as cursor:
+        cursor.execute(
+            """
+            SELECT kind, state, COUNT(*) AS jobs
+            FROM jobs
+            WHERE state IN ('queued', 'running', 'failed')
+            GROUP BY kind, state
+            """
+        )
+        counts: dict[str, dict[str, int]] = {}
+        for row in cursor.fetchall():
+            counts.setdefault(row["kind"], {})[row["state"]] = row["jobs"]
+        recent: list[Job] = []
+        if session_id is not None:
+            cursor.execute(
+                """
+                SELECT *
+                FROM jobs
+                WHERE session_id = ?
+                ORDER BY job_id DESC
+                LIMIT ?
+                """,
+                (session_id, JOB_STATUS_LIMIT),
+            )
+            recent = [_decode(job) for job in cursor.fetchall()]
+    return {"counts": counts, "jobs": recent}
+
+
+def stats(database_file: str = JOBS_DB_FILE) -> dict[str, int]:
+    with client(database_file) as cursor:
+        cursor.execute(
+            """
+            SELECT state, COUNT(*) AS jobs
+            FROM jobs
+            WHERE state IN ('queued', 'running', 'failed')
+            GROUP BY state
+            """
+        )
+        counts = {row["state"]: row["jobs"] for row in cursor.fetchall()}
+    return {state: counts.get(state, 0) for state in ("queued", "running", "failed")}
+
+
+def _work(database_file: str) -> None:
+    while True:
+        try:
+            claimed = _claim(database_file)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            print(f"Could not claim jobs: {error}")
+            claimed = []
+        if claimed:
+            _run(claimed, database_file)
+            continue
+        # other processes enqueue too, so wake up now and then to look
+        with _wake:
+            _wake.wait(timeout=JOB_POLL_SECONDS)
+
+
+def _schedule_loop(database_file: str) -> None:
+    while True:
+        try:
+            recover_expired(database_file)
+            schedule_due(database_file)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            print(f"Could not schedule jobs: {error}")
+        time.sleep(SCHEDULE_CHECK_SECONDS)
+
+
+def start(workers: int = JOB_WORKERS, database_file: str = JOBS_DB_FILE) -> None:
+    with _start_lock:
+        if any(thread.is_alive() for thread in _threads):
+            return
+        initialize_database(database_file)
+        _threads.clear()
+        for number in range(workers):
+            _threads.append(
+                threading.Thread(
+                    target=_work,
+                    args=(database_file,),
+                    name=f"roots-job-{number}",
+                    daemon=True,
+                )
+            )
+        _threads.append(
+            threading.Thread(
+                target=_schedule_loop,
+                args=(database_file,),
+                name="roots-job-scheduler",
+                daemon=True,
+            )
+        )
+        for thread in _threads:
+            thread.start()
@@ -1,115 +1,736 @@
+import json
 import os
+import re
+import threading
+import time
+from typing import Iterator, Optional
 
-import faiss  # type: ignore
 import numpy as np
 
+from . import sql
 from .sql import client
-from ._embedding import embed, construct_index
-from .models import query_decision_agent
+from ._embedding import (
+    TRAINING_SAMPLE_SIZE,
+    EMBEDDING_SIZE,
+    EmbeddingSizeError,
+    embed,
+    embed_many,
+    construct_index,
+    train_index,
+)
+from ._index import get_index, close_index, write_atomic, MemoryIndex
+from ._lazy import lazy_import
+from ._payloads import PayloadStore
+from .models import decide
+from ._decisions import decision_cache
+from .tokens import count_tokens
+from .types import MemoryResult
+
+faiss = lazy_import("faiss")
 
 MEMORY_INDEX_FILE = "data/memory_embeddings.index"
 MEMORY_DB_FILE = "data/memory_store.db"
+MEMORY_PAYLOAD_FILE = "data/memory_payloads"
+USE_PAYLOAD_STORE = True
+REBUILD_INDEX_FILE = f"{MEMORY_INDEX_FILE}.rebuild"
+REBUILD_CHECKPOINT_FILE = f"{MEMORY_INDEX_FILE}.rebuild.json"
+REBUILD_CHUNK_SIZE = 512
+REBUILD_CHECKPOINT_SECONDS = 30.0
+INDEX_FOLLOW_SECONDS = float(os.getenv("ROOTS_INDEX_FOLLOW_SECONDS", "1.0"))
+BROAD_CANDIDATES = 256
+BROAD_TOKEN_BUDGET = 1024
+BROAD_RELEVANCE_WEIGHT = 0.3
+DEDUPLICATE_THRESHOLD = 0.95
+DEDUPLICATE_NEIGHBOURS = 8
+# syncs that may fail to embed a memory before it is left out of the index, until the
+# next rebuild embeds every memory again
+EMBED_ATTEMPTS = 5
+MEMORABLE_MIN_WORDS = 2
+TRIVIAL_MESSAGES = frozenset(
+    (
+        "thanks",
+        "thank you",
+        "thanks a lot",
+        "ok thanks",
+        "ok",
+        "okay",
+        "sure",
+        "yes",
+        "yes please",
+        "no",
+        "no thanks",
+        "got it",
+        "sounds good",
+        "cool",
+        "nice",
+        "great",
+        "hello",
+        "hi there",
+        "good morning",
+        "good night",
+    )
+)
+
+MIGRATIONS: list[tuple[str, ...]] = [
+    (
+        """
+        CREATE TABLE IF NOT EXISTS memories (
+            memory_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            memory TEXT UNIQUE
+        )
+        """,
+    ),
+    (
+        """
+        CREATE TABLE memory_journal (
+            sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+            operation TEXT CHECK(operation IN ('add', 'remove')) NOT NULL,
+            memory_id INTEGER NOT NULL
+        )
+        """,
+    ),
+]
+
+
+payload_store = PayloadStore(MEMORY_PAYLOAD_FILE)
+_sync_lock = threading.Lock()
+# journal entries past this sequence are still needed by a rebuild in progress
+_journal_floor: Optional[int] = None
+_embed_failures: dict[int, int] = {}
+_follower: Optional[threading.Thread] = None
+
+
+def memory_index() -> MemoryIndex:
+    return get_index(MEMORY_INDEX_FILE)
+
+
+def initialize_database(rebuild: bool = True):
+    sql.migrate(MEMORY_DB_FILE, MIGRATIONS)
+    _start_follower()
+    # an existing index is only caught up from the journal; the journal is compacted
+    # behind it, so a missing index has to be rebuilt from the memories themselves
+    if os.path.exists(MEMORY_INDEX_FILE) or memory_index().generation:
+        sync_index()
+        return
+    if not memory_index().writer:
+        print("Another process is building the memory index.")
+        return
+    if needs_rebuild():
+        # callers that pass rebuild=False schedule rebuild_database themselves
+        if rebuild:
+            rebuild_database()
+        return
+    index = memory_index()
+    index.replace(_new_index(), generation=_journal_head())
+    index.flush(force=True)
+
 
+def needs_rebuild() -> bool:
+    if os.path.exists(MEMORY_INDEX_FILE) or memory_index().generation:
+        return False
+    with client(MEMORY_DB_FILE) as cursor:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM memories) AS has_memories")
+        return bool(cursor.fetchone()["has_memories"])
+
+
+def add(text: str) -> Optional[int]:
+    memory_ids = add_many([text])
+    return memory_ids[0] if memory_ids else None
 
-def initialize_database():
+
+def add_many(texts: list[str]) -> list[int]:
+    memory_ids: list[int] = []
     with client(MEMORY_DB_FILE) as cursor:
+        for text in dict.fromkeys(texts):
+            cursor.execute(
+                "INSERT OR IGNORE INTO memories (memory) VALUES (?) RETURNING memory_id",
+                (text,),
+            )
+            result = cursor.fetchone()
+            if result is not None:
+                memory_ids.append(result["memory_id"])
+        _journal(cursor, "add", memory_ids)
+    sync_index()
+    return memory_ids
+
+
+def remove(memory_id: int) -> bool:
+    return bool(remove_many([memory_id]))
+
+
+def remove_many(memory_ids: list[int]) -> list[int]:
+    removed: list[int] = []
+    with client(MEMORY_DB_FILE) as cursor:
+        for memory_id in dict.fromkeys(memory_ids):
+            cursor.execute(
+                "DELETE FROM memories WHERE memory_id = ? RETURNING memory_id",
+                (memory_id,),
+            )
+            if cursor.fetchone() is not None:
+                removed.append(memory_id)
+        _journal(cursor, "remove", removed)
+    sync_index()
+    return removed
+
+
+def update(memory_id: int, text: str) -> Optional[int]:
+    # the new text gets a new id, so indexes that can only hide vectors stay correct;
+    # text that is already remembered merges into the existing memory
+    with client(MEMORY_DB_FILE) as cursor:
+        cursor.execute(
+            "DELETE FROM memories WHERE memory_id = ? RETURNING memory_id", (memory_id,)
+        )
+        if cursor.fetchone() is None:
+            return None
         cursor.execute(
             """
-            CREATE TABLE IF NOT EXISTS memories (
-                memory_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                memory TEXT UNIQUE
+            INSERT INTO memories (memory) VALUES (?)
+            ON CONFLICT (memory) DO UPDATE SET memory = excluded.memory
+            RETURNING memory_id
+            """,
+            (text,),
+        )
+        updated_id = cursor.fetchone()["memory_id"]
+        _journal(cursor, "remove", [memory_id])
+        _journal(cursor, "add", [updated_id])
+    sync_index()
+    return updated_id
+
+
+def deduplicate(
+    threshold: float = DEDUPLICATE_THRESHOLD, chunk_size: int = REBUILD_CHUNK_SIZE
+) -> int:
+    sync_index()
+    index = memory_index()
+    duplicates: set[int] = set()
+    for chunk in _page_memories(0, chunk_size):
+        chunk = [
+            (memory_id, text) for memory_id, text in chunk if memory_id not in duplicates
+        ]
+        vectors, ids = _vectors(chunk)
+        if not ids.size:
+            continue
+        distances, neighbours = index.search(vectors, DEDUPLICATE_NEIGHBOURS + 1)
+        found: set[int] = set()
+        for memory_id, row_distances, row_neighbours in zip(
+            ids.tolist(), distances, neighbours
+        ):
+            if memory_id in found:
+                continue
+            # the oldest memory of a near-duplicate group is the one kept
+            found.update(
+                int(neighbour)
+                for distance, neighbour in zip(row_distances, row_neighbours)
+                if neighbour > memory_id and 1.0 - distance / 2 >= threshold
             )
-        """
+        found -= duplicates
+        if found:
+            remove_many(sorted(found))
+            duplicates |= found
+    print(f"Removed {len(duplicates):,} near-duplicate memories.")
+    return len(duplicates)
+
+
+def compact_payloads() -> bool:
+    # only the process writing the index writes the payload store
+    if not USE_PAYLOAD_STORE or not memory_index().writer:
+        return False
+    with _sync_lock:
+        return payload_store.compact()
+
+
+def _vectors(chunk: list[tuple[int, str]]) -> tuple[np.ndarray, np.ndarray]:
+    ids = [memory_id for memory_id, _ in chunk]
+    if ids:
+        try:
+            vectors = memory_index().reconstruct(ids)
+        except RuntimeError:
+            vectors = None
+        if vectors is not None:
+            return vectors, np.array(ids, dtype=np.int64)
+    return _embed_chunk(chunk)
+
+
+def sync_index() -> int:
+    with _sync_lock:
+        index = memory_index()
+        if not index.writer:
+            # the writing process applies the journal; this one picks up its flushes
+            return index.generation
+        with client(MEMORY_DB_FILE) as cursor:
+            cursor.execute(
+                """
+                SELECT
+                    memory_journal.sequence,
+                    memory_journal.operation,
+                    memory_journal.memory_id,
+                    memories.memory
+                FROM memory_journal
+                LEFT JOIN memories USING (memory_id)
+                WHERE memory_journal.sequence > ?
+                ORDER BY memory_journal.sequence
+                """,
+                (index.generation,),
+            )
+            entries = cursor.fetchall()
+
+        if entries:
+            _apply_journal(index, entries)
+        _compact_journal(index)
+        return index.generation
+
+
+def follow_index() -> None:
+    index = memory_index()
+    if index.refresh() and USE_PAYLOAD_STORE:
+        # texts the writer stored since this process loaded the payload table
+        payload_store.close()
+    if not index.writer:
+        return
+    # memories journaled by other processes, published for their searches
+    sync_index()
+    if index.generation != index.persisted_generation and index.has_readers():
+        index.flush(force=True)
+
+
+def _follow_loop() -> None:
+    while True:
+        time.sleep(INDEX_FOLLOW_SECONDS)
+        try:
+            follow_index()
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            print(f"Could not follow memory index: {error}")
+
+
+def _start_follower() -> None:
+    global _follower  # pylint: disable=global-statement
+    if INDEX_FOLLOW_SECONDS <= 0 or (_follower is not None and _follower.is_alive()):
+        return
+    _follower = threading.Thread(target=_follow_loop, name="index-follower", daemon=True)
+    _follower.start()
+
+
+def _apply_journal(index: MemoryIndex, entries: list[dict]) -> None:
+    generation = entries[-1]["sequence"]
+    sequences: dict[int, int] = {}
+    additions: list[tuple[int, str]] = []
+    for entry in entries:
+        # an add whose row is gone was removed again later in the journal
+        if entry["operation"] == "add" and entry["memory"] is not None:
+            sequences.setdefault(entry["memory_id"], entry["sequence"])
+            additions.append((entry["memory_id"], entry["memory"]))
+    removals = sorted(
+        {entry["memory_id"] for entry in entries if entry["operation"] == "remove"}
+    )
+
+    # replaying after a crash must not index a memory twice
+    indexed = index.contains([memory_id for memory_id, _ in additions])
+    additions = [
+        (memory_id, text)
+        for memory_id, text in dict(additions).items()
+        if memory_id not in indexed
+    ]
+    progress = _Progress("Indexed", len(additions))
+    for start in range(0, len(additions), REBUILD_CHUNK_SIZE):
+        chunk = additions[start : start + REBUILD_CHUNK_SIZE]
+        embeddings, ids = _embed_chunk(chunk)
+        if ids.size:
+            index.add(embeddings, ids)
+        failed = {memory_id for memory_id, _ in chunk} - set(ids.tolist())
+        for memory_id in ids.tolist():
+            _embed_failures.pop(memory_id, None)
+        retried = _count_embed_failures(failed)
+        if retried:
+            # retry from the first memory that could not be embedded on the next sync
+            first_failure = min(sequences[memory_id] for memory_id in retried)
+            generation = min(generation, first_failure - 1)
+        if USE_PAYLOAD_STORE:
+            payload_store.put_many(chunk)
+        if len(additions) > REBUILD_CHUNK_SIZE:
+            progress.update(len(chunk))
+
+    if removals:
+        index.remove(removals)
+        if USE_PAYLOAD_STORE:
+            payload_store.remove_many(removals)
+    index.set_generation(generation)
+
+
+def _count_embed_failures(failed: set[int]) -> set[int]:
+    # one text the embedder always rejects must not hold back the generation, and with
+    # it journal compaction, for good
+    given_up = set()
+    for memory_id in failed:
+        _embed_failures[memory_id] = _embed_failures.get(memory_id, 0) + 1
+        if _embed_failures[memory_id] >= EMBED_ATTEMPTS:
+            given_up.add(memory_id)
+            del _embed_failures[memory_id]
+    if given_up:
+        print(
+            f"Could not embed {len(given_up)} memories in {EMBED_ATTEMPTS} attempts; "
+            "leaving them out of the index until it is rebuilt."
         )
-    index = construct_index()
-    faiss.write_index(faiss.IndexIDMap(index), MEMORY_INDEX_FILE)
+    return failed - given_up
+
+
+def _journal(cursor, operation: str, memory_ids: list[int]) -> None:
+    cursor.executemany(
+        "INSERT INTO memory_journal (operation, memory_id) VALUES (?, ?)",
+        [(operation, memory_id) for memory_id in memory_ids],
+    )
+
+
+def _journal_head() -> int:
+    with client(MEMORY_DB_FILE) as cursor:
+        cursor.execute("SELECT COALESCE(MAX(sequence), 0) AS head FROM memory_journal")
+        return cursor.fetchone()["head"]
 
 
-def add(text):
+def _journal_tail() -> int:
+    with client(MEMORY_DB_FILE) as cursor:
+        cursor.execute("SELECT MIN(sequence) AS tail FROM memory_journal")
+        tail = cursor.fetchone()["tail"]
+    return _journal_head() + 1 if tail is None else tail
+
+
+def _compact_journal(index: MemoryIndex) -> None:
+    # only entries the index has already persisted are safe to forget
+    compact_through = index.persisted_generation
+    if _journal_floor is not None:
+        compact_through = min(compact_through, _journal_floor)
     with client(MEMORY_DB_FILE) as cursor:
         cursor.execute(
-            "INSERT OR IGNORE INTO memories (memory) VALUES (?) RETURNING memory_id",
-            (text,),
+            "DELETE FROM memory_journal WHERE sequence <= ?", (compact_through,)
         )
-        result = cursor.fetchone()
-        if result is None:
-            return
-        memory_id = result["memory_id"]
-
-        embedding = embed(text)
-        index = faiss.read_index(MEMORY_INDEX_FILE)
-        if not isinstance(index, faiss.IndexIDMap):
-            index = faiss.IndexIDMap(index)
-        index.add_with_ids(
-            np.array([embedding], dtype=np.float32),
-            np.array([memory_id], dtype=np.int64),
-        )
-        faiss.write_index(index, MEMORY_INDEX_FILE)
 
 
 def fetch_relevant_memories(
-    query: str, broad_search: bool = False, k: int = 3
-) -> tuple[list[str], list[float]]:
+    query: str,
+    broad_search: bool = False,
+    k: int = 3,
+    embedding: Optional[np.ndarray] = None,
+    token_budget: int = BROAD_TOKEN_BUDGET,
+    ef_search: Optional[int] = None,
+    nprobe: Optional[int] = None,
+) -> list[MemoryResult]:
+    if embedding is None:
+        try:
+            embedding = embed(query)
+        except EmbeddingSizeError as error:
+            # searched as if the embedding backend were down
+            print(f"Could not embed memory query: {error}")
+
     if broad_search:
+        results = _fetch_broad_memories(embedding, token_budget)
+    elif embedding is None:
+        results = []
+    else:
+        _distances, _indices = memory_index().search(
+            np.array([embedding], dtype=np.float32), k, ef_search=ef_search, nprobe=nprobe
+        )
+        results = _resolve(_indices[0], _distances[0])
+    return results
+
+
+def _resolve(memory_ids: np.ndarray, distances: np.ndarray) -> list[MemoryResult]:
+    hits = [
+        (int(memory_id), float(distance))
+        for memory_id, distance in zip(memory_ids, distances)
+        if memory_id != -1
+    ]
+    texts = fetch_memory_texts([memory_id for memory_id, _ in hits])
+    # squared L2 between unit vectors, mapped back onto cosine similarity
+    return [
+        {"memory_id": memory_id, "score": 1.0 - distance / 2, "memory": texts[memory_id]}
+        for memory_id, distance in hits
+        if memory_id in texts
+    ]
+
+
+def _fetch_broad_memories(
+    embedding: Optional[np.ndarray], token_budget: int
+) -> list[MemoryResult]:
+    if embedding is None:
         with client(MEMORY_DB_FILE) as cursor:
-            cursor.execute("SELECT memory FROM memories")
-            memories = cursor.fetchall()
-        results: list[str] = [memory["memory"] for memory in memories]
-        distances = [-1.0] * len(results)
-        print(f"Memories found: {len(results):,}")
-        return results, distances
-
-    index = faiss.read_index(MEMORY_INDEX_FILE)
-    print("emedding memory query")
-    embedding = embed(query)
-    print("searching")
-    _distances, _indices = index.search(np.array([embedding], dtype=np.float32), k)
-
-    distances = _distances[0]
-    indices = _indices[0]
-
-    print("finding memories")
-    results = []
+            cursor.execute(
+                "SELECT memory_id, memory FROM memories ORDER BY memory_id DESC LIMIT ?",
+                (BROAD_CANDIDATES,),
+            )
+            records = cursor.fetchall()
+        return _within_budget(
+            [
+                {
+                    "memory_id": record["memory_id"],
+                    "score": 0.0,
+                    "memory": record["memory"],
+                }
+                for record in records
+            ],
+            token_budget,
+        )
+
+    _distances, _indices = memory_index().search(
+        np.array([embedding], dtype=np.float32), BROAD_CANDIDATES
+    )
+    candidates = _resolve(_indices[0], _distances[0])
+    if not candidates:
+        return []
+
+    vectors = memory_index().reconstruct([result["memory_id"] for result in candidates])
+    if vectors is None:
+        embeddings = embed_many([result["memory"] for result in candidates])
+        candidates = [
+            result for result, vector in zip(candidates, embeddings) if vector is not None
+        ]
+        if not candidates:
+            return []
+        vectors = np.vstack([vector for vector in embeddings if vector is not None])
+
+    order = _select_diverse(
+        embedding,
+        vectors,
+        [count_tokens(result["memory"]) for result in candidates],
+        token_budget,
+    )
+    return [candidates[position] for position in order]
+
+
+def fetch_memory_texts(memory_ids: list[int]) -> dict[int, str]:
+    texts = payload_store.get_many(memory_ids) if USE_PAYLOAD_STORE else {}
+    missing = [memory_id for memory_id in memory_ids if memory_id not in texts]
+    if not missing:
+        return texts
+
+    placeholders = ", ".join("?" * len(missing))
     with client(MEMORY_DB_FILE) as cursor:
-        for memory_id in indices:
-            if memory_id != -1:
-                cursor.execute(
-                    "SELECT memory FROM memories WHERE memory_id = ?", (int(memory_id),)
-                )
-                memory = cursor.fetchone()
-                if memory:
-                    results.append(memory["memory"])
-    print(f"Memories found: {len(results):,}")
-    return results, distances
+        cursor.execute(
+            f"SELECT memory_id, memory FROM memories WHERE memory_id IN ({placeholders})",
+            missing,
+        )
+        found = {record["memory_id"]: record["memory"] for record in cursor.fetchall()}
+    # only the process writing the index appends to the payload store
+    if USE_PAYLOAD_STORE and found and memory_index().writer:
+        payload_store.put_many(found.items())
+    texts.update(found)
+    return texts
 
 
-def rebuild_database():
+def _select_diverse(
+    query: np.ndarray,
+    vectors: np.ndarray,
+    token_counts: list[int],
+    token_budget: int,
+    relevance_weight: float = BROAD_RELEVANCE_WEIGHT,
+) -> list[int]:
+    # maximal marginal relevance, greedily filling the token budget
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    relevance = vectors @ query
+    redundancy = np.zeros(len(vectors), dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+    selected: list[int] = []
+    remaining_budget = token_budget
+
+    while remaining_budget > 0 and available.any():
+        scores = relevance_weight * relevance - (1 - relevance_weight) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        available[best] = False
+        if token_counts[best] > remaining_budget:
+            continue
+        selected.append(best)
+        remaining_budget -= token_counts[best]
+        redundancy = np.maximum(redundancy, vectors @ vectors[best])
+    return selected
+
+
+def _within_budget(results: list[MemoryResult], token_budget: int) -> list[MemoryResult]:
+    selected = []
+    for result in results:
+        tokens = count_tokens(result["memory"])
+        if tokens <= token_budget:
+            selected.append(result)
+            token_budget -= tokens
+    return selected
+
+
+def rebuild_database(
+    chunk_size: int = REBUILD_CHUNK_SIZE, resume: bool = True
+) -> Optional[int]:
+    global _journal_floor  # pylint: disable=global-statement
+
+    if not memory_index().writer:
+        print("Another process is writing the memory index. Skipping index rebuild.")
+        return None
+
     with client(MEMORY_DB_FILE) as cursor:
-        cursor.execute("SELECT memory_id, memory FROM memories")
-        memories = cursor.fetchall()
+        cursor.execute("SELECT COUNT(*) AS total FROM memories")
+        total = cursor.fetchone()["total"]
 
-    if not memories:
+    if not total:
         print("No memories found. Skipping index rebuild.")
-        return
+        return None
 
-    embeddings = []
-    ids = []
-    for memory in memories:
-        embeddings.append(embed(memory["memory"]))
-        ids.append(memory["memory_id"])
+    index, last_memory_id, done, generation = (
+        _load_rebuild_checkpoint() if resume else (None, 0, 0, 0)
+    )
+    if index is not None and generation < _journal_tail() - 1:
+        print("Memory journal moved past the rebuild checkpoint; starting over.")
+        index = None
+    if index is None:
+        # rows changed after this point are replayed from the journal once rebuilt
+        index, last_memory_id, done, generation = _new_index(), 0, 0, _journal_head()
+    else:
+        print(f"Resuming index rebuild after memory {last_memory_id} ({done:,} done).")
+
+    _journal_floor = generation
+    try:
+        progress = _Progress("Embedded", total, done)
+        last_checkpoint = time.monotonic()
+        for chunk in _page_memories(last_memory_id, chunk_size):
+            embeddings, ids = _embed_chunk(chunk)
+            if ids.size:
+                # pylint: disable-next=no-value-for-parameter
+                index.add_with_ids(embeddings, ids)
+            if USE_PAYLOAD_STORE:
+                payload_store.put_many(
+                    [
+                        (memory_id, text)
+                        for memory_id, text in chunk
+                        if memory_id not in payload_store
+                    ]
+                )
+            last_memory_id = chunk[-1][0]
+            progress.update(len(chunk))
+
+            if time.monotonic() - last_checkpoint >= REBUILD_CHECKPOINT_SECONDS:
+                _save_rebuild_checkpoint(index, last_memory_id, progress.done, generation)
+                last_checkpoint = time.monotonic()
+
+        with _sync_lock:
+            memory_index().replace(index, generation=generation)
+            memory_index().flush(force=True)
+    finally:
+        _journal_floor = None
+    sync_index()
+    _clear_rebuild_checkpoint()
+    print(f"Rebuilt memory index with {index.ntotal:,} memories.")
+    return index.ntotal
 
+
+def _new_index():
     index = construct_index()
-    index = faiss.IndexIDMap(index)
-    index.add_with_ids(  # pylint: disable=no-value-for-parameter
-        np.vstack(embeddings).astype(np.float32),
-        np.array(ids, dtype=np.int64),
+    if not index.is_trained:
+        index = train_index(index, _training_sample())
+    return faiss.IndexIDMap2(index)
+
+
+def _training_sample() -> np.ndarray:
+    with client(MEMORY_DB_FILE) as cursor:
+        cursor.execute(
+            "SELECT memory FROM memories ORDER BY RANDOM() LIMIT ?",
+            (TRAINING_SAMPLE_SIZE,),
+        )
+        texts = [record["memory"] for record in cursor.fetchall()]
+    embeddings = [embedding for embedding in embed_many(texts) if embedding is not None]
+    if not embeddings:
+        return np.empty((0, EMBEDDING_SIZE), dtype=np.float32)
+    print(f"Training memory index on {len(embeddings):,} memories.")
+    return np.vstack(embeddings).astype(np.float32)
+
+
+class _Progress:
+    def __init__(self, verb: str, total: int, done: int = 0):
+        self.verb = verb
+        self.total = total
+        self.done = done
+        self._started_at = time.monotonic()
+        self._started_from = done
+
+    def update(self, count: int) -> None:
+        self.done += count
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        rate = (self.done - self._started_from) / elapsed
+        print(
+            f"{self.verb} {self.done:,}/{self.total:,} memories "
+            f"({rate:,.1f} memories/sec)"
+        )
+
+
+def _page_memories(
+    after_memory_id: int, chunk_size: int
+) -> Iterator[list[tuple[int, str]]]:
+    while True:
+        with client(MEMORY_DB_FILE) as cursor:
+            cursor.execute(
+                """
+                SELECT memory_id, memory
+                FROM memories
+                WHERE memory_id > ?
+                ORDER BY memory_id
+                LIMIT ?
+                """,
+                (after_memory_id, chunk_size),
+            )
+            records = cursor.fetchall()
+        if not records:
+            return
+        yield [(record["memory_id"], record["memory"]) for record in records]
+        after_memory_id = records[-1]["memory_id"]
+
+
+def _embed_chunk(chunk: list[tuple[int, str]]) -> tuple[np.ndarray, np.ndarray]:
+    embeddings = embed_many([text for _, text in chunk])
+    embedded = [
+        (memory_id, embedding)
+        for (memory_id, _), embedding in zip(chunk, embeddings)
+        if embedding is not None
+    ]
+    if len(embedded) < len(chunk):
+        print(f"Could not embed {len(chunk) - len(embedded)} memories; skipping them.")
+    if not embedded:
+        return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+    return (
+        np.vstack([embedding for _, embedding in embedded]).astype(np.float32),
+        np.array([memory_id for memory_id, _ in embedded], dtype=np.int64),
     )
 
-    faiss.write_index(index, MEMORY_INDEX_FILE)
-    print(f"Rebuilt SQLite database with {len(memories)} memories.")
+
+def _load_rebuild_checkpoint():
+    if not all(map(os.path.exists, (REBUILD_CHECKPOINT_FILE, REBUILD_INDEX_FILE))):
+        return None, 0, 0, 0
+    with open(REBUILD_CHECKPOINT_FILE, encoding="utf-8") as file:
+        checkpoint = json.load(file)
+    index = faiss.read_index(REBUILD_INDEX_FILE)
+    return (
+        index,
+        checkpoint["last_memory_id"],
+        checkpoint["done"],
+        checkpoint.get("generation", 0),
+    )
+
+
+def _save_rebuild_checkpoint(
+    index, last_memory_id: int, done: int, generation: int
+) -> None:
+    write_atomic(REBUILD_INDEX_FILE, faiss.serialize_index(index))
+    checkpoint = json.dumps(
+        {"last_memory_id": last_memory_id, "done": done, "generation": generation}
+    )
+    write_atomic(REBUILD_CHECKPOINT_FILE, checkpoint.encode("utf-8"))
+
+
+def _clear_rebuild_checkpoint() -> None:
+    for filepath in (REBUILD_CHECKPOINT_FILE, REBUILD_INDEX_FILE):
+        if os.path.exists(filepath):
+            os.remove(filepath)
 
 
 def is_memorable(prompt: str) -> tuple[bool, str]:
+    if _is_trivial(prompt):
+        decision_cache.skip()
+        return False, "None"
+
     text = f"""
 Analyze the following text. If it contains important facts, user preferences, habits, or recurring behaviors, summarize just the key takeaways in a concise format.
 Otherwise, respond with only the word 'None'.
@@ -117,14 +738,30 @@ Otherwise, respond with only the word 'None'.
 Text:
 {prompt}
     """.strip()
-    summary = "".join(query_decision_agent(text))
+    summary = decide(text)
     return "none" not in summary.lower(), summary.strip()
 
 
+def _is_trivial(prompt: str) -> bool:
+    words = re.sub(r"[^\w\s']", " ", prompt.lower()).split()
+    return len(words) < MEMORABLE_MIN_WORDS or " ".join(words) in TRIVIAL_MESSAGES
+
+
 def _destroy_database():
+    close_index(MEMORY_INDEX_FILE, flush=False)
+    payload_store.destroy()
     with client(MEMORY_DB_FILE) as cursor:
+        cursor.execute("DROP TABLE IF EXISTS memory_journal")
         cursor.execute("DROP TABLE IF EXISTS memories")
+    sql.close(MEMORY_DB_FILE)
 
-    for filepath in (MEMORY_DB_FILE, MEMORY_INDEX_FILE):
+    for filepath in (
+        MEMORY_DB_FILE,
+        f"{MEMORY_DB_FILE}-wal",
+        f"{MEMORY_DB_FILE}-shm",
+        MEMORY_INDEX_FILE,
+        f"{MEMORY_INDEX_FILE}.removed",
+        f"{MEMORY_INDEX_FILE}.generation",
+    ):
         if os.path.exists(filepath):
             os.remove(filepath)
@@ -1,14 +1,23 @@
-from typing import TypedDict, Generator
+from abc import ABC, abstractmethod
+from typing import AsyncGenerator, Callable, Generator, Optional, TypedDict
+import asyncio
 import copy
 import os
+import threading
+import time
+import weakref
 
-import openai
-import anthropic
-import ollama
-from tenacity import retry, stop_after_attempt, wait_fixed
-
+from . import cancellation as cancellations
+from . import tracing
+from ._lazy import lazy_import
+from ._decisions import decision_cache
+from .cancellation import Cancelled, CancellationToken
 from .types import Role, Model
 
+openai = lazy_import("openai")
+anthropic = lazy_import("anthropic")
+ollama = lazy_import("ollama")
+
 
 class ChatMessage(TypedDict):
     role: Role
@@ -37,10 +46,360 @@ MODELS: list[Model] = [
     },
     {"name": "Mistal-7b (Local)", "model_id": "mistral", "client_id": "ollama"},
 ]
+CONTEXT_TOKENS: dict[str, int] = {
+    "gpt-4o": 128_000,
+    "gpt-3.5-turbo": 16_385,
+    "claude-3-5-sonnet-latest": 200_000,
+    "claude-3-5-haiku-latest": 200_000,
+    # ollama truncates to its num_ctx rather than the model's trained window
+    "mistral": 4_096,
+}
+DEFAULT_CONTEXT_TOKENS = 4_096
 DECISION_MODEL = "mistral"
+DECISION_SYSTEM_PROMPT = "You are trying to help the user classify text."
+SUMMARY_MODEL = "mistral"
 MODEL_LOOKUP: dict[str, Model] = {model["model_id"]: model for model in MODELS}
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-ANTHROPIC_API_KEY = os.getenv("OPENAI_API_KEY")
+ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+# point these at local fake servers to exercise the providers offline
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL")
+OLLAMA_HOST = os.getenv("OLLAMA_HOST")
+ANTHROPIC_MAX_TOKENS = 1024
+PROVIDER_CONCURRENCY = {"openai": 8, "anthropic": 8, "ollama": 2}
+DEFAULT_PROVIDER_CONCURRENCY = 4
+PROVIDER_TIMEOUT_SECONDS = 60.0
+PROVIDER_ATTEMPTS = 3
+PROVIDER_RETRY_WAIT_SECONDS = 2.0
+
+
+class Provider(ABC):
+    def __init__(
+        self,
+        name: str,
+        concurrency: Optional[int] = None,
+        timeout_seconds: Optional[float] = None,
+        attempts: int = PROVIDER_ATTEMPTS,
+        retry_wait_seconds: float = PROVIDER_RETRY_WAIT_SECONDS,
+    ):
+        self.name = name
+        self.concurrency = concurrency or int(
+            os.getenv(
+                f"ROOTS_{name.upper()}_CONCURRENCY",
+                PROVIDER_CONCURRENCY.get(name, DEFAULT_PROVIDER_CONCURRENCY),
+            )
+        )
+        self.timeout_seconds = timeout_seconds or float(
+            os.getenv(f"ROOTS_{name.upper()}_TIMEOUT", str(PROVIDER_TIMEOUT_SECONDS))
+        )
+        self.attempts = attempts
+        self.retry_wait_seconds = retry_wait_seconds
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._async_slots: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self._connect()
+            return self._client
+
+    @property
+    def async_client(self):
+        with self._lock:
+            if self._async_client is None:
+                self._async_client = self._connect_async()
+            return self._async_client
+
+    @abstractmethod
+    def _connect(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _connect_async(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _stream(
+        self,
+        model_id: str,
+        messages: list[ChatMessage],
+        cancellation: Optional[CancellationToken] = None,
+    ) -> ModelIterResponse:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def _astream(
+        self, model_id: str, messages: list[ChatMessage]
+    ) -> AsyncGenerator[str, None]:
+        # the yield makes this an async generator, like the implementations
+        raise NotImplementedError
+        yield  # pylint: disable=unreachable
+
+    def stream(
+        self,
+        model_id: str,
+        messages: list[ChatMessage],
+        cancellation: Optional[CancellationToken] = None,
+    ) -> ModelIterResponse:
+        cancellation = cancellation or cancellations.current()
+        requested_at = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout_seconds):
+            raise TimeoutError(f"No {self.name} connection free")
+        try:
+            for attempt in range(1, self.attempts + 1):
+                started = False
+                rate: Optional[_TokenRate] = None
+                tokens = self._stream(model_id, messages, cancellation)
+                try:
+                    for token in tokens:
+                        if cancellation is not None:
+                            cancellation.raise_if_cancelled()
+                        # an empty role chunk shows the caller nothing, so a retry is safe
+                        if not token:
+                            continue
+                        started = True
+                        if rate is None:
+                            rate = _TokenRate(self.name, requested_at)
+                        rate.count += 1
+                        yield token
+                    # a response closed by a cancel may simply end early
+                    if cancellation is not None:
+                        cancellation.raise_if_cancelled()
+                    return
+                except Cancelled:
+                    raise
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    # or fail its read, which is no reason to retry
+                    if cancellation is not None:
+                        cancellation.raise_if_cancelled()
+                    # once tokens reach the caller a retry would repeat them
+                    if started or attempt == self.attempts:
+                        raise
+                    print(f"{self.name} failed before streaming, retrying: {error}")
+                    time.sleep(self.retry_wait_seconds * attempt)
+                finally:
+                    # closes the underlying HTTP stream so the server stops generating
+                    tokens.close()
+                    if rate is not None:
+                        rate.finish()
+        finally:
+            self._slots.release()
+
+    async def astream(
+        self,
+        model_id: str,
+        messages: list[ChatMessage],
+        cancellation: Optional[CancellationToken] = None,
+    ) -> AsyncGenerator[str, None]:
+        cancellation = cancellation or cancellations.current()
+        loop = asyncio.get_running_loop()
+        slots = self._async_slots.setdefault(loop, asyncio.Semaphore(self.concurrency))
+        await asyncio.wait_for(slots.acquire(), self.timeout_seconds)
+        try:
+            for attempt in range(1, self.attempts + 1):
+                started = False
+                tokens = self._astream(model_id, messages)
+                try:
+                    async for token in tokens:
+                        if cancellation is not None:
+                            cancellation.raise_if_cancelled()
+                        if not token:
+                            continue
+                        started = True
+                        yield token
+                    return
+                except Cancelled:
+                    raise
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    if started or attempt == self.attempts:
+                        raise
+                    print(f"{self.name} failed before streaming, retrying: {error}")
+                    await asyncio.sleep(self.retry_wait_seconds * attempt)
+                finally:
+                    await tokens.aclose()  # type: ignore
+        finally:
+            slots.release()
+
+    def _close_on_cancel(
+        self, cancellation: Optional[CancellationToken], close: Callable[[], None]
+    ) -> None:
+        # otherwise a cancel is only seen with the next token, which can be the whole
+        # time to first token away, while the server keeps generating
+        if cancellation is None:
+            return
+
+        def close_quietly() -> None:
+            try:
+                close()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                print(f"{self.name} stream did not close on cancel: {error}")
+
+        cancellation.on_cancel(close_quietly)
+
+
+class _TokenRate:
+    def __init__(self, provider: str, requested_at: float):
+        self.provider = provider
+        self.count = 0
+        self.first_token_at = time.perf_counter()
+        tracing.record("model_first_token", self.first_token_at - requested_at)
+
+    def finish(self) -> None:
+        seconds = time.perf_counter() - self.first_token_at
+        if self.count > 1 and seconds > 0:
+            # the first token starts the clock, so it is not counted in the rate
+            tracing.observe(
+                "tokens_per_second", (self.count - 1) / seconds, provider=self.provider
+            )
+
+
+class OpenAIProvider(Provider):
+    def _connect(self):
+        return openai.OpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            timeout=self.timeout_seconds,
+            max_retries=0,
+        )
+
+    def _connect_async(self):
+        return openai.AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            timeout=self.timeout_seconds,
+            max_retries=0,
+        )
+
+    def _stream(
+        self,
+        model_id: str,
+        messages: list[ChatMessage],
+        cancellation: Optional[CancellationToken] = None,
+    ) -> ModelIterResponse:
+        response = self.client.chat.completions.create(
+            model=model_id,
+            messages=messages,  # type: ignore
+            temperature=0.7,
+            stream=True,
+        )
+        self._close_on_cancel(cancellation, response.close)
+        try:
+            for chunk in response:
+                if chunk.choices:
+                    yield chunk.choices[0].delta.content or ""  # type: ignore
+        finally:
+            response.close()
+
+    async def _astream(
+        self, model_id: str, messages: list[ChatMessage]
+    ) -> AsyncGenerator[str, None]:
+        response = await self.async_client.chat.completions.create(
+            model=model_id,
+            messages=messages,  # type: ignore
+            temperature=0.7,
+            stream=True,
+        )
+        try:
+            async for chunk in response:
+                if chunk.choices:
+                    yield chunk.choices[0].delta.content or ""  # type: ignore
+        finally:
+            await response.close()
+
+
+class AnthropicProvider(Provider):
+    def _connect(self):
+        return anthropic.Anthropic(
+            api_key=ANTHROPIC_API_KEY,
+            base_url=ANTHROPIC_BASE_URL,
+            timeout=self.timeout_seconds,
+            max_retries=0,
+        )
+
+    def _connect_async(self):
+        return anthropic.AsyncAnthropic(
+            api_key=ANTHROPIC_API_KEY,
+            base_url=ANTHROPIC_BASE_URL,
+            timeout=self.timeout_seconds,
+            max_retries=0,
+        )
+
+    def _stream(
+        self,
+        model_id: str,
+        messages: list[ChatMessage],
+        cancellation: Optional[CancellationToken] = None,
+    ) -> ModelIterResponse:
+        with self.client.messages.stream(
+            model=model_id,
+            messages=messages,  # type: ignore
+            max_tokens=ANTHROPIC_MAX_TOKENS,
+        ) as stream:
+            self._close_on_cancel(cancellation, stream.close)
+            yield from stream.text_stream
+
+    async def _astream(
+        self, model_id: str, messages: list[ChatMessage]
+    ) -> AsyncGenerator[str, None]:
+        async with self.async_client.messages.stream(
+            model=model_id,
+            messages=messages,  # type: ignore
+            max_tokens=ANTHROPIC_MAX_TOKENS,
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+
+
+class OllamaProvider(Provider):
+    def _connect(self):
+        return ollama.Client(host=OLLAMA_HOST, timeout=self.timeout_seconds)
+
+    def _connect_async(self):
+        return ollama.AsyncClient(host=OLLAMA_HOST, timeout=self.timeout_seconds)
+
+    def _stream(
+        self,
+        model_id: str,
+        messages: list[ChatMessage],
+        cancellation: Optional[CancellationToken] = None,
+    ) -> ModelIterResponse:
+        # ollama hands back a generator, which cannot be closed from the thread that
+        # cancels while it is running, so a cancel here waits for the next chunk
+        response = self.client.chat(model=model_id, messages=messages, stream=True)
+        try:
+            for chunk in response:
+                yield chunk.message.content or ""
+        finally:
+            response.close()
+
+    async def _astream(
+        self, model_id: str, messages: list[ChatMessage]
+    ) -> AsyncGenerator[str, None]:
+        response = await self.async_client.chat(
+            model=model_id, messages=messages, stream=True
+        )
+        try:
+            async for chunk in response:
+                yield chunk.message.content or ""
+        finally:
+            await response.aclose()
+
+
+providers: dict[str, Provider] = {
+    "openai": OpenAIProvider("openai"),
+    "anthropic": AnthropicProvider("anthropic"),
+    "ollama": OllamaProvider("ollama"),
+}
+
+
+def register_provider(client_id: str, provider: Provider) -> None:
+    providers[client_id] = provider
 
 
 def initialize() -> dict[str, bool]:
@@ -56,72 +415,79 @@ def _check_model(model_id: str) -> bool:
 
 
 def query_ollama(model_id: str, messages: list[ChatMessage]) -> ModelIterResponse:
-    response = ollama.chat(model=model_id, messages=messages, stream=True)
-    for chunk in response:
-        yield chunk.message.content or ""
+    return providers["ollama"].stream(model_id, messages)
 
 
 def query_openai(model_id: str, messages: list[ChatMessage]) -> ModelIterResponse:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    response = client.chat.completions.create(
-        model=model_id,
-        messages=messages,  # type: ignore
-        temperature=0.7,
-        stream=True,
-    )
-    for chunk in response:
-        yield chunk.choices[0].delta.content or ""  # type: ignore
-
-
-def query_anthropic(
-    model_id: str, messages: list[ChatMessage], max_tokens: int = 1024
-) -> ModelIterResponse:
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-    with client.messages.stream(
-        model=model_id,
-        messages=messages,  # type: ignore
-        max_tokens=max_tokens,
-    ) as stream:
-        yield from stream.text_stream
+    return providers["openai"].stream(model_id, messages)
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-def query(model_id: str, messages: list[ChatMessage]) -> ModelIterResponse:
-    model = MODEL_LOOKUP[model_id]
-    client = model["client_id"]
+def query_anthropic(model_id: str, messages: list[ChatMessage]) -> ModelIterResponse:
+    return providers["anthropic"].stream(model_id, messages)
 
-    if client == "openai":
-        return query_openai(model_id, messages)
 
-    if client == "anthropic":
-        return query_anthropic(model_id, messages)
+def _provider(model_id: str) -> Provider:
+    client = MODEL_LOOKUP[model_id]["client_id"]
+    if client not in providers:
+        raise ValueError(f"Unknown model client: {client}")
+    return providers[client]
+
+
+def query(
+    model_id: str,
+    messages: list[ChatMessage],
+    cancellation: Optional[CancellationToken] = None,
+) -> ModelIterResponse:
+    return _provider(model_id).stream(model_id, messages, cancellation)
 
-    if client == "ollama":
-        return query_ollama(model_id, messages)
 
-    raise ValueError(f"Unknown model client: {client}")
+def query_async(
+    model_id: str,
+    messages: list[ChatMessage],
+    cancellation: Optional[CancellationToken] = None,
+) -> AsyncGenerator[str, None]:
+    return _provider(model_id).astream(model_id, messages, cancellation)
 
 
 def query_decision_agent(prompt: str) -> ModelIterResponse:
     messages: list[ChatMessage] = [
-        {"role": "system", "content": "You are trying to help the user classify text."},
+        {"role": "system", "content": DECISION_SYSTEM_PROMPT},
         {"role": "user", "content": prompt},
     ]
     return query_ollama(DECISION_MODEL, messages=messages)
 
 
+def decide(prompt: str) -> str:
+    key = decision_cache.key(DECISION_MODEL, DECISION_SYSTEM_PROMPT, prompt)
+    cached = decision_cache.get(key)
+    if cached is not None:
+        return cached
+
+    started_at = time.perf_counter()
+    with tracing.span("decision"):
+        response = "".join(query_decision_agent(prompt))
+    decision_cache.put(key, response, time.perf_counter() - started_at)
+    return response
+
+
 def available_models() -> list[Model]:
     # model_availability = initialize()
     # return [model for model in MODELS if model_availability[model["name"]]]
     return MODELS
 
 
-def summarize_history(history: list[ChatMessage]) -> list[ChatMessage]:
+def context_tokens(model_id: str) -> int:
+    return CONTEXT_TOKENS.get(model_id, DEFAULT_CONTEXT_TOKENS)
+
+
+def summarize_history(history: list[ChatMessage], summary: str = "") -> str:
     messages = copy.deepcopy(history)
+    if summary:
+        summary = f"Summary of our earlier conversation:\n{summary}"
+        messages.insert(0, {"role": "user", "content": summary})
     sumarization_request = """
-    Summarize our entire conversation so far into 2000 words or fewer, so that another
+    Summarize our entire conversation so far into 500 words or fewer, so that another
     LLM can continue our conversation from where we left off.
     """.strip()
-    history.append({"role": "user", "content": sumarization_request})
-    summarized_history = "".join(query_ollama(model_id="mistral", messages=messages))
-    return [{"role": "assistant", "content": summarized_history}]
+    messages.append({"role": "user", "content": sumarization_request})
+    return "".join(query_ollama(model_id=SUMMARY_MODEL, messages=messages)).strip()
@@ -0,0 +1,124 @@
+import time
+from typing import Any, Iterator
+
+import socketio  # type: ignore
+
+from . import sql
+
+
+MESSAGE_QUEUE_POLL_SECONDS = 0.01
+# polling slows down to this while nothing is published
+MESSAGE_QUEUE_IDLE_POLL_SECONDS = 0.5
+MESSAGE_QUEUE_RETENTION_SECONDS = 60.0
+
+MIGRATIONS: list[tuple[str, ...]] = [
+    (
+        """
+        CREATE TABLE IF NOT EXISTS socketio_messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at_utc REAL NOT NULL
+        )
+        """,
+        """
+        CREATE INDEX socketio_messages_channel_message_id
+        ON socketio_messages (channel, message_id)
+        """,
+    ),
+]
+
+
+# a message queue for server processes on one machine, standing in for Redis or
+# another broker; every process polls a shared SQLite table for what the others publish
+class SQLiteManager(socketio.PubSubManager):
+    name = "sqlite"
+
+    def __init__(
+        self,
+        url: str,
+        channel: str = "flask-socketio",
+        write_only: bool = False,
+        logger=None,
+        poll_seconds: float = MESSAGE_QUEUE_POLL_SECONDS,
+        idle_poll_seconds: float = MESSAGE_QUEUE_IDLE_POLL_SECONDS,
+        retention_seconds: float = MESSAGE_QUEUE_RETENTION_SECONDS,
+    ):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url.removeprefix("sqlite:///")
+        self.poll_seconds = poll_seconds
+        self.idle_poll_seconds = idle_poll_seconds
+        self.retention_seconds = retention_seconds
+        sql.migrate(self.path, MIGRATIONS)
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, **kwargs):
+        room = kwargs.pop("to", None) or room
+        # replies to a client connected to this process, such as streamed frames, never
+        # need to reach the other processes
+        if room is not None and self.is_connected(room, namespace or "/"):
+            kwargs["ignore_queue"] = True
+        return super().emit(
+            event, data, namespace=namespace, room=room, skip_sid=skip_sid, **kwargs
+        )
+
+    def _publish(self, data: Any) -> None:
+        with sql.client(self.path) as cursor:
+            cursor.execute(
+                """
+                INSERT INTO socketio_messages (channel, payload, created_at_utc)
+                VALUES (?, ?, ?)
+                """,
+                (self.channel, self.json.dumps(data), time.time()),
+            )
+
+    def _poll(self, query: str, parameters: tuple = ()) -> list[dict]:
+        # straight from the pool rather than through sql.client, which would record
+        # every idle poll in the sql latency histogram
+        with sql.pool(self.path).connection() as connection:
+            try:
+                return connection.execute(query, parameters).fetchall()
+            finally:
+                connection.rollback()
+
+    def _listen(self) -> Iterator[str]:
+        last_message_id = self._poll(
+            "SELECT COALESCE(MAX(message_id), 0) AS head FROM socketio_messages"
+        )[0]["head"]
+        last_pruned = time.monotonic()
+        poll_seconds = self.poll_seconds
+        while True:
+            messages = self._poll(
+                """
+                SELECT message_id, payload
+                FROM socketio_messages
+                WHERE channel = ? AND message_id > ?
+                ORDER BY message_id
+                """,
+                (self.channel, last_message_id),
+            )
+            for message in messages:
+                last_message_id = message["message_id"]
+                yield message["payload"]
+            if time.monotonic() - last_pruned > self.retention_seconds:
+                last_pruned = time.monotonic()
+                self._prune()
+            if messages:
+                poll_seconds = self.poll_seconds
+            else:
+                time.sleep(poll_seconds)
+                poll_seconds = min(poll_seconds * 2, self.idle_poll_seconds)
+
+    def _prune(self) -> None:
+        with sql.client(self.path) as cursor:
+            cursor.execute(
+                "DELETE FROM socketio_messages WHERE created_at_utc < ?",
+                (time.time() - self.retention_seconds,),
+            )
+
+
+def options(url: str) -> dict[str, Any]:
+    if not url:
+        return {}
+    if url.startswith("sqlite:///"):
+        return {"client_manager": SQLiteManager(url)}
+    return {"message_queue": url}
@@ -0,0 +1,257 @@
+import os
+import threading
+import time
+from typing import Optional, Protocol
+
+from . import sql
+from .sql import client
+from ._cache import LRUCache
+from .history import ConversationHistory, load as load_history
+from .types import Message
+
+
+SESSION_DB_FILE = "data/sessions.db"
+SESSION_BACKEND = os.getenv("ROOTS_SESSION_BACKEND", "sqlite")
+SESSION_MAX_CONVERSATIONS = 512
+SESSION_MAX_TOKENS = int(os.getenv("ROOTS_SESSION_MAX_TOKENS", "1000000"))
+SESSION_TTL_SECONDS = 30 * 60.0
+SESSION_EXPIRE_INTERVAL_SECONDS = 60.0
+# how stale a session's activity in the backend may get before a request rewrites it;
+# far below the TTL, so a session in use never looks idle
+SESSION_TOUCH_SECONDS = 60.0
+
+MIGRATIONS: list[tuple[str, ...]] = [
+    (
+        """
+        CREATE TABLE IF NOT EXISTS session_state (
+            session_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            updated_at_utc REAL NOT NULL,
+            PRIMARY KEY (session_id, name)
+        )
+        """,
+        """
+        CREATE INDEX session_state_updated_at_utc
+        ON session_state (updated_at_utc)
+        """,
+    ),
+]
+
+
+class SessionBackend(Protocol):
+    def get(self, session_id: str, name: str) -> Optional[str]: ...
+
+    def put(self, session_id: str, name: str, value: str) -> None: ...
+
+    def drop(self, session_id: str) -> None: ...
+
+    def values(self, name: str) -> set[str]: ...
+
+    def expire(self, idle_seconds: float) -> set[str]: ...
+
+
+class MemorySessionBackend:
+    def __init__(self):
+        self._state: dict[str, dict[str, tuple[str, float]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str, name: str) -> Optional[str]:
+        with self._lock:
+            entry = self._state.get(session_id, {}).get(name)
+            return None if entry is None else entry[0]
+
+    def put(self, session_id: str, name: str, value: str) -> None:
+        with self._lock:
+            self._state.setdefault(session_id, {})[name] = (value, time.time())
+
+    def drop(self, session_id: str) -> None:
+        with self._lock:
+            self._state.pop(session_id, None)
+
+    def values(self, name: str) -> set[str]:
+        with self._lock:
+            return {state[name][0] for state in self._state.values() if name in state}
+
+    def expire(self, idle_seconds: float) -> set[str]:
+        cutoff = time.time() - idle_seconds
+        with self._lock:
+            expired = {
+                session_id
+                for session_id, state in self._state.items()
+                if max(updated_at for _, updated_at in state.values()) < cutoff
+            }
+            for session_id in expired:
+                del self._state[session_id]
+        return expired
+
+
+# shared by every server process that points at the same database file
+class SQLiteSessionBackend:
+    def __init__(self, path: str = SESSION_DB_FILE):
+        self.path = path
+        self._migrated = False
+        self._lock = threading.Lock()
+
+    def _client(self):
+        if not self._migrated:
+            with self._lock:
+                if not self._migrated:
+                    sql.migrate(self.path, MIGRATIONS)
+                    self._migrated = True
+        return client(self.path)
+
+    def get(self, session_id: str, name: str) -> Optional[str]:
+        with self._client() as cursor:
+            cursor.execute(
+                "SELECT value FROM session_state WHERE session_id = ? AND name = ?",
+                (session_id, name),
+            )
+            result = cursor.fetchone()
+        return None if result is None else result["value"]
+
+    def put(self, session_id: str, name: str, value: str) -> None:
+        with self._client() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO session_state (session_id, name, value, updated_at_utc)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (session_id, name) DO UPDATE SET
+                    value = excluded.value,
+                    updated_at_utc = excluded.updated_at_utc
+                """,
+                (session_id, name, value, time.time()),
+            )
+
+    def drop(self, session_id: str) -> None:
+        with self._client() as cursor:
+            cursor.execute(
+                "DELETE FROM session_state WHERE session_id = ?", (session_id,)
+            )
+
+    def values(self, name: str) -> set[str]:
+        with self._client() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT value FROM session_state WHERE name = ?", (name,)
+            )
+            return {record["value"] for record in cursor.fetchall()}
+
+    def expire(self, idle_seconds: float) -> set[str]:
+        with self._client() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM session_state
+                WHERE session_id IN (
+                    SELECT session_id
+                    FROM session_state
+                    GROUP BY session_id
+                    HAVING MAX(updated_at_utc) < ?
+                )
+                RETURNING session_id
+                """,
+                (time.time() - idle_seconds,),
+            )
+            return {record["session_id"] for record in cursor.fetchall()}
+
+
+class SessionStore:
+    def __init__(
+        self,
+        backend: SessionBackend,
+        max_conversations: int = SESSION_MAX_CONVERSATIONS,
+        max_tokens: int = SESSION_MAX_TOKENS,
+        ttl_seconds: float = SESSION_TTL_SECONDS,
+    ):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        # histories are rebuilt from the conversations database, so any process can
+        # evict them freely; only small per-session values live in the backend
+        self.histories: LRUCache[ConversationHistory] = LRUCache(
+            max_conversations,
+            max_weight=max_tokens,
+            weigher=lambda conversation_history: conversation_history.tokens(),
+            ttl_seconds=ttl_seconds,
+        )
+        self._last_expired = time.monotonic()
+        # what this process last wrote for each session, and when
+        self._touched: dict[str, tuple[int, float]] = {}
+        self._touched_lock = threading.Lock()
+
+    def history(
+        self, session_id: str, conversation_id: int, refresh: bool = False
+    ) -> ConversationHistory:
+        key = (session_id, conversation_id)
+        conversation_history = self.histories.get(key)
+        if conversation_history is None:
+            conversation_history = load_history(conversation_id)
+            self.histories.put(key, conversation_history)
+        elif refresh:
+            conversation_history.refresh()
+            self.histories.put(key, conversation_history)
+        self._touch(session_id, conversation_id)
+        self._expire_idle()
+        return conversation_history
+
+    def _touch(self, session_id: str, conversation_id: int) -> None:
+        # the backend's update time is the session's last activity, so one write keeps
+        # it alive, and a request that changes nothing soon after another needs none
+        now = time.monotonic()
+        with self._touched_lock:
+            touched = self._touched.get(session_id)
+            if touched is not None and touched[0] == conversation_id:
+                if now - touched[1] < SESSION_TOUCH_SECONDS:
+                    return
+            self._touched[session_id] = (conversation_id, now)
+        self.backend.put(session_id, "conversation_id", str(conversation_id))
+
+    def append(
+        self, session_id: str, conversation_id: int, messages: list[Message]
+    ) -> None:
+        conversation_history = self.history(session_id, conversation_id)
+        conversation_history.append(messages)
+        # re-weigh the grown history against the token cap
+        self.histories.put((session_id, conversation_id), conversation_history)
+
+    def drop(self, session_id: str) -> None:
+        for key in self.histories.keys():
+            if isinstance(key, tuple) and key[0] == session_id:
+                self.histories.pop(key)
+        with self._touched_lock:
+            self._touched.pop(session_id, None)
+        self.backend.drop(session_id)
+
+    def _expire_idle(self) -> None:
+        if time.monotonic() - self._last_expired < SESSION_EXPIRE_INTERVAL_SECONDS:
+            return
+        self._last_expired = time.monotonic()
+        self.histories.expire()
+        with self._touched_lock:
+            cutoff = self._last_expired - SESSION_TOUCH_SECONDS
+            for session_id, (_, touched_at) in list(self._touched.items()):
+                if touched_at < cutoff:
+                    del self._touched[session_id]
+        for session_id in self.backend.expire(self.ttl_seconds):
+            self.drop(session_id)
+
+    def active_conversations(self) -> set[int]:
+        # across every process sharing the backend, unlike the cached histories
+        return {int(value) for value in self.backend.values("conversation_id")}
+
+    def stats(self) -> dict[str, int]:
+        return self.histories.stats()
+
+
+def _default_backend() -> SessionBackend:
+    if SESSION_BACKEND == "memory":
+        return MemorySessionBackend()
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionBackend()
+    raise ValueError(f"Unknown session backend: {SESSION_BACKEND}")
+
+
+store = SessionStore(_default_backend())
+
+
+def set_store(new_store: SessionStore) -> None:
+    global store  # pylint: disable=global-statement
+    store = new_store
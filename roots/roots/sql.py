@@ -1,21 +1,133 @@
+import os
+import queue
 import sqlite3
+import threading
 from contextlib import contextmanager
 
+from . import tracing
+
+
+POOL_SIZE = 8
+BUSY_TIMEOUT_SECONDS = 5.0
+STATEMENT_CACHE_SIZE = 256
+CACHE_SIZE_KIB = 64 * 1024
+MMAP_SIZE_BYTES = 256 * 1024 * 1024
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{CACHE_SIZE_KIB}",
+    f"PRAGMA mmap_size = {MMAP_SIZE_BYTES}",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+)
+
+
+class ConnectionPool:
+    def __init__(self, path: str, size: int = POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_SECONDS,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        connection.row_factory = dict_factory
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+        try:
+            yield connection
+        finally:
+            if self._closed or self._idle.qsize() >= self.size:
+                connection.close()
+            else:
+                self._idle.put(connection)
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def pool(path) -> ConnectionPool:
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
+
+
+def close(path) -> None:
+    with _pools_lock:
+        connection_pool = _pools.pop(path, None)
+    if connection_pool is not None:
+        connection_pool.close()
+
+
+_inherited: list[ConnectionPool] = []
+
+
+def _forget_inherited_pools() -> None:
+    global _pools_lock  # pylint: disable=global-statement
+    # SQLite connections must not be used across a fork, nor closed in the child, where
+    # closing can undo locks the parent still relies on; keep them and open new ones
+    _pools_lock = threading.Lock()
+    _inherited.extend(_pools.values())
+    _pools.clear()
+
+
+os.register_at_fork(after_in_child=_forget_inherited_pools)
+
 
 @contextmanager
 def client(path):
-    connection = sqlite3.connect(path)
-    connection.row_factory = dict_factory
-    cursor = connection.cursor()
-    try:
-        yield cursor
-        connection.commit()
-    except Exception as error:
-        connection.rollback()
-        print(f"SQLite Error: {error}")
-        raise
-    finally:
-        connection.close()
+    with tracing.span("sql"), pool(path).connection() as connection:
+        cursor = connection.cursor()
+        try:
+            yield cursor
+            connection.commit()
+        except Exception as error:
+            connection.rollback()
+            print(f"SQLite Error: {error}")
+            raise
+        finally:
+            cursor.close()
+
+
+def migrate(path, migrations: list[tuple[str, ...]]) -> None:
+    with client(path) as cursor:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()["user_version"]
+        for number, statements in enumerate(migrations[version:], start=version + 1):
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(f"PRAGMA user_version = {number}")
+
+
+def optimize(path) -> None:
+    # folds the write-ahead log back into the database and refreshes planner statistics
+    with pool(path).connection() as connection:
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.execute("PRAGMA optimize")
 
 
 def dict_factory(cursor, row):
@@ -0,0 +1,211 @@
+import contextvars
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+from .cancellation import Cancelled, CancellationToken
+
+
+FRAME_INTERVAL_SECONDS = 0.03
+FRAME_MAX_CHARACTERS = 1024
+FRAMES_IN_FLIGHT = 8
+MAX_BUFFERED_CHARACTERS = 64 * 1024
+ACK_TIMEOUT_SECONDS = 2.0
+TOKEN_QUEUE_SIZE = 256
+
+Acknowledge = Callable[..., None]
+
+_DONE = object()
+_CANCELLED = object()
+
+
+class StreamStats:
+    def __init__(self):
+        self.tokens = 0
+        self.frames = 0
+        self.characters = 0
+        self.bytes = 0
+        self.ack_wait_seconds = 0.0
+        self.cancelled = False
+        self.started_at = time.perf_counter()
+        self.finished_at: Optional[float] = None
+
+    def stats(self) -> dict[str, float]:
+        elapsed = (self.finished_at or time.perf_counter()) - self.started_at
+        return {
+            "tokens": self.tokens,
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "frames_per_second": self.frames / max(elapsed, 1e-9),
+            "bytes_per_frame": self.bytes / max(self.frames, 1),
+            "ack_wait_seconds": self.ack_wait_seconds,
+            "cancelled": self.cancelled,
+        }
+
+
+# batches streamed tokens into frames; a client that stops acknowledging frames gets
+# fewer, larger ones, and once too much is buffered the model stream itself is paused
+class StreamCoalescer:
+    def __init__(
+        self,
+        emit_frame: Callable[[str, Acknowledge], None],
+        on_first_token: Optional[Callable[[], None]] = None,
+        interval_seconds: float = FRAME_INTERVAL_SECONDS,
+        max_frame_characters: int = FRAME_MAX_CHARACTERS,
+        frames_in_flight: int = FRAMES_IN_FLIGHT,
+        max_buffered_characters: int = MAX_BUFFERED_CHARACTERS,
+        ack_timeout_seconds: float = ACK_TIMEOUT_SECONDS,
+    ):
+        self.emit_frame = emit_frame
+        self.on_first_token = on_first_token
+        self.interval_seconds = interval_seconds
+        self.max_frame_characters = max_frame_characters
+        self.frames_in_flight = frames_in_flight
+        self.max_buffered_characters = max_buffered_characters
+        self.ack_timeout_seconds = ack_timeout_seconds
+        self.stats = StreamStats()
+        self.parts: list[str] = []
+        self._pending: list[str] = []
+        self._pending_characters = 0
+        self._next_flush = time.monotonic() + interval_seconds
+        self._unacknowledged: list[float] = []
+        self._acknowledged = threading.Condition()
+
+    def stream(
+        self, tokens: Iterable[str], cancellation: Optional[CancellationToken] = None
+    ) -> str:
+        tokens_queue: queue.Queue = queue.Queue(maxsize=TOKEN_QUEUE_SIZE)
+        stop = threading.Event()
+        # the reader runs in this context so the provider sees the active trace
+        reader = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(_read_tokens, tokens, tokens_queue, stop),
+            daemon=True,
+        )
+        reader.start()
+        if cancellation is not None:
+            cancellation.on_cancel(lambda: _offer(tokens_queue, _CANCELLED))
+
+        try:
+            while True:
+                wait = max(self._next_flush - time.monotonic(), 0.0)
+                try:
+                    token = tokens_queue.get(timeout=wait if self._pending else None)
+                except queue.Empty:
+                    self.flush()
+                    continue
+                if token is _DONE:
+                    break
+                if (
+                    token is _CANCELLED
+                    or isinstance(token, Cancelled)
+                    or (cancellation is not None and cancellation.cancelled)
+                ):
+                    self.stats.cancelled = True
+                    break
+                if isinstance(token, BaseException):
+                    self.flush(final=True)
+                    raise token
+                self.write(token)
+        finally:
+            stop.set()
+
+        self.flush(final=True)
+        self.stats.finished_at = time.perf_counter()
+        return self.response
+
+    @property
+    def response(self) -> str:
+        return "".join(self.parts)
+
+    def write(self, token: str) -> None:
+        if not token:
+            return
+        if not self.stats.tokens and self.on_first_token is not None:
+            self.on_first_token()
+        self.stats.tokens += 1
+        self.parts.append(token)
+        self._pending.append(token)
+        self._pending_characters += len(token)
+
+        due = time.monotonic() >= self._next_flush
+        if due or self._pending_characters >= self.max_frame_characters:
+            self.flush()
+
+    def flush(self, final: bool = False) -> None:
+        if not self._pending:
+            return
+        must_send = final or self._pending_characters >= self.max_buffered_characters
+        self._next_flush = time.monotonic() + self.interval_seconds
+        if not self._window_open(wait=must_send):
+            return
+
+        frame = "".join(self._pending)
+        self._pending.clear()
+        self._pending_characters = 0
+        with self._acknowledged:
+            self._unacknowledged.append(time.monotonic())
+        self.stats.frames += 1
+        self.stats.characters += len(frame)
+        self.stats.bytes += len(frame.encode("utf-8"))
+        self.emit_frame(frame, self._acknowledge)
+
+    def _acknowledge(self, *_args) -> None:
+        with self._acknowledged:
+            if self._unacknowledged:
+                self._unacknowledged.pop(0)
+            self._acknowledged.notify_all()
+
+    def _window_open(self, wait: bool) -> bool:
+        started_at = time.perf_counter()
+        with self._acknowledged:
+            while True:
+                # clients that never acknowledge only cost a timeout per frame
+                deadline = time.monotonic() - self.ack_timeout_seconds
+                while self._unacknowledged and self._unacknowledged[0] < deadline:
+                    self._unacknowledged.pop(0)
+                if len(self._unacknowledged) < self.frames_in_flight:
+                    break
+                if not wait:
+                    return False
+                oldest = self._unacknowledged[0]
+                self._acknowledged.wait(
+                    timeout=max(oldest + self.ack_timeout_seconds - time.monotonic(), 0.0)
+                )
+        self.stats.ack_wait_seconds += time.perf_counter() - started_at
+        return True
+
+
+def _read_tokens(
+    tokens: Iterable[str], tokens_queue: queue.Queue, stop: threading.Event
+) -> None:
+    try:
+        for token in tokens:
+            if not _put(tokens_queue, token, stop):
+                return
+        _put(tokens_queue, _DONE, stop)
+    except BaseException as error:  # pylint: disable=broad-exception-caught
+        _put(tokens_queue, error, stop)
+    finally:
+        # closing the generator closes the provider's stream
+        close = getattr(tokens, "close", None)
+        if close is not None:
+            close()
+
+
+def _put(tokens_queue: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            tokens_queue.put(item, timeout=FRAME_INTERVAL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _offer(tokens_queue: queue.Queue, item) -> None:
+    try:
+        tokens_queue.put_nowait(item)
+    except queue.Full:
+        pass
@@ -0,0 +1,281 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Iterator, Optional, ParamSpec, TypeVar
+
+
+TRACING_ENABLED = os.getenv("ROOTS_TRACING", "1") != "0"
+TRACE_LOG_FILE = os.getenv("ROOTS_TRACE_LOG", "")
+METRICS_PREFIX = "roots"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+QUANTILES = (0.5, 0.95, 0.99)
+# 100µs to 100s, four buckets per power of ten
+DURATION_BUCKETS = tuple(round(10 ** (exponent / 4), 6) for exponent in range(-16, 9))
+RATE_BUCKETS = tuple(float(2**exponent) for exponent in range(12))
+MAX_SPANS_PER_TRACE = 256
+
+METRICS: dict[str, tuple[str, tuple[float, ...]]] = {
+    "stage_seconds": ("Time spent in each stage of a chat turn.", DURATION_BUCKETS),
+    "tokens_per_second": ("Model output rate once streaming started.", RATE_BUCKETS),
+}
+
+Parameters = ParamSpec("Parameters")
+Result = TypeVar("Result")
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self) -> tuple[list[int], int, float]:
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+
+    def quantile(self, quantile: float) -> float:
+        counts, count, _ = self.snapshot()
+        if not count:
+            return 0.0
+        # interpolates within the bucket the same way Prometheus' histogram_quantile does
+        rank = quantile * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+
+class Trace:
+    def __init__(self, name: str, **attributes: Any):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.perf_counter()
+        self.started_at_utc = time.time()
+        self.stages: dict[str, float] = {}
+        self.spans: list[dict[str, Any]] = []
+        self.dropped_spans = 0
+        self._lock = threading.Lock()
+
+    def record(
+        self, name: str, seconds: float, started_at: Optional[float] = None
+    ) -> None:
+        started_at = time.perf_counter() - seconds if started_at is None else started_at
+        with self._lock:
+            # repeated stages such as sql add up
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            if len(self.spans) >= MAX_SPANS_PER_TRACE:
+                self.dropped_spans += 1
+                return
+            self.spans.append(
+                {
+                    "name": name,
+                    "start_ms": round((started_at - self.started_at) * 1000, 3),
+                    "duration_ms": round(seconds * 1000, 3),
+                }
+            )
+
+    def set(self, **attributes: Any) -> None:
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def report(self) -> str:
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda stage: stage[1])
+        return ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in stages)
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "trace_id": self.trace_id,
+                "name": self.name,
+                "started_at_utc": self.started_at_utc,
+                "attributes": dict(self.attributes),
+                "stages_ms": {
+                    name: round(seconds * 1000, 3)
+                    for name, seconds in self.stages.items()
+                },
+                "spans": list(self.spans),
+                "dropped_spans": self.dropped_spans,
+            }
+
+
+_current: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar(
+    "trace", default=None
+)
+_histograms: dict[tuple[str, Labels], Histogram] = {}
+_histograms_lock = threading.Lock()
+_collectors: dict[str, Callable[[], dict[str, Any]]] = {}
+_log_lock = threading.Lock()
+_no_span = nullcontext()
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def trace(name: str, **attributes: Any) -> Iterator[Optional[Trace]]:
+    if not TRACING_ENABLED:
+        yield None
+        return
+    active = Trace(name, **attributes)
+    reset = _current.set(active)
+    try:
+        yield active
+    finally:
+        _current.reset(reset)
+        observe("stage_seconds", active.elapsed(), stage=f"{name}_total")
+        if TRACE_LOG_FILE:
+            _write(active)
+
+
+def span(name: str):
+    if not TRACING_ENABLED:
+        return _no_span
+    return _span(name)
+
+
+@contextmanager
+def _span(name: str) -> Iterator[None]:
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started_at, started_at)
+
+
+def timed(
+    name: str, function: Callable[Parameters, Result]
+) -> Callable[Parameters, Result]:
+    def wrapper(*args: Parameters.args, **kwargs: Parameters.kwargs) -> Result:
+        with span(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def record(name: str, seconds: float, started_at: Optional[float] = None) -> None:
+    if not TRACING_ENABLED:
+        return
+    observe("stage_seconds", seconds, stage=name)
+    active = _current.get()
+    if active is not None:
+        active.record(name, seconds, started_at)
+
+
+def mark(name: str) -> None:
+    active = _current.get()
+    if active is not None:
+        record(name, active.elapsed(), active.started_at)
+
+
+def annotate(**attributes: Any) -> None:
+    active = _current.get()
+    if active is not None:
+        active.set(**attributes)
+
+
+def observe(metric: str, value: float, **labels: str) -> None:
+    if not TRACING_ENABLED:
+        return
+    key = (metric, tuple(sorted(labels.items())))
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(key, Histogram(METRICS[metric][1]))
+    histogram.observe(value)
+
+
+def quantiles(metric: str, **labels: str) -> dict[float, float]:
+    histogram = _histograms.get((metric, tuple(sorted(labels.items()))))
+    if histogram is None:
+        return {}
+    return {quantile: histogram.quantile(quantile) for quantile in QUANTILES}
+
+
+def register_collector(name: str, collect: Callable[[], dict[str, Any]]) -> None:
+    _collectors[name] = collect
+
+
+def render() -> str:
+    with _histograms_lock:
+        histograms = sorted(_histograms.items())
+    lines: list[str] = []
+    for metric, (description, buckets) in METRICS.items():
+        name = f"{METRICS_PREFIX}_{metric}"
+        series = [
+            (labels, histogram)
+            for (key, labels), histogram in histograms
+            if key == metric
+        ]
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in series:
+            counts, count, total = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {count}')
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        lines.append(f"# HELP {name}_quantile Estimated {metric} quantiles.")
+        lines.append(f"# TYPE {name}_quantile gauge")
+        for labels, histogram in series:
+            for quantile in QUANTILES:
+                labelled = _labels(labels, quantile=quantile)
+                lines.append(f"{name}_quantile{labelled} {histogram.quantile(quantile)}")
+
+    for collector, collect in sorted(_collectors.items()):
+        for key, value in collect().items():
+            if not isinstance(value, (int, float)):
+                continue
+            name = f"{METRICS_PREFIX}_{collector}_{key}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _labels(labels: Labels, **extra: Any) -> str:
+    pairs = [*labels, *((key, str(value)) for key, value in extra.items())]
+    if not pairs:
+        return ""
+    escaped = (
+        key + '="' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for key, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _write(finished: Trace) -> None:
+    line = json.dumps(finished.to_dict(), default=str)
+    try:
+        with _log_lock, open(TRACE_LOG_FILE, "a", encoding="utf-8") as log:
+            log.write(line + "\n")
+    except OSError as error:
+        print(f"Could not write trace to {TRACE_LOG_FILE}: {error}")
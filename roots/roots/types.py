@@ -1,7 +1,8 @@
-from typing import Optional, TypedDict, Literal
+from typing import NotRequired, Optional, TypedDict, Literal
 
 
 Role = Literal["system", "user", "assistant"]
+MessageStatus = Literal["complete", "cancelled", "failed"]
 
 
 class Message(TypedDict):
@@ -13,6 +14,8 @@ class Message(TypedDict):
     context: Optional[str]
     model_id: Optional[str]
     created_at_utc: Optional[int]
+    state: NotRequired[MessageStatus]
+    message_rowid: NotRequired[int]
 
 
 class Conversation(TypedDict):
@@ -21,6 +24,27 @@ class Conversation(TypedDict):
     created_at_utc: int
     last_modified_at_utc: int
     messages: list[Message]
+    has_more_messages: NotRequired[bool]
+
+
+class ConversationSummary(TypedDict):
+    conversation_id: int
+    summary: str
+    through_message_id: str
+
+
+class SearchResult(TypedDict):
+    conversation_id: int
+    conversation_name: str
+    message_id: Optional[str]
+    snippet: str
+    score: float
+
+
+class MemoryResult(TypedDict):
+    memory_id: int
+    score: float
+    memory: str
 
 
 class Model(TypedDict):
@@ -29,9 +53,31 @@ class Model(TypedDict):
     client_id: str
 
 
-BackendState = Literal["idle", "initialized", "thinking", "writing", "complete", "failed"]
+BackendState = Literal[
+    "idle", "initialized", "thinking", "writing", "complete", "cancelled", "failed"
+]
 
 
 class MessageState(TypedDict):
     message_id: str
     state: BackendState
+
+
+JobState = Literal["queued", "running", "done", "failed"]
+
+
+class Job(TypedDict):
+    job_id: int
+    kind: str
+    payload: dict
+    priority: int
+    state: JobState
+    attempts: int
+    max_attempts: int
+    session_id: Optional[str]
+    coalesce_key: Optional[str]
+    error: Optional[str]
+    run_after_utc: float
+    claimed_at_utc: Optional[float]
+    created_at_utc: float
+    updated_at_utc: float
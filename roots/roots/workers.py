@@ -0,0 +1,34 @@
+import contextvars
+import functools
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, ParamSpec, TypeVar
+
+
+WORKERS = int(os.getenv("ROOTS_WORKERS", "8"))
+
+Parameters = ParamSpec("Parameters")
+Result = TypeVar("Result")
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="roots-worker")
+
+
+def submit(
+    function: Callable[Parameters, Result],
+    *args: Parameters.args,
+    **kwargs: Parameters.kwargs,
+) -> Future[Result]:
+    # carry context variables such as the active cancellation token into the worker
+    context = contextvars.copy_context()
+    return _executor.submit(functools.partial(context.run, function, *args, **kwargs))
+
+
+def submit_detached(
+    function: Callable[Parameters, Result],
+    *args: Parameters.args,
+    **kwargs: Parameters.kwargs,
+) -> Future[Result]:
+    # for work that outlives the request that started it, which must neither be
+    # cancelled with that request nor add spans to its trace
+    context = contextvars.Context()
+    return _executor.submit(functools.partial(context.run, function, *args, **kwargs))
@@ -0,0 +1,50 @@
+import logging
+import os
+
+import pytest
+
+from benchmarks import fakes
+from roots import conversations, jobs, memories, sql
+from roots._index import close_index
+
+
+@pytest.fixture(scope="session", autouse=True)
+def workspace(tmp_path_factory):
+    # every data file path is relative, so running from a scratch directory keeps the
+    # tests away from real conversations and memories
+    directory = tmp_path_factory.mktemp("roots")
+    (directory / "data").mkdir()
+    previous = os.getcwd()
+    os.chdir(directory)
+    # one process needs no follower, and one that woke after the chdir back would open
+    # the real index
+    memories.INDEX_FOLLOW_SECONDS = 0.0
+    fakes.install(first_token_seconds=0.0, tokens_per_second=0.0)
+    for name in ("socketio", "engineio", "werkzeug"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    conversations.initialize_database()
+    memories.initialize_database()
+    jobs.initialize_database()
+    try:
+        yield directory
+    finally:
+        # flush the index while its relative path still points into the scratch directory
+        close_index(memories.MEMORY_INDEX_FILE)
+        os.chdir(previous)
+
+
+@pytest.fixture
+def database_file(tmp_path):
+    # a conversations database of its own, for tests that count or clean up rows
+    path = str(tmp_path / "conversations.db")
+    conversations.initialize_database(path)
+    yield path
+    sql.close(path)
+
+
+@pytest.fixture
+def jobs_file(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    jobs.initialize_database(path)
+    yield path
+    sql.close(path)
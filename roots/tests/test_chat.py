@@ -0,0 +1,141 @@
+import threading
+import time
+import uuid
+
+import pytest
+
+import app
+from benchmarks import fakes, synthetic
+from roots import cancellation, context, conversations, models
+from roots.context import RoutingDecision
+
+
+class FailingProvider(fakes.FakeProvider):
+    def _stream(self, model_id, messages, _cancellation=None):
+        raise RuntimeError("provider is down")
+
+
+class SpecificRouter:
+    def route(self, prompt, embedding):
+        return RoutingDecision(False, 1.0, "test", "SPECIFIC")
+
+
+@pytest.fixture(scope="module")
+def client():
+    session = app.socketio.test_client(app.app)
+    fakes.acknowledge_frames(app.socketio)
+    yield session
+    session.disconnect()
+
+
+@pytest.fixture
+def conversation_id(client) -> int:
+    client.emit("request_conversation", {"conversation_name": uuid.uuid4().hex})
+    return next(
+        event["args"][0]["conversation_id"]
+        for event in client.get_received()
+        if event["name"] == "conversation_response"
+    )
+
+
+def send(client, conversation_id: int, content: str, model_id: str = "gpt-4o"):
+    exchange_id = uuid.uuid4().hex
+    user_message = synthetic.message(conversation_id, "user", content, exchange_id)
+    assistant_message = synthetic.message(conversation_id, "assistant", "", exchange_id)
+    assistant_message["model_id"] = model_id
+    client.emit(
+        "new_message",
+        {"user_message": user_message, "assistant_message": assistant_message},
+    )
+    return user_message, assistant_message
+
+
+def final_state(client, message_id: str) -> str:
+    return [
+        event["args"][0]["state"]
+        for event in client.get_received()
+        if event["name"] == "backend_update"
+        and event["args"][0]["message_id"] == message_id
+    ][-1]
+
+
+def test_reply_is_saved_after_the_prompt(client, conversation_id):
+    user_message, assistant_message = send(client, conversation_id, "hello there")
+
+    assert final_state(client, assistant_message["message_id"]) == "complete"
+    messages, _ = conversations.fetch_messages(conversation_id)
+    assert [message["message_id"] for message in messages] == [
+        user_message["message_id"],
+        assistant_message["message_id"],
+    ]
+    assert messages[1]["content"]
+
+
+def test_failed_reply_is_saved_and_reported(client, conversation_id, monkeypatch):
+    monkeypatch.setitem(models.providers, "openai", FailingProvider("openai"))
+
+    user_message, assistant_message = send(client, conversation_id, "are you there")
+
+    assert final_state(client, assistant_message["message_id"]) == "failed"
+    messages, _ = conversations.fetch_messages(conversation_id)
+    assert [(message["role"], message["state"]) for message in messages] == [
+        ("user", "complete"),
+        ("assistant", "failed"),
+    ]
+    assert messages[0]["content"] == user_message["content"]
+
+
+def test_cancel_before_first_token(client, conversation_id, monkeypatch):
+    slow = fakes.FakeProvider("openai", first_token_seconds=5.0)
+    monkeypatch.setitem(models.providers, "openai", slow)
+    exchange_id = uuid.uuid4().hex
+    user_message = synthetic.message(conversation_id, "user", "stop me", exchange_id)
+    assistant_message = synthetic.message(conversation_id, "assistant", "", exchange_id)
+    assistant_message["model_id"] = "gpt-4o"
+    sender = threading.Thread(
+        target=client.emit,
+        args=(
+            "new_message",
+            {"user_message": user_message, "assistant_message": assistant_message},
+        ),
+    )
+    started_at = time.monotonic()
+    sender.start()
+    while not cancellation.cancel(assistant_message["message_id"]):
+        time.sleep(0.01)
+    sender.join()
+
+    assert time.monotonic() - started_at < slow.first_token_seconds
+    assert final_state(client, assistant_message["message_id"]) == "cancelled"
+    messages, _ = conversations.fetch_messages(conversation_id)
+    assert (messages[-1]["content"], messages[-1]["state"]) == ("", "cancelled")
+
+    # the empty reply must not reach the next prompt, which providers would reject
+    monkeypatch.setitem(models.providers, "openai", fakes.FakeProvider("openai"))
+    _, reply = send(client, conversation_id, "try again")
+    assert final_state(client, reply["message_id"]) == "complete"
+    session_id = app.socketio.server.manager.sid_from_eio_sid(client.eio_sid, "/")
+    assert (session_id, conversation_id) in app.sessions.store.histories.keys()
+    conversation_history = app.sessions.store.history(session_id, conversation_id)
+    prompt = conversation_history.prompt("gpt-4o", "next")
+    assert all(message["content"] for message in prompt)
+
+
+def test_past_messages_have_their_own_heading(conversation_id, monkeypatch):
+    monkeypatch.setattr(context, "router", SpecificRouter())
+    monkeypatch.setattr(context, "HYBRID_MAX_MESSAGE_SCORE", None)
+    other = conversations.create(uuid.uuid4().hex)["conversation_id"]
+    conversations.save_messages(
+        [
+            synthetic.message(other, "user", "my parrot is called Pascal", "pascal"),
+            synthetic.message(other, "assistant", "parrot Pascal sounds fun", "pascal"),
+        ]
+    )
+
+    generated = context.generate("what is my parrot called", conversation_id)
+
+    heading = "\nRelevant past messages: \n"
+    assert heading in generated
+    past_messages = generated.split(heading)[1]
+    assert "my parrot is called Pascal" in past_messages
+    assert "sounds fun" not in generated
@@ -0,0 +1,170 @@
+import sqlite3
+
+from benchmarks import synthetic
+from roots import conversations, sql
+from roots.sql import client
+
+
+def add_turn(conversation_id: int, user: str, assistant: str, database_file: str):
+    exchange_id = f"exchange-{user}"
+    return conversations.save_messages(
+        [
+            synthetic.message(conversation_id, "user", user, exchange_id),
+            synthetic.message(conversation_id, "assistant", assistant, exchange_id),
+        ],
+        database_file=database_file,
+    )
+
+
+def count(database_file: str, query: str, parameters: tuple = ()) -> int:
+    with client(database_file) as cursor:
+        cursor.execute(f"SELECT COUNT(*) AS total FROM ({query})", parameters)
+        return cursor.fetchone()["total"]
+
+
+def test_drop_cascades_to_messages_and_search_index(database_file):
+    conversation_id = conversations.create("cascade", database_file)["conversation_id"]
+    add_turn(conversation_id, "walrus question", "walrus answer", database_file)
+
+    conversations.drop(conversation_id, database_file)
+
+    assert count(database_file, "SELECT * FROM messages") == 0
+    assert count(database_file, "SELECT * FROM messages_fts") == 0
+    assert conversations.search("walrus", database_file=database_file) == ([], False)
+
+
+def test_clean_database_spares_new_and_active_conversations(database_file):
+    _stale, active, fresh, used = (
+        conversations.create(name, database_file)["conversation_id"]
+        for name in ("stale", "active", "fresh", "used")
+    )
+    add_turn(used, "hello there", "hi", database_file)
+    with client(database_file) as cursor:
+        cursor.execute(
+            "UPDATE conversations SET created_at_utc = 0 WHERE conversation_id != ?",
+            (fresh,),
+        )
+
+    conversations.clean_database(keep={active}, database_file=database_file)
+
+    with client(database_file) as cursor:
+        cursor.execute("SELECT conversation_id FROM conversations")
+        remaining = {record["conversation_id"] for record in cursor.fetchall()}
+    assert remaining == {active, fresh, used}
+
+
+def test_conversation_pages_are_newest_first(database_file):
+    conversation_ids = [
+        conversations.create(f"page/{number}", database_file)["conversation_id"]
+        for number in range(5)
+    ]
+    with client(database_file) as cursor:
+        # two share a timestamp, so the id has to break the tie
+        cursor.executemany(
+            "UPDATE conversations SET last_modified_at_utc = ? WHERE conversation_id = ?",
+            [(100, conversation_ids[0]), (200, conversation_ids[1])]
+            + [(300, conversation_id) for conversation_id in conversation_ids[2:]],
+        )
+
+    seen = []
+    before_modified, before_conversation_id, has_more = None, None, True
+    while has_more:
+        page, has_more = conversations.fetch_conversations(
+            before_modified, before_conversation_id, limit=2, database_file=database_file
+        )
+        seen += [conversation["conversation_id"] for conversation in page]
+        before_modified = page[-1]["last_modified_at_utc"]
+        before_conversation_id = page[-1]["conversation_id"]
+
+    newest_first = [*reversed(conversation_ids[2:]), *reversed(conversation_ids[:2])]
+    assert seen == newest_first
+
+
+def test_message_pages_walk_back_without_gaps(database_file):
+    conversation_id = conversations.create("messages", database_file)["conversation_id"]
+    saved = []
+    for number in range(7):
+        saved += add_turn(conversation_id, f"question {number}", "answer", database_file)
+
+    pages = []
+    before = None
+    while True:
+        page, has_more = conversations.fetch_messages(
+            conversation_id, before=before, limit=3, database_file=database_file
+        )
+        pages = page + pages
+        if not has_more:
+            break
+        before = page[0]["message_id"]
+
+    assert [message["message_id"] for message in pages] == [
+        message["message_id"] for message in saved
+    ]
+
+
+def test_search_filters_by_role_and_score(database_file):
+    conversation_id = conversations.create("zebras", database_file)["conversation_id"]
+    add_turn(conversation_id, "tell me about zebras", "they have stripes", database_file)
+
+    results, _ = conversations.search("zebras", database_file=database_file)
+    assert {result["message_id"] is None for result in results} == {True, False}
+
+    results, _ = conversations.search("zebras", role="user", database_file=database_file)
+    assert len(results) == 1
+    assert results[0]["snippet"] == "tell me about **zebras**"
+
+    results, _ = conversations.search(
+        "zebras", role="user", max_score=-100.0, database_file=database_file
+    )
+    assert results == []
+
+
+def test_migration_keeps_the_rowids_of_existing_messages(tmp_path):
+    database_file = str(tmp_path / "old.db")
+    # the schema before it was versioned, when messages had no INTEGER PRIMARY KEY
+    sql.migrate(database_file, conversations.MIGRATIONS[:1])
+    with client(database_file) as cursor:
+        cursor.execute("INSERT INTO conversations (conversation_name) VALUES ('old')")
+        cursor.executemany(
+            """
+            INSERT INTO messages (message_id, exchange_id, conversation_id, role, content)
+            VALUES (?, 'exchange', 1, 'user', ?)
+            """,
+            [("first", "first"), ("gone", "gone"), ("penguins", "penguins")],
+        )
+        # leaves a gap in the rowids, which the copied table must keep
+        cursor.execute("DELETE FROM messages WHERE content IN ('first', 'gone')")
+        cursor.execute("SELECT rowid, message_id FROM messages ORDER BY rowid")
+        rowids = cursor.fetchall()
+
+    conversations.initialize_database(database_file)
+    conversations.backfill_search_index(database_file=database_file)
+    sql.close(database_file)
+    connection = sqlite3.connect(database_file)
+    connection.execute("VACUUM")
+    connection.close()
+
+    with client(database_file) as cursor:
+        cursor.execute(
+            "SELECT message_rowid AS rowid, message_id FROM messages ORDER BY rowid"
+        )
+        assert cursor.fetchall() == rowids
+    results, _ = conversations.search(
+        "penguins", role="user", highlight=("", ""), database_file=database_file
+    )
+    assert [result["snippet"] for result in results] == ["penguins"]
+    sql.close(database_file)
+    connection = sqlite3.connect(database_file)
+    connection.execute("VACUUM")
+    connection.close()
+
+    with client(database_file) as cursor:
+        cursor.execute(
+            "SELECT message_rowid AS rowid, message_id FROM messages ORDER BY rowid"
+        )
+        assert cursor.fetchall() == rowids
+    results, _ = conversations.search(
+        "penguins", role="user", highlight=("", ""), database_file=database_file
+    )
+    assert [result["snippet"] for result in results] == ["penguins"]
+    sql.close(database_file)
@@ -0,0 +1,110 @@
+from benchmarks import synthetic
+from roots import cancellation, conversations, history, models, sessions, tracing
+from roots.history import ConversationHistory
+
+
+def turn(conversation_id: int, user: str, assistant: str, state: str = "complete"):
+    exchange_id = f"exchange-{user}"
+    assistant_message = synthetic.message(
+        conversation_id, "assistant", assistant, exchange_id
+    )
+    assistant_message["state"] = state  # type: ignore
+    return [
+        synthetic.message(conversation_id, "user", user, exchange_id),
+        assistant_message,
+    ]
+
+
+def test_stopped_and_empty_replies_stay_out_of_the_prompt():
+    conversation_history = ConversationHistory(
+        0,
+        messages=[
+            *turn(0, "first question", "first answer"),
+            # stopped before the first token
+            *turn(0, "second question", "", state="cancelled"),
+            *turn(0, "third question", "half an answ", state="cancelled"),
+            *turn(0, "fourth question", "", state="failed"),
+        ],
+    )
+
+    prompt = conversation_history.prompt("gpt-4o", "fifth question")
+
+    assert prompt == [
+        {"role": "user", "content": "first question"},
+        {"role": "assistant", "content": "first answer"},
+        {"role": "user", "content": "second question"},
+        {"role": "user", "content": "third question"},
+        {"role": "user", "content": "fourth question"},
+        {"role": "user", "content": "fifth question"},
+    ]
+
+
+def test_refresh_picks_up_turns_from_other_sessions():
+    conversation_id = conversations.create("shared history")["conversation_id"]
+    first = history.load(conversation_id)
+    second = history.load(conversation_id)
+
+    own_turn = turn(conversation_id, "asked in the first tab", "first reply")
+    conversations.save_messages(own_turn)
+    first.append(own_turn)
+    conversations.save_messages(
+        turn(conversation_id, "asked in the second tab", "second reply")
+    )
+    first.refresh()
+    second.refresh()
+
+    expected = [
+        "asked in the first tab",
+        "first reply",
+        "asked in the second tab",
+        "second reply",
+    ]
+    assert [message["content"] for _, message in first.messages] == expected
+    assert [message["content"] for _, message in second.messages] == expected
+
+
+def test_sessions_share_turns_written_by_another_process():
+    conversation_id = conversations.create("two processes")["conversation_id"]
+    # each store stands in for the cache of a separate server process
+    stores = [sessions.SessionStore(sessions.MemorySessionBackend()) for _ in range(2)]
+    for store in stores:
+        store.history("session", conversation_id)
+
+    conversations.save_messages(turn(conversation_id, "hello", "hi"))
+    conversation_history = stores[1].history("session", conversation_id, refresh=True)
+
+    assert conversation_history.prompt("gpt-4o", "again")[:2] == [
+        {"role": "user", "content": "hello"},
+        {"role": "assistant", "content": "hi"},
+    ]
+
+
+def test_summaries_outlive_the_request_that_started_them(monkeypatch):
+    monkeypatch.setattr(history, "RECENT_HISTORY_TOKENS", 1)
+    monkeypatch.setattr(history, "SUMMARIZE_AFTER_TOKENS", 1)
+    monkeypatch.setattr(tracing, "TRACING_ENABLED", True)
+    seen = []
+
+    def summarize_history(*_):
+        seen.append((cancellation.current(), tracing.current()))
+        return "summary"
+
+    monkeypatch.setattr(models, "summarize_history", summarize_history)
+    conversation_id = conversations.create("compacted")["conversation_id"]
+    conversation_history = ConversationHistory(
+        conversation_id,
+        messages=[
+            *turn(conversation_id, "old question", "old answer"),
+            *turn(conversation_id, "new question", "new answer"),
+        ],
+    )
+    token = cancellation.CancellationToken("request")
+
+    with cancellation.active(token), tracing.trace("request"):
+        summarizing = conversation_history.compact()
+        token.cancel()
+    assert summarizing is not None
+    summarizing.result(timeout=5.0)
+
+    assert seen and all(context == (None, None) for context in seen)
+    assert conversation_history.summary == "summary"
@@ -0,0 +1,24 @@
+import os
+import runpy
+
+import pytest
+
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "..", "scripts", "check-import-time")
+# slower machines, such as shared CI runners, can loosen every budget at once
+BUDGET_SCALE = float(os.getenv("ROOTS_IMPORT_BUDGET_SCALE", "1.0"))
+
+check_import_time = runpy.run_path(SCRIPT)
+
+
+@pytest.fixture(scope="module")
+def baseline() -> dict[str, int]:
+    return check_import_time["import_times"]("pass")
+
+
+@pytest.mark.parametrize("module, budget", check_import_time["BUDGETS"].items())
+def test_cold_import_within_budget(baseline, module, budget):
+    seconds, loaded = check_import_time["measure"](module, baseline, runs=3)
+
+    assert not loaded, f"importing {module} eagerly imports {', '.join(loaded)}"
+    assert seconds <= budget * BUDGET_SCALE
@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+
+from roots import jobs
+from roots.sql import client
+
+
+payloads: list[dict] = []
+
+
+@jobs.handler("test_record")
+def record(batch: list[dict]):
+    payloads.extend(batch)
+
+
+@jobs.handler("test_fail", max_attempts=2)
+def fail(_: list[dict]):
+    raise RuntimeError("always fails")
+
+
+def fetch(job_id: int, jobs_file: str) -> dict:
+    with client(jobs_file) as cursor:
+        cursor.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,))
+        return cursor.fetchone()
+
+
+def make_due(jobs_file: str) -> None:
+    with client(jobs_file) as cursor:
+        cursor.execute("UPDATE jobs SET run_after_utc = 0 WHERE state = 'queued'")
+
+
+@pytest.fixture(autouse=True)
+def clear_payloads():
+    payloads.clear()
+
+
+def test_coalesced_jobs_run_once(jobs_file):
+    first = jobs.enqueue(
+        "test_record", {"n": 1}, coalesce_key="k", database_file=jobs_file
+    )
+    second = jobs.enqueue(
+        "test_record", {"n": 2}, coalesce_key="k", priority=0, database_file=jobs_file
+    )
+
+    assert first == second
+    assert fetch(first, jobs_file)["priority"] == 0
+    assert jobs.run_pending(jobs_file) == 1
+    assert payloads == [{"n": 1}]
+
+
+def test_failed_jobs_back_off_then_give_up(jobs_file):
+    job_id = jobs.enqueue("test_fail", database_file=jobs_file)
+
+    jobs.run_pending(jobs_file)
+    job = fetch(job_id, jobs_file)
+    assert job["state"] == "queued"
+    assert job["attempts"] == 1
+    assert job["error"] == "RuntimeError: always fails"
+    assert job["run_after_utc"] > time.time()
+    # not due again until its backoff has passed
+    assert jobs.run_pending(jobs_file) == 0
+
+    make_due(jobs_file)
+    jobs.run_pending(jobs_file)
+    job = fetch(job_id, jobs_file)
+    assert job["state"] == "failed"
+    assert job["attempts"] == 2
+
+
+def test_backoff_grows_and_is_capped():
+    assert jobs.backoff(1) <= jobs.RETRY_BACKOFF_SECONDS
+    assert jobs.backoff(3) >= jobs.RETRY_BACKOFF_SECONDS * 2
+    assert jobs.backoff(100) <= jobs.RETRY_BACKOFF_MAX_SECONDS
+
+
+def test_lost_jobs_are_retried_until_their_attempts_run_out(jobs_file):
+    retried = jobs.enqueue("test_fail", database_file=jobs_file)
+    exhausted = jobs.enqueue("test_fail", database_file=jobs_file)
+    with client(jobs_file) as cursor:
+        # as if the process running them died long ago
+        cursor.execute(
+            """
+            UPDATE jobs
+            SET state = 'running', claimed_at_utc = 0, attempts = ?
+            WHERE job_id = ?
+            """,
+            (1, retried),
+        )
+        cursor.execute(
+            """
+            UPDATE jobs
+            SET state = 'running', claimed_at_utc = 0, attempts = max_attempts
+            WHERE job_id = ?
+            """,
+            (exhausted,),
+        )
+
+    assert jobs.recover_expired(jobs_file) == 2
+    assert fetch(retried, jobs_file)["state"] == "queued"
+    assert fetch(exhausted, jobs_file)["state"] == "failed"
+    assert fetch(exhausted, jobs_file)["error"] == "Lost with the process that ran it"
+
+
+def test_running_jobs_renew_their_claim(jobs_file, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_HEARTBEAT_SECONDS", 0.02)
+    claims: list[float] = []
+    finished = threading.Event()
+
+    @jobs.handler("test_slow")
+    def slow(_: list[dict]):
+        for _ in range(2):
+            time.sleep(0.1)
+            claims.append(fetch(job_id, jobs_file)["claimed_at_utc"])
+        finished.set()
+
+    job_id = jobs.enqueue("test_slow", database_file=jobs_file)
+    jobs.run_pending(jobs_file)
+
+    assert finished.is_set()
+    assert claims[1] > claims[0]
+    assert fetch(job_id, jobs_file)["state"] == "done"
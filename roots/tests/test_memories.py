@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from benchmarks import fakes
+from roots import _embedding, memories
+from roots.sql import client
+
+
+def test_journal_replay_does_not_index_twice():
+    memory_ids = memories.add_many(["replayed memory about kites", "replayed tea memory"])
+    index = memories.memory_index()
+    total = index.ntotal
+    with client(memories.MEMORY_DB_FILE) as cursor:
+        # as if the process crashed after indexing them but before moving its generation
+        cursor.executemany(
+            "INSERT INTO memory_journal (operation, memory_id) VALUES ('add', ?)",
+            [(memory_id,) for memory_id in memory_ids],
+        )
+
+    memories.sync_index()
+
+    assert index.ntotal == total
+    assert index.contains(memory_ids) == set(memory_ids)
+
+
+def test_removed_memories_are_not_found():
+    text = "my bicycle is painted bright orange"
+    memory_id = memories.add(text)
+    assert memory_id is not None
+    found = memories.fetch_relevant_memories("bicycle painted orange", k=1)
+    assert [result["memory"] for result in found] == [text]
+
+    memories.remove(memory_id)
+
+    found = memories.fetch_relevant_memories("bicycle painted orange", k=5)
+    assert text not in [result["memory"] for result in found]
+
+
+def test_add_before_remove_in_one_replay_leaves_nothing_behind():
+    memory_id = memories.add("a memory that is taken back")
+    assert memory_id is not None
+    with client(memories.MEMORY_DB_FILE) as cursor:
+        cursor.execute("DELETE FROM memories WHERE memory_id = ?", (memory_id,))
+        cursor.executemany(
+            "INSERT INTO memory_journal (operation, memory_id) VALUES (?, ?)",
+            [("add", memory_id), ("remove", memory_id)],
+        )
+
+    memories.sync_index()
+
+    assert memories.fetch_memory_texts([memory_id]) == {}
+
+
+class RejectingBackend(fakes.FakeEmbeddingBackend):
+    def embed(self, texts):
+        if any("unembeddable" in text for text in texts):
+            raise ValueError("input rejected")
+        return super().embed(texts)
+
+
+class WrongSizeBackend(fakes.FakeEmbeddingBackend):
+    def embed(self, texts):
+        return [[1.0, 0.0, 0.0] for _ in texts]
+
+
+def test_wrong_size_embeddings_are_rejected(monkeypatch):
+    monkeypatch.setattr(_embedding, "backend", WrongSizeBackend())
+
+    with pytest.raises(_embedding.EmbeddingSizeError, match="768 dimensions"):
+        _embedding.embed("a text embedded by the wrong model")
+    assert _embedding.embed_many(["another text for the wrong model"]) == [None]
+    assert not memories.fetch_relevant_memories("a query for the wrong model")
+
+
+def test_unembeddable_memories_stop_holding_back_the_journal(monkeypatch):
+    monkeypatch.setattr(_embedding, "backend", RejectingBackend())
+    # pylint: disable-next=unbalanced-tuple-unpacking
+    rejected, accepted = memories.add_many(
+        ["an unembeddable memory", "an embeddable memory about lanterns"]
+    )
+    index = memories.memory_index()
+    head = memories._journal_head()  # pylint: disable=protected-access
+    assert index.generation < head
+
+    for _ in range(memories.EMBED_ATTEMPTS):
+        memories.sync_index()
+
+    assert index.generation == head
+    assert index.contains([rejected, accepted]) == {accepted}
+
+
+def test_updated_memories_are_embedded_again():
+    memory_id = memories.add("my hamster is called Biscuit")
+    assert memory_id is not None
+
+    updated_id = memories.update(memory_id, "my hamster is called Waffles")
+
+    assert updated_id is not None and updated_id != memory_id
+    index = memories.memory_index()
+    assert np.allclose(
+        index.reconstruct([updated_id])[0],
+        fakes.fake_embedding("my hamster is called Waffles"),
+        atol=1e-5,
+    )
+    found = memories.fetch_relevant_memories("my hamster is called", k=5)
+    found_texts = [result["memory"] for result in found]
+    assert "my hamster is called Waffles" in found_texts
+    assert "my hamster is called Biscuit" not in found_texts
+
+
+def test_deduplicate_removes_only_newer_near_duplicates():
+    words = "saffron quilts hang beside copper kettles in grandmother's tidy attic"
+    # pylint: disable-next=unbalanced-tuple-unpacking
+    kept, duplicate, similar = memories.add_many(
+        [
+            words,
+            # one repeated word keeps it above the threshold
+            f"{words} attic",
+            # three new words take it below
+            f"{words} under rafters dust",
+        ]
+    )
+
+    memories.deduplicate()
+
+    assert set(memories.fetch_memory_texts([kept, duplicate, similar])) == {
+        kept,
+        similar,
+    }
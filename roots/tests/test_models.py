@@ -0,0 +1,35 @@
+import pytest
+
+from benchmarks import fakes
+from roots.models import Provider
+
+
+class FlakyProvider(fakes.FakeProvider):
+    # sends the role chunk, then drops the connection on the first attempt
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.attempts = 2
+        self.retry_wait_seconds = 0.0
+        self.calls = 0
+
+    def _stream(self, model_id, messages, cancellation=None):
+        self.calls += 1
+        yield ""
+        if self.calls == 1:
+            raise ConnectionError("connection reset")
+        yield "hello"
+
+
+def test_empty_chunks_do_not_stop_a_retry():
+    provider = FlakyProvider("flaky")
+
+    assert list(provider.stream("model", [])) == ["hello"]
+    assert provider.calls == 2
+
+
+def test_providers_must_implement_streaming():
+    class Incomplete(Provider):  # pylint: disable=abstract-method
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete")  # pylint: disable=abstract-class-instantiated
@@ -0,0 +1,67 @@
+import os
+
+from roots._payloads import RECORD, PayloadStore
+
+
+def test_readers_leave_a_partial_record_for_the_writer(tmp_path):
+    path = str(tmp_path / "payloads")
+    writer = PayloadStore(path)
+    writer.put_many([(1, "first"), (2, "second")])
+    record = RECORD.itemsize
+    with open(writer.table_path, "rb") as table:
+        table.seek(record)
+        second = table.read(record)
+    # as if the writer were halfway through appending the second record
+    os.truncate(writer.table_path, record + record // 2)
+
+    reader = PayloadStore(path)
+    assert reader.get_many([1, 2]) == {1: "first"}
+    assert os.path.getsize(writer.table_path) == record + record // 2
+
+    with open(writer.table_path, "r+b") as table:
+        table.seek(record)
+        table.write(second)
+    reader.close()
+    assert reader.get_many([1, 2]) == {1: "first", 2: "second"}
+
+
+def test_writer_drops_a_torn_record_before_appending(tmp_path):
+    path = str(tmp_path / "payloads")
+    writer = PayloadStore(path)
+    writer.put_many([(1, "first")])
+    with open(writer.table_path, "ab") as table:
+        table.write(b"torn")
+
+    writer.put_many([(2, "second")])
+
+    assert os.path.getsize(writer.table_path) == 2 * RECORD.itemsize
+    assert PayloadStore(path).get_many([1, 2]) == {1: "first", 2: "second"}
+
+
+def test_compaction_keeps_only_live_payloads(tmp_path):
+    path = str(tmp_path / "payloads")
+    writer = PayloadStore(path)
+    writer.put_many([(1, "first"), (2, "second"), (3, "third")])
+    writer.put_many([(1, "first again"), (1, "first, finally")])
+    writer.remove_many([2])
+    # one reader has mapped the old blob, the other has only read the old table
+    mapped, unmapped = PayloadStore(path), PayloadStore(path)
+    assert mapped.get_many([3]) == {3: "third"}
+    assert 3 in unmapped
+    grown = os.path.getsize(writer.blob_path)
+
+    assert writer.compact()
+
+    live = {1: "first, finally", 3: "third"}
+    assert os.path.getsize(writer.blob_path) == len("first, finally") + len("third")
+    assert os.path.getsize(writer.blob_path) < grown
+    assert os.path.getsize(writer.table_path) == 3 * RECORD.itemsize
+    assert writer.get_many([1, 2, 3]) == live
+    assert PayloadStore(path).get_many([1, 2, 3]) == live
+    assert mapped.get_many([3]) == {3: "third"}
+    assert unmapped.get_many([1, 3]) == live
+    # too little left to reclaim
+    assert not writer.compact()
+
+    writer.put_many([(4, "fourth")])
+    assert PayloadStore(path).get_many([1, 3, 4]) == {**live, 4: "fourth"}
@@ -0,0 +1,167 @@
+import sqlite3
+
+import pytest
+
+from benchmarks import synthetic
+from roots import conversations, sql
+
+
+STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# each call runs against a conversation with three messages, with the plan details
+# that are allowed despite looking slow
+CALLS = [
+    pytest.param(lambda path: conversations.create("plans", path), (), id="create"),
+    pytest.param(lambda path: conversations.update(1, "renamed", path), (), id="update"),
+    pytest.param(
+        lambda path: conversations.fetch(1, path, message_limit=10), (), id="fetch"
+    ),
+    pytest.param(
+        lambda path: conversations.fetch_messages(
+            1, before="message-2", limit=1, database_file=path
+        ),
+        (),
+        id="fetch messages page",
+    ),
+    pytest.param(
+        lambda path: conversations.fetch_messages_after(1, "message-0", path),
+        (),
+        id="fetch messages after",
+    ),
+    pytest.param(
+        lambda path: conversations.fetch_summary(1, path), (), id="fetch summary"
+    ),
+    pytest.param(
+        lambda path: conversations.save_summary(1, "summary", "message-0", path),
+        (),
+        id="save summary",
+    ),
+    pytest.param(
+        lambda path: conversations.fetch_conversations(
+            2**31, 1, limit=10, database_file=path
+        ),
+        (),
+        id="fetch conversations page",
+    ),
+    # the full list is read in index order
+    pytest.param(conversations.fetch_all, (), id="fetch all"),
+    pytest.param(
+        lambda path: conversations.search("plans", role="user", database_file=path),
+        # results from two full-text indexes can only be ranked once they are merged
+        ("USE TEMP B-TREE FOR ORDER BY",),
+        id="search",
+    ),
+    pytest.param(
+        lambda path: conversations.update_message_context("message-0", "context", path),
+        (),
+        id="update message context",
+    ),
+    pytest.param(
+        lambda path: conversations.backfill_search_index(database_file=path),
+        (),
+        id="backfill search index",
+    ),
+    pytest.param(
+        lambda path: conversations.clean_database(keep=[1], database_file=path),
+        # cleanup visits every conversation, off the request path
+        ("SCAN conversations",),
+        id="clean database",
+    ),
+    pytest.param(lambda path: conversations.drop(1, path), (), id="drop"),
+]
+
+
+@pytest.fixture
+def traced_database(database_file):
+    conversation_id = conversations.create("traced", database_file)["conversation_id"]
+    messages = [
+        synthetic.message(conversation_id, "user", "plans for the weekend")
+        for _ in range(3)
+    ]
+    for number, message in enumerate(messages):
+        message["message_id"] = f"message-{number}"
+    conversations.save_messages(messages, database_file)
+    # pooled connections were opened before tracing started
+    sql.close(database_file)
+    statements: list[str] = []
+    connect = sql.ConnectionPool._connect  # pylint: disable=protected-access
+
+    def traced_connect(pool: sql.ConnectionPool):
+        connection = connect(pool)
+        connection.set_trace_callback(statements.append)
+        return connection
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(sql.ConnectionPool, "_connect", traced_connect)
+        yield database_file, statements
+
+
+def plan_problems(detail: str) -> list[str]:
+    problems = []
+    # full-text matches and merged subquery results are read whole by design
+    scanned = detail.startswith("SCAN ") and not detail.startswith("SCAN (")
+    if scanned and "USING" not in detail and "VIRTUAL TABLE" not in detail:
+        problems.append(f"full table scan: {detail}")
+    if "USE TEMP B-TREE" in detail:
+        problems.append(f"unindexed sort: {detail}")
+    return problems
+
+
+@pytest.mark.parametrize("call, allowed", CALLS)
+def test_queries_use_indexes(traced_database, call, allowed):
+    database_file, statements = traced_database
+
+    call(database_file)
+
+    # the statements the call really ran, with their parameters already bound; those
+    # triggers run are marked as comments, and the full-text extension's own name
+    # their schema
+    queries = list(
+        dict.fromkeys(
+            statement
+            for statement in statements
+            if statement.lstrip().upper().startswith(STATEMENTS)
+            and "'main'." not in statement
+        )
+    )
+    assert queries
+    problems = []
+    connection = sqlite3.connect(database_file)
+    try:
+        for query in queries:
+            details = [
+                row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {query}")
+            ]
+            problems += [
+                f"{problem}\n{query}"
+                for detail in details
+                for problem in plan_problems(detail)
+                if not any(exception in detail for exception in allowed)
+            ]
+    finally:
+        connection.close()
+    assert not problems, "\n\n".join(problems)
+
+
+def test_foreign_keys_are_indexed(database_file):
+    # cascades run inside SQLite, where the trace callback cannot see them
+    connection = sqlite3.connect(database_file)
+    try:
+        tables = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ).fetchall()
+        for (table,) in tables:
+            foreign_keys = connection.execute(f"PRAGMA foreign_key_list('{table}')")
+            for foreign_key in foreign_keys.fetchall():
+                column = foreign_key[3]
+                details = [
+                    row[3]
+                    for row in connection.execute(
+                        f"EXPLAIN QUERY PLAN SELECT 1 FROM {table} WHERE {column} = 1"
+                    )
+                ]
+                assert not [
+                    problem for detail in details for problem in plan_problems(detail)
+                ], f"{table}.{column} has no index: {details}"
+    finally:
+        connection.close()
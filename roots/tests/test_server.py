@@ -0,0 +1,40 @@
+import pytest
+
+import app
+from roots import jobs
+
+
+@pytest.fixture
+def started(monkeypatch) -> list[bool]:
+    calls: list[bool] = []
+    monkeypatch.setattr(app, "_initialized", False)
+    monkeypatch.setattr(jobs, "start", lambda *args, **kwargs: calls.append(True))
+    monkeypatch.setattr(app.socketio, "run", lambda *args, **kwargs: None)
+    monkeypatch.setattr(app, "DEBUG", True)
+    return calls
+
+
+def test_reloader_parent_does_not_start_workers(started, monkeypatch):
+    monkeypatch.delenv("WERKZEUG_RUN_MAIN", raising=False)
+
+    app.main()
+
+    assert not started
+    assert not app._initialized  # pylint: disable=protected-access
+
+
+def test_reloader_child_starts_workers(started, monkeypatch):
+    monkeypatch.setenv("WERKZEUG_RUN_MAIN", "true")
+
+    app.main()
+
+    assert started == [True]
+
+
+def test_without_debug_the_only_process_starts_workers(started, monkeypatch):
+    monkeypatch.setattr(app, "DEBUG", False)
+    monkeypatch.delenv("WERKZEUG_RUN_MAIN", raising=False)
+
+    app.main()
+
+    assert started == [True]
@@ -0,0 +1,86 @@
+import time
+
+from roots import conversations, sessions
+from roots.sessions import MemorySessionBackend, SessionStore, SQLiteSessionBackend
+
+
+def test_least_recent_history_is_evicted_and_reloaded():
+    conversation_ids = [
+        conversations.create(f"evicted/{number}")["conversation_id"]
+        for number in range(3)
+    ]
+    store = SessionStore(MemorySessionBackend(), max_conversations=2)
+
+    histories = [
+        store.history("session", conversation_id) for conversation_id in conversation_ids
+    ]
+
+    assert store.stats()["size"] == 2
+    assert ("session", conversation_ids[0]) not in store.histories.keys()
+    # evicted histories are rebuilt from the database on the next request
+    reloaded = store.history("session", conversation_ids[0])
+    assert reloaded is not histories[0]
+    assert reloaded.conversation_id == conversation_ids[0]
+
+
+def test_idle_sessions_expire(monkeypatch):
+    monkeypatch.setattr(sessions, "SESSION_EXPIRE_INTERVAL_SECONDS", 0.0)
+    conversation_id = conversations.create("expiring")["conversation_id"]
+    backend = MemorySessionBackend()
+    store = SessionStore(backend, ttl_seconds=0.05)
+
+    store.history("idle", conversation_id)
+    time.sleep(0.1)
+    store.history("active", conversation_id)
+
+    assert backend.get("idle", "conversation_id") is None
+    assert backend.get("active", "conversation_id") is not None
+    assert [key[0] for key in store.histories.keys()] == ["active"]
+
+
+class CountingBackend(MemorySessionBackend):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def put(self, session_id, name, value):
+        self.writes += 1
+        super().put(session_id, name, value)
+
+
+def test_repeated_requests_write_the_session_once(monkeypatch):
+    conversation_ids = [
+        conversations.create(f"touched/{number}")["conversation_id"]
+        for number in range(2)
+    ]
+    backend = CountingBackend()
+    store = SessionStore(backend)
+
+    for _ in range(3):
+        store.history("session", conversation_ids[0])
+    assert backend.writes == 1
+
+    store.history("session", conversation_ids[1])
+    assert backend.writes == 2
+    assert backend.get("session", "conversation_id") == str(conversation_ids[1])
+
+    # a session in use is still rewritten often enough not to look idle
+    monkeypatch.setattr(sessions, "SESSION_TOUCH_SECONDS", 0.0)
+    store.history("session", conversation_ids[1])
+    assert backend.writes == 3
+
+
+def test_active_conversations_are_shared_through_the_backend(tmp_path):
+    backend = SQLiteSessionBackend(str(tmp_path / "sessions.db"))
+    conversation_ids = [
+        conversations.create(f"active/{number}")["conversation_id"] for number in range(2)
+    ]
+    # two processes, each with its own cache, sharing one session database
+    first, second = SessionStore(backend), SessionStore(backend)
+    first.history("first", conversation_ids[0])
+    second.history("second", conversation_ids[1])
+
+    assert first.active_conversations() == set(conversation_ids)
+
+    second.drop("second")
+    assert first.active_conversations() == {conversation_ids[0]}
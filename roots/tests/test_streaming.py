@@ -0,0 +1,57 @@
+import threading
+import time
+
+from benchmarks import fakes
+from roots.cancellation import CancellationToken
+from roots.streaming import StreamCoalescer
+
+
+class BlockingResponse:
+    # stands in for an HTTP response whose first chunk has not arrived yet
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        if not self.closed.wait(timeout=5.0):
+            yield "too late"
+        raise ConnectionError("response closed")
+
+    def close(self):
+        self.closed.set()
+
+
+class BlockingProvider(fakes.FakeProvider):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.attempts = 2
+        self.responses: list[BlockingResponse] = []
+        self.finished = threading.Event()
+
+    def _stream(self, model_id, messages, cancellation=None):
+        response = BlockingResponse()
+        self.responses.append(response)
+        self._close_on_cancel(cancellation, response.close)
+        try:
+            yield from response
+        finally:
+            self.finished.set()
+
+
+def test_cancel_closes_the_response_before_the_first_token():
+    provider = BlockingProvider("blocking")
+    token = CancellationToken("blocked")
+    frames: list[str] = []
+    coalescer = StreamCoalescer(lambda frame, _: frames.append(frame))
+    timer = threading.Timer(0.05, token.cancel)
+    started_at = time.monotonic()
+    timer.start()
+
+    response = coalescer.stream(provider.stream("model", [], token), token)
+
+    assert response == "" and not frames
+    assert coalescer.stats.cancelled
+    # the provider's read ends with the cancel rather than with its next token
+    assert provider.finished.wait(timeout=1.0)
+    assert time.monotonic() - started_at < 1.0
+    # a closed response is not mistaken for a failure worth retrying
+    assert len(provider.responses) == 1
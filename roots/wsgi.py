@@ -0,0 +1,7 @@
+# the entry point for a production server such as gunicorn, which imports the app
+# without running app.py as a script
+from app import app, initialize
+
+initialize()
+
+__all__ = ["app"]
@@ -9,6 +9,7 @@ export type Message = {
   context: string | null;
   created_at_utc: number | null;
   model_id: string | null;
+  state?: "complete" | "cancelled" | "failed";
 };
 
 export type Conversation = {
@@ -17,6 +18,7 @@ export type Conversation = {
   created_at_utc: number;
   last_modified_at_utc: number;
   messages: Message[];
+  has_more_messages?: boolean;
 };
 
 export type Model = {
@@ -31,6 +33,7 @@ export type BackendState =
   | "thinking"
   | "writing"
   | "complete"
+  | "cancelled"
   | "failed";
 
 export type MessageState = {
@@ -24,9 +24,11 @@ export default function Chat() {
   const [textareaHeight, setTextareaHeight] = useState<number>(80);
   const [activeMessage, setActiveMessage] = useState<Message | null>(null);
   const [lastSentMessageId, setLastSentMessageId] = useState<string | null>(null);
+  const [hasMoreMessages, setHasMoreMessages] = useState<boolean>(false);
 
   const chatContainerRef = useRef<HTMLDivElement | null>(null);
   const messagesContainerRef = useRef<HTMLDivElement | null>(null);
+  const streamingMessageIdRef = useRef<string | null>(null);
 
   if (!currentConversation) {
     return (
@@ -62,18 +64,23 @@ export default function Chat() {
       }));
     }
 
-    function handleMessageStreamResponse({
-      message_id,
-      content,
-    }: {
-      message_id: string;
-      content: string;
-    }) {
+    function handleMessageStreamResponse(
+      {
+        message_id,
+        content,
+      }: {
+        message_id: string;
+        content: string;
+      },
+      acknowledge?: () => void
+    ) {
       setMessages((prev: Message[]) =>
         prev.map((msg) =>
           msg.message_id === message_id ? { ...msg, content: msg.content + content } : msg
         )
       );
+      // lets the backend pace its frames to how fast we keep up
+      acknowledge?.();
     }
 
     function handleMessageMetadataResponse({
@@ -90,13 +97,44 @@ export default function Chat() {
       );
     }
 
+    function markStopped(loaded: Message[]) {
+      setMessagesState((prev) => {
+        const next = { ...prev };
+        for (const message of loaded) {
+          if (message.state === "cancelled" || message.state === "failed") {
+            next[message.message_id] = message.state;
+          }
+        }
+        return next;
+      });
+    }
+
+    function handleMessagesResponse({
+      conversation_id,
+      messages: olderMessages,
+      has_more,
+    }: {
+      conversation_id: number;
+      messages: Message[];
+      has_more: boolean;
+    }) {
+      if (conversation_id !== currentConversation.conversation_id) return;
+      setMessages((prev: Message[]) => [...olderMessages, ...prev]);
+      markStopped(olderMessages);
+      setHasMoreMessages(has_more);
+    }
+
     setMessages(currentConversation.messages);
+    markStopped(currentConversation.messages);
+    setHasMoreMessages(!!currentConversation.has_more_messages);
     socket.on("backend_update", handleBackendUpdate);
+    socket.on("messages_response", handleMessagesResponse);
     socket.on("message_stream_response", handleMessageStreamResponse);
     socket.on("message_metadata_response", handleMessageMetadataResponse);
 
     return () => {
       socket.off("backend_update", handleBackendUpdate);
+      socket.off("messages_response", handleMessagesResponse);
       socket.off("message_stream_response", handleMessageStreamResponse);
       socket.off("message_metadata_response", handleMessageMetadataResponse);
     };
@@ -217,6 +255,7 @@ export default function Chat() {
     };
 
     setMessages((prev) => [...prev, assistantMessage]);
+    streamingMessageIdRef.current = assistantMessageID;
     socket.emit("new_message", {
       user_message: userMessage,
       assistant_message: assistantMessage,
@@ -239,8 +278,16 @@ export default function Chat() {
     }, 3000);
   }
 
+  function loadEarlierMessages() {
+    socket.emit("request_messages", {
+      conversation_id: currentConversation.conversation_id,
+      before: messages[0]?.message_id ?? null,
+    });
+  }
+
   function stopStream() {
-    socket.emit("stop");
+    socket.emit("stop", { message_id: streamingMessageIdRef.current });
+    streamingMessageIdRef.current = null;
     setBackendState("idle");
   }
 
@@ -322,6 +369,14 @@ export default function Chat() {
           ref={messagesContainerRef}
           className="flex flex-col min-h-0 min-w-0 space-y-6 w-[90%] mx-auto"
         >
+          {hasMoreMessages && (
+            <button
+              onClick={loadEarlierMessages}
+              className="text-center text-textSecondary dark:text-textSecondary-dark text-xs opacity-70"
+            >
+              Load earlier messages
+            </button>
+          )}
           {renderMessages(messages, messagesState)}
         </div>
         {/* Thinking Indicator */}
@@ -75,6 +75,9 @@ export default function ChatMessage({ message, state, onClick }: ChatMessageProp
             {state === "failed" && (
               <div className="text-red-300">Could not reach backend... Try again.</div>
             )}
+            {state === "cancelled" && (
+              <div className="text-textSecondary dark:text-textSecondary-dark">Stopped.</div>
+            )}
             <div className="flex items-center gap-1">
               <span className="markdown inline-block rounded">
                 <MarkdownRenderer content={message.content} />
@@ -1,4 +1,4 @@
-import { useEffect, useState } from "react";
+import { UIEvent, useEffect, useState } from "react";
 
 import { ChevronDownIcon } from "@heroicons/react/24/outline";
 
@@ -92,7 +92,8 @@ type SidebarProps = {
 
 export default function Sidebar({ onConversationSelect }: SidebarProps) {
   const [conversationsTree, setConversationsTree] = useState<ConversationTree>({});
-  const { availableConversations } = useConversation();
+  const { availableConversations, hasMoreConversations, loadMoreConversations } =
+    useConversation();
   const handleSelect = onConversationSelect ?? (() => {});
 
   useEffect(() => {
@@ -126,8 +127,16 @@ export default function Sidebar({ onConversationSelect }: SidebarProps) {
     return tree;
   }
 
+  function handleScroll(event: UIEvent<HTMLDivElement>) {
+    const { scrollTop, scrollHeight, clientHeight } = event.currentTarget;
+    if (scrollHeight - scrollTop - clientHeight < 200) loadMoreConversations();
+  }
+
   return (
-    <div className="overflow-y-auto h-full w-full bg-sidebar dark:bg-sidebar-dark text-textPrimary dark:text-textPrimary-dark p-4">
+    <div
+      onScroll={handleScroll}
+      className="overflow-y-auto h-full w-full bg-sidebar dark:bg-sidebar-dark text-textPrimary dark:text-textPrimary-dark p-4"
+    >
       <div className="flex flex-row flex-1 justify-around">
         <div className="w-5 h-5 hover:scale-125 transition-transform transform duration-300">
           <NewProjectButton />
@@ -148,6 +157,14 @@ export default function Sidebar({ onConversationSelect }: SidebarProps) {
             <SidebarItem key={key} name={key} data={value} onSelect={handleSelect} />
           ))}
       </div>
+      {hasMoreConversations && (
+        <button
+          onClick={loadMoreConversations}
+          className="mt-4 w-full text-sm text-textSecondary dark:text-textSecondary-dark opacity-70 hover:opacity-100"
+        >
+          Load older conversations
+        </button>
+      )}
     </div>
   );
 }
@@ -1,4 +1,4 @@
-import { createContext, useContext, useEffect, useState, ReactNode } from "react";
+import { createContext, useContext, useEffect, useRef, useState, ReactNode } from "react";
 import { Conversation, Model } from "../Types";
 import { useSocket } from "./SocketContext";
 import LoadingOverlay from "../components/LoadingOverlay";
@@ -8,6 +8,8 @@ type ConversationContextType = {
   currentConversation: Conversation;
   availableConversations: Conversation[];
   availableModels: Model[];
+  hasMoreConversations: boolean;
+  loadMoreConversations: () => void;
   setCurrentModel: (model: Model) => void;
   setCurrentConversationByID: (conversation_id: number) => void;
 };
@@ -28,17 +30,48 @@ export function ConversationProvider({ children }: { children: ReactNode }) {
     []
   );
   const [availableModels, setAvailableModels] = useState<Model[]>([]);
+  const [hasMoreConversations, setHasMoreConversations] = useState(false);
+  // the oldest conversation of the last page, where the next page starts
+  const pageCursor = useRef<Conversation | null>(null);
+  const pageRequested = useRef(false);
   const [isLoaded, setIsLoaded] = useState(false);
 
   // handle new socket
   useEffect(() => {
     socket.emit("request_models");
-    socket.emit("request_conversations");
+    pageCursor.current = null;
+    pageRequested.current = true;
+    socket.emit("request_conversations_page", {});
+
+    function mergeConversations(conversations: Conversation[]) {
+      setAvailableConversations((prev) => {
+        const merged = new Map(prev.map((c) => [c.conversation_id, c]));
+        conversations.forEach((c) => merged.set(c.conversation_id, c));
+        return Array.from(merged.values()).sort(
+          (a, b) =>
+            b.last_modified_at_utc - a.last_modified_at_utc ||
+            b.conversation_id - a.conversation_id
+        );
+      });
+    }
 
     function handleConversationsResponse(conversations: Conversation[]) {
       setAvailableConversations(conversations);
     }
 
+    function handleConversationsPageResponse({
+      conversations,
+      has_more,
+    }: {
+      conversations: Conversation[];
+      has_more: boolean;
+    }) {
+      mergeConversations(conversations);
+      pageCursor.current = conversations.at(-1) ?? pageCursor.current;
+      pageRequested.current = false;
+      setHasMoreConversations(has_more);
+    }
+
     function handleConversationUpdate(conversation: Conversation) {
       setCurrentConversation(conversation);
     }
@@ -56,6 +89,8 @@ export function ConversationProvider({ children }: { children: ReactNode }) {
 
     socket.on("conversation_response", handleConversationResponse);
     socket.on("conversations_response", handleConversationsResponse);
+    socket.on("conversations_page_response", handleConversationsPageResponse);
+    socket.on("conversations_delta", mergeConversations);
     socket.on("conversation_update", handleConversationUpdate);
     socket.on("models_response", handleModelsResponse);
     setIsLoaded(true);
@@ -63,6 +98,8 @@ export function ConversationProvider({ children }: { children: ReactNode }) {
     return () => {
       socket.off("conversation_response", handleConversationResponse);
       socket.off("conversations_response", handleConversationsResponse);
+      socket.off("conversations_page_response", handleConversationsPageResponse);
+      socket.off("conversations_delta", mergeConversations);
       socket.off("conversation_update", handleConversationUpdate);
       socket.off("models_response", handleModelsResponse);
       setIsLoaded(false);
@@ -101,6 +138,17 @@ export function ConversationProvider({ children }: { children: ReactNode }) {
     }
   }
 
+  // older pages are only fetched when the list is scrolled to its end
+  function loadMoreConversations() {
+    const cursor = pageCursor.current;
+    if (!socket || !hasMoreConversations || !cursor || pageRequested.current) return;
+    pageRequested.current = true;
+    socket.emit("request_conversations_page", {
+      before_modified: cursor.last_modified_at_utc,
+      before_conversation_id: cursor.conversation_id,
+    });
+  }
+
   function setCurrentModel(newModel: Model) {
     if (newModel !== currentModel) {
       localStorage.setItem("modelID", String(newModel.model_id));
@@ -121,6 +169,8 @@ export function ConversationProvider({ children }: { children: ReactNode }) {
         currentModel: currentModel,
         setCurrentModel: setCurrentModel,
         availableModels: availableModels,
+        hasMoreConversations: hasMoreConversations,
+        loadMoreConversations: loadMoreConversations,
       }}
     >
       {children}